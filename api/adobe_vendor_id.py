@@ -4,6 +4,7 @@ import uuid
 import base64
 import os
 import datetime
+import time
 import jwt
 from jwt.algorithms import HMACAlgorithm
 
@@ -16,6 +17,7 @@ from config import (
 )
 from api.base_controller import BaseCirculationManagerController
 from problem_details import *
+from util.lru import ExpiringLRUCache
 from sqlalchemy.orm.session import Session
 from core.util.xmlparser import XMLParser
 from core.util.problem_detail import ProblemDetail
@@ -592,9 +594,19 @@ class AuthdataUtility(object):
     ADOBE_ACCOUNT_ID_PATRON_IDENTIFIER = "Identifier for Adobe account ID purposes"
     
     ALGORITHM = 'HS256'
+
+    # A short client token is good for this long.
+    SHORT_CLIENT_TOKEN_LIFETIME = datetime.timedelta(minutes=60)
+
+    # By default, a short client token is handed out again, rather
+    # than generating a new one, for this many seconds.
+    DEFAULT_SHORT_CLIENT_TOKEN_REUSE = 600
+
+    # Remember short client tokens for at most this many patrons.
+    SHORT_CLIENT_TOKEN_CACHE_SIZE = 10000
    
     def __init__(self, vendor_id, library_uri, library_short_name, secret,
-                 other_libraries={}):
+                 other_libraries={}, short_client_token_reuse=0):
         """Basic constructor.
 
         :param vendor_id: The Adobe Vendor ID that should accompany authdata
@@ -618,6 +630,11 @@ class AuthdataUtility(object):
         instance of this class will be able to decode an authdata from
         any library in this dictionary (plus the library it was
         initialized for).
+
+        :param short_client_token_reuse: short_client_token() will
+        hand out the same token to a given patron for this many
+        seconds. This can't be more than half of the token's lifetime,
+        so a client never receives a token that's about to expire.
         """
         self.vendor_id = vendor_id
 
@@ -660,17 +677,42 @@ class AuthdataUtility(object):
         self.short_token_signing_key = self.short_token_signer.prepare_key(
             self.secret
         )
+
+        max_reuse = self.SHORT_CLIENT_TOKEN_LIFETIME.total_seconds() / 2
+        self.short_client_token_reuse = min(
+            short_client_token_reuse or 0, max_reuse
+        )
+        self._short_client_tokens = ExpiringLRUCache(
+            self.SHORT_CLIENT_TOKEN_CACHE_SIZE
+        )
         
     LIBRARY_URI_KEY = 'library_uri'
     LIBRARY_SHORT_NAME_KEY = 'library_short_name'
     AUTHDATA_SECRET_KEY = 'authdata_secret'
     OTHER_LIBRARIES_KEY = 'other_libraries'
     OTHER_LIBRARY_SHORT_NAMES_KEY = 'other_library_short_names'
+    SHORT_CLIENT_TOKEN_REUSE_KEY = 'short_client_token_reuse'
+
+    # from_config() checks the library's short name and shared secret,
+    # which are stored in the database, at most this often (in
+    # seconds).
+    LIBRARY_CACHE_TIME = 60
+
+    # The most recent AuthdataUtility created by from_config(), along
+    # with the configuration and library information it was created
+    # from, and the time at which the library information needs to be
+    # checked again.
+    _from_config = None
 
     @classmethod
     def from_config(cls, _db):
         """Initialize an AuthdataUtility from site configuration.
 
+        The same AuthdataUtility is returned every time, until the
+        configuration changes, so that short client tokens can be
+        reused across requests. A change to the library's short name
+        or shared secret is noticed within LIBRARY_CACHE_TIME seconds.
+
         :return: An AuthdataUtility if one is configured; otherwise
         None.
 
@@ -684,24 +726,51 @@ class AuthdataUtility(object):
             return None
         vendor_id = integration.get(Configuration.ADOBE_VENDOR_ID)
         library_uri = integration.get(cls.LIBRARY_URI_KEY)
+        other_libraries = integration.get(cls.OTHER_LIBRARIES_KEY, {})
+        incomplete = CannotLoadConfiguration(
+            "Adobe Vendor ID configuration is incomplete. %s, %s, library.library_registry_short_name and library.library_registry_shared_secret must all be defined." % (
+                cls.LIBRARY_URI_KEY,
+                Configuration.ADOBE_VENDOR_ID
+            )
+        )
+        if not vendor_id or not library_uri:
+            raise incomplete
+        reuse = integration.get(
+            cls.SHORT_CLIENT_TOKEN_REUSE_KEY,
+            cls.DEFAULT_SHORT_CLIENT_TOKEN_REUSE
+        )
+        config_key = (
+            vendor_id, library_uri,
+            tuple(sorted(
+                (uri, tuple(v)) for uri, v in other_libraries.items()
+            )),
+            reuse
+        )
+        now = time.time()
+        cached = cls._from_config
+        if cached:
+            cached_config_key, cached_library_key, utility, check_at = cached
+            if cached_config_key == config_key and now < check_at:
+                return utility
+
         library = Library.instance(_db)
         library_short_name = library.library_registry_short_name
         secret = library.library_registry_shared_secret
-        other_libraries = integration.get(cls.OTHER_LIBRARIES_KEY, {})
-        if (not vendor_id or not library_uri
-            or not library_short_name or not secret):
-            raise CannotLoadConfiguration(
-                "Adobe Vendor ID configuration is incomplete. %s, %s, library.library_registry_short_name and library.library_registry_shared_secret must all be defined." % (
-                    cls.LIBRARY_URI_KEY,
-                    Configuration.ADOBE_VENDOR_ID
-                )
-            )
+        if not library_short_name or not secret:
+            raise incomplete
         if '|' in library_short_name:
             raise CannotLoadConfiguration(
                 "Library short name cannot contain the pipe character."
             )
-        return cls(vendor_id, library_uri, library_short_name, secret,
-                   other_libraries)
+        library_key = (library_short_name, secret)
+        if not cached or (cached_config_key, cached_library_key) != (
+                config_key, library_key):
+            utility = cls(vendor_id, library_uri, library_short_name, secret,
+                          other_libraries, short_client_token_reuse=reuse)
+        cls._from_config = (
+            config_key, library_key, utility, now + cls.LIBRARY_CACHE_TIME
+        )
+        return utility
         
     def encode(self, patron_identifier):
         """Generate an authdata JWT suitable for putting in an OPDS feed, where
@@ -819,11 +888,33 @@ class AuthdataUtility(object):
         if not patron_identifier:
             raise ValueError("No patron identifier specified")
         now = datetime.datetime.utcnow()
-        expires = int(self.numericdate(now + datetime.timedelta(minutes=60)))
+        expires = int(
+            self.numericdate(now + self.SHORT_CLIENT_TOKEN_LIFETIME)
+        )
         authdata = self._encode_short_client_token(
             self.short_name, patron_identifier, expires
         )
         return self.vendor_id, authdata
+
+    def short_client_token(self, patron_identifier):
+        """Find a short client token for the given patron, reusing a
+        recently generated one if possible.
+
+        A patron's bookshelf contains the same token many times over,
+        and clients sync the bookshelf often, so there's no need to
+        sign a new token every time.
+
+        :return: A 2-tuple (vendor ID, token)
+        """
+        if not self.short_client_token_reuse:
+            return self.encode_short_client_token(patron_identifier)
+        value = self._short_client_tokens.get(patron_identifier)
+        if value is None:
+            value = self.encode_short_client_token(patron_identifier)
+            self._short_client_tokens.put(
+                patron_identifier, value, self.short_client_token_reuse
+            )
+        return value
     
     def _encode_short_client_token(self, library_short_name,
                                    patron_identifier, expires):
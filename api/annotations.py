@@ -3,6 +3,8 @@ from pyld import jsonld
 import json
 from datetime import datetime
 import os
+from sqlalchemy import func
+from sqlalchemy.orm.session import Session
 
 from core.model import (
     Annotation,
@@ -53,6 +55,19 @@ class AnnotationWriter(object):
             annotations = [annotation for annotation in annotations if annotation.identifier == identifier]
         return annotations
 
+    @classmethod
+    def latest_timestamp_for(cls, patron, identifier=None):
+        """Find the last time one of the patron's annotations was
+        created, changed or deleted, without loading the annotations.
+        """
+        _db = Session.object_session(patron)
+        qu = _db.query(func.max(Annotation.timestamp)).filter(
+            Annotation.patron_id==patron.id
+        )
+        if identifier:
+            qu = qu.filter(Annotation.identifier_id==identifier.id)
+        return qu.scalar()
+
     @classmethod
     def annotation_container_for(cls, patron, identifier=None):
         if identifier:
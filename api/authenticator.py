@@ -18,13 +18,18 @@ from core.util.problem_detail import (
 )
 from core.util.opds_authentication_document import OPDSAuthenticationDocument
 from core.analytics import Analytics
+from sqlalchemy import or_
 from sqlalchemy.ext.hybrid import hybrid_property
 from problem_details import *
 from util.patron import PatronUtility
+from util.lru import ExpiringLRUCache
 
 import datetime
+import hashlib
+import hmac
 import logging
 from money import Money
+import os
 import re
 import urlparse
 import urllib
@@ -40,6 +45,7 @@ from flask import (
 from werkzeug.datastructures import Headers
 from flask.ext.babel import lazy_gettext as _
 import importlib
+import weakref
 
 
 class PatronData(object):
@@ -231,6 +237,13 @@ class PatronData(object):
             # external sync.
             patron.last_external_sync = datetime.datetime.utcnow()
 
+        if not CredentialCache.cacheable(patron):
+            # This patron has been blocked or their card has
+            # expired. Make sure their credentials are checked with
+            # the ILS next time, so we find out as soon as that
+            # changes.
+            CredentialCache.invalidate_everywhere(patron)
+
     def set_value(self, patron, field_name, value):
         if value is None:
             # Do nothing
@@ -328,6 +341,106 @@ class PatronData(object):
         self.authorization_identifier = authorization_identifier
         self.authorization_identifiers = authorization_identifiers
         
+class CredentialCache(object):
+    """Remember which Basic Auth credentials were recently found to be
+    valid (or invalid), so that we don't have to ask the ILS about
+    them on every request.
+
+    Credentials are never stored. Each username and password pair is
+    reduced to a keyed hash, using a key that is generated when the
+    cache is created and never leaves this process.
+    """
+
+    # Every CredentialCache in this process, so that a change in a
+    # patron's status can be noticed by all of them.
+    _instances = weakref.WeakSet()
+
+    # Distinguishes credentials that aren't in the cache from
+    # credentials that are known to be invalid.
+    NOT_FOUND = object()
+
+    def __init__(self, ttl, failed_ttl=0, max_size=10000):
+        """Constructor.
+
+        :param ttl: Remember valid credentials for this many seconds.
+        :param failed_ttl: Remember invalid credentials for this many
+        seconds.
+        :param max_size: Remember at most this many sets of credentials.
+        """
+        self.ttl = ttl
+        self.failed_ttl = failed_ttl
+        self.max_size = max_size
+        self.key = os.urandom(32)
+
+        # Maps the hash of a set of credentials to a patron ID. A
+        # patron ID of None means the credentials are invalid.
+        self.entries = ExpiringLRUCache(max_size)
+        self._instances.add(self)
+
+    @classmethod
+    def cacheable(cls, patron):
+        """Is it safe to skip the ILS when this patron authenticates?
+
+        Patrons who are blocked or whose cards have expired are always
+        checked with the ILS, so that any change in their status takes
+        effect immediately.
+        """
+        return (patron.block_reason is None
+                and PatronUtility.authorization_is_active(patron))
+
+    @classmethod
+    def invalidate_everywhere(cls, patron):
+        """Forget every set of credentials that authenticated the given
+        patron.
+        """
+        if patron.id is None:
+            return
+        for cache in list(cls._instances):
+            cache.invalidate(patron.id)
+
+    def hash(self, username, password):
+        if isinstance(username, unicode):
+            username = username.encode("utf8")
+        if isinstance(password, unicode):
+            password = password.encode("utf8")
+        credentials = "%s\0%s" % (username or "", password or "")
+        return hmac.new(self.key, credentials, hashlib.sha256).digest()
+
+    def get(self, username, password):
+        """Look up a set of credentials.
+
+        :return: A 2-tuple (found, patron ID). If `found` is True and
+        the patron ID is None, the credentials were recently found
+        to be invalid.
+        """
+        if not self.ttl and not self.failed_ttl:
+            return False, None
+        patron_id = self.entries.get(
+            self.hash(username, password), self.NOT_FOUND
+        )
+        if patron_id is self.NOT_FOUND:
+            return False, None
+        return True, patron_id
+
+    def put(self, username, password, patron_id):
+        """Remember that a set of credentials authenticated the given
+        patron, or (if `patron_id` is None) that they're invalid.
+        """
+        if patron_id is None:
+            ttl = self.failed_ttl
+        else:
+            ttl = self.ttl
+        if not ttl:
+            return
+        self.entries.put(self.hash(username, password), patron_id, ttl)
+
+    def invalidate(self, patron_id):
+        """Forget every set of credentials for the given patron."""
+        self.entries.remove_where(
+            lambda key, cached_id: cached_id == patron_id
+        )
+
+
 class Authenticator(object):
     """Use the registered AuthenticationProviders to turn incoming
     credentials into Patron objects.
@@ -797,6 +910,12 @@ class BasicAuthenticationProvider(AuthenticationProvider):
     DEFAULT_IDENTIFIER_REGULAR_EXPRESSION = alphanumerics_plus
     DEFAULT_PASSWORD_REGULAR_EXPRESSION = None        
 
+    # By default, credentials the ILS has accepted are trusted for
+    # five minutes without being checked again. Credentials the ILS
+    # has rejected are rejected for thirty seconds.
+    DEFAULT_CREDENTIAL_CACHE_TTL = 300
+    DEFAULT_FAILED_CREDENTIAL_CACHE_TTL = 30
+
     @classmethod
     def from_config(cls, config):
         """Load a BasicAuthenticationProvider from site configuration."""
@@ -810,8 +929,18 @@ class BasicAuthenticationProvider(AuthenticationProvider):
     def __init__(self,
                  identifier_regular_expression=class_default,
                  password_regular_expression=class_default,
-                 test_username=None, test_password=None):
+                 test_username=None, test_password=None,
+                 credential_cache_ttl=class_default,
+                 failed_credential_cache_ttl=class_default):
         """Create a BasicAuthenticationProvider.
+
+        :param credential_cache_ttl: Once the ILS accepts a set of
+        credentials, accept them for this many seconds without checking
+        with the ILS again.
+
+        :param failed_credential_cache_ttl: Once the ILS rejects a set
+        of credentials, reject them for this many seconds without
+        checking with the ILS again.
         """
         if identifier_regular_expression is self.class_default:
             identifier_regular_expression = self.DEFAULT_IDENTIFIER_REGULAR_EXPRESSION
@@ -831,6 +960,14 @@ class BasicAuthenticationProvider(AuthenticationProvider):
         self.password_re = password_regular_expression
         self.test_username = test_username
         self.test_password = test_password
+
+        if credential_cache_ttl is self.class_default:
+            credential_cache_ttl = self.DEFAULT_CREDENTIAL_CACHE_TTL
+        if failed_credential_cache_ttl is self.class_default:
+            failed_credential_cache_ttl = self.DEFAULT_FAILED_CREDENTIAL_CACHE_TTL
+        self.credential_cache = CredentialCache(
+            credential_cache_ttl, failed_credential_cache_ttl
+        )
         self.log = logging.getLogger(self.NAME)
         
     def testing_patron(self, _db):
@@ -859,12 +996,25 @@ class BasicAuthenticationProvider(AuthenticationProvider):
             # need to be checked with the source of truth.
             return None
 
+        # Have we checked these credentials with the source of truth
+        # recently?
+        found, patron_id = self.credential_cache.get(username, password)
+        if found:
+            if patron_id is None:
+                # The credentials were wrong last time.
+                return None
+            patron = _db.query(Patron).get(patron_id)
+            if patron:
+                return patron
+
         # Check these credentials with the source of truth.
         patrondata = self.remote_authenticate(username, password)
 
         if not patrondata or isinstance(patrondata, ProblemDetail):
             # Either an error occured or the credentials did not correspond
             # to any patron.
+            if patrondata is None or patrondata is False:
+                self.credential_cache.put(username, password, None)
             return patrondata
 
         # At this point we know there is _some_ authenticated patron,
@@ -879,6 +1029,7 @@ class BasicAuthenticationProvider(AuthenticationProvider):
             # We found them! Make sure their data is up to date
             # with whatever we just got from remote.
             patrondata.apply(patron)
+            self._remember_credentials(username, password, patron)
             return patron
         
         # We didn't find them. Now the question is: _why_ didn't the
@@ -901,6 +1052,7 @@ class BasicAuthenticationProvider(AuthenticationProvider):
             # For whatever reason, the remote lookup implementation
             # returned a Patron object instead of a PatronData. Just
             # use that Patron object.
+            self._remember_credentials(username, password, patrondata)
             return patrondata
 
         # At this point we have an updated PatronData object which
@@ -919,8 +1071,16 @@ class BasicAuthenticationProvider(AuthenticationProvider):
         # update the Patron record with the account information we
         # just got from the source of truth.
         patrondata.apply(patron)
+        self._remember_credentials(username, password, patron)
         return patron
 
+    def _remember_credentials(self, username, password, patron):
+        """Note that these credentials authenticated this patron, so
+        we don't have to ask the ILS again for a while.
+        """
+        if patron.id is not None and CredentialCache.cacheable(patron):
+            self.credential_cache.put(username, password, patron.id)
+
     def get_credential_from_header(self, header):
         """Extract a password credential from a WWW-Authenticate header
         (or equivalent).
@@ -1012,19 +1172,27 @@ class BasicAuthenticationProvider(AuthenticationProvider):
             # This is a Basic Auth username, but it might correspond
             # to either Patron.authorization_identifier or
             # Patron.username.
-            #
-            # TODO: We could save a bit of time in a common case by
-            # combining these into a single query.
             lookups.append(dict(authorization_identifier=username))
             lookups.append(dict(username=username))
 
-        patron = None
+        if not lookups:
+            return None
+
+        # Find every patron who matches any of the lookups in a single
+        # query, then pick the one found by the most reliable lookup.
+        clauses = []
         for lookup in lookups:
-            patron = get_one(_db, Patron, **lookup)
-            if patron:
-                # We found them!
-                break            
-        return patron
+            [(field, value)] = lookup.items()
+            clauses.append(getattr(Patron, field)==value)
+        candidates = _db.query(Patron).filter(or_(*clauses)).all()
+
+        for lookup in lookups:
+            [(field, value)] = lookup.items()
+            for patron in candidates:
+                if getattr(patron, field) == value:
+                    # We found them!
+                    return patron
+        return None
 
     @property
     def authentication_header(self):
@@ -53,6 +53,7 @@ from circulation import (
     BaseCirculationAPI
 )
 from circulation_exceptions import *
+from util.http_client import PooledHTTPClient
 
 
 class Axis360API(BaseAxis360API, Authenticator, BaseCirculationAPI):
@@ -75,6 +76,19 @@ class Axis360API(BaseAxis360API, Authenticator, BaseCirculationAPI):
         (pdf, adobe_drm): 'PDF',
     }
 
+    def __init__(self, *args, **kwargs):
+        super(Axis360API, self).__init__(*args, **kwargs)
+        self.http_client = PooledHTTPClient.for_integration(
+            self.SERVICE_NAME
+        )
+
+    def _make_request(self, url, method, headers, data=None, params=None,
+                      **kwargs):
+        """Make an HTTP request over a pooled connection."""
+        return self.http_client.request(
+            method, url, headers=headers, data=data, params=params, **kwargs
+        )
+
     def checkout(self, patron, pin, licensepool, internal_format):
 
         url = self.base_url + "checkout/v2" 
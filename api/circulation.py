@@ -2,11 +2,21 @@ from nose.tools import set_trace
 from circulation_exceptions import *
 import datetime
 from collections import defaultdict
-from threading import Thread
+import copy
 import logging
 import re
 import time
+from threading import Lock
 from flask.ext.babel import lazy_gettext as _
+from sqlalchemy import (
+    and_,
+    or_,
+)
+from sqlalchemy.orm import (
+    contains_eager,
+    joinedload,
+    Session,
+)
 
 from core.analytics import Analytics
 from core.model import (
@@ -18,8 +28,11 @@ from core.model import (
     LicensePool,
     Loan,
     Hold,
+    Patron,
 )
 from util.patron import PatronUtility
+from util.lru import ExpiringLRUCache
+from util.worker_pool import WorkerPool
 from core.util.cdn import cdnify
 from config import Configuration
 
@@ -124,18 +137,133 @@ class HoldInfo(CirculationInfo):
         )
 
 
+class PatronActivityCache(object):
+    """A short-lived, in-memory record of what each data source told
+    us about each patron's loans and holds.
+
+    Clients tend to sync a patron's bookshelf several times in quick
+    succession. This lets all but the first sync skip the trip to the
+    remote APIs.
+
+    A fetch may still be in flight when the patron's activity is
+    invalidated, and the out-of-date result it eventually brings back
+    must not be cached. To prevent this, every patron has a generation,
+    which changes whenever their activity is invalidated. A caller
+    notes the generation before fetching, and passes it into put(),
+    which ignores the result if the generation has changed.
+    """
+
+    def __init__(self, ttl, max_size=10000):
+        """Constructor.
+
+        :param ttl: Cached activity is good for this many seconds. If
+        this is zero, nothing is cached.
+        :param max_size: Keep at most this many entries, discarding the
+        least recently used.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = ExpiringLRUCache(max_size)
+
+        # Every invalidation gets a new number from this counter, and
+        # a patron's generation is the number of their most recent
+        # invalidation. When a patron is forgotten to keep this
+        # bounded, _forgotten_generation is raised so that it's
+        # higher than any generation they might have had.
+        self._lock = Lock()
+        self._counter = 0
+        self._generations = ExpiringLRUCache(
+            max_size, on_discard=self._forget_generation
+        )
+        self._forgotten_generation = 0
+
+    def _forget_generation(self, patron_id, generation):
+        self._forgotten_generation = max(
+            self._forgotten_generation, generation
+        )
+
+    def _generation(self, patron_id):
+        return self._generations.get(patron_id, self._forgotten_generation)
+
+    def generation(self, patron_id):
+        """:return: A value that changes whenever the patron's activity
+        is invalidated.
+        """
+        with self._lock:
+            return self._generation(patron_id)
+
+    def get(self, patron_id, data_source_id):
+        """Find a fresh list of LoanInfo and HoldInfo objects for the
+        given patron and data source.
+
+        :return: A list, or None if nothing fresh is cached.
+        """
+        if not self.ttl or not data_source_id:
+            return None
+        return self._entries.get((patron_id, data_source_id))
+
+    def put(self, patron_id, data_source_id, activity, generation=None):
+        """Cache the activity for the given patron and data source.
+
+        :param generation: The patron's generation from before the
+        activity was fetched. If the patron's activity has been
+        invalidated since then, nothing is cached.
+        """
+        if not self.ttl or not data_source_id:
+            return
+        activity = list(activity)
+        with self._lock:
+            if (generation is not None
+                and generation != self._generation(patron_id)):
+                return
+            self._entries.put(
+                (patron_id, data_source_id), activity, self.ttl
+            )
+
+    def invalidate(self, patron_id, data_source_id=None):
+        """Forget what we know about a patron's activity.
+
+        :param data_source_id: If this is provided, only forget the
+        patron's activity with this data source.
+        """
+        with self._lock:
+            self._counter += 1
+            self._generations.put(patron_id, self._counter)
+            if data_source_id:
+                self._entries.remove((patron_id, data_source_id))
+            else:
+                self._entries.remove_where(
+                    lambda key, activity: key[0] == patron_id
+                )
+
 
 class CirculationAPI(object):
     """Implement basic circulation logic and abstract away the details
     between different circulation APIs.
     """
 
-    def __init__(self, _db, overdrive=None, threem=None, axis=None):
+    # Every CirculationAPI in a process shares this pool of threads
+    # for asking distributors about patron activity.
+    PATRON_ACTIVITY_POOL = WorkerPool(10, "Patron activity")
+
+    # By default, this is how long, in seconds, to wait for any one
+    # distributor to tell us about a patron's activity.
+    PATRON_ACTIVITY_TIMEOUT = 30
+
+    def __init__(self, _db, overdrive=None, threem=None, axis=None,
+                 patron_activity_timeout=None, patron_activity_cache_ttl=0,
+                 patron_activity_cache_size=10000):
         self._db = _db
         self.overdrive = overdrive
         self.threem = threem
         self.axis = axis
         self.apis = [x for x in (overdrive, threem, axis) if x]
+        if patron_activity_timeout is None:
+            patron_activity_timeout = self.PATRON_ACTIVITY_TIMEOUT
+        self.patron_activity_timeout = patron_activity_timeout
+        self.patron_activity_cache = PatronActivityCache(
+            patron_activity_cache_ttl, patron_activity_cache_size
+        )
         self.log = logging.getLogger("Circulation API")
 
         # When we get our view of a patron's loans and holds, we need
@@ -143,19 +271,16 @@ class CirculationAPI(object):
         # need to include loans from open-access sources because we
         # are the authorities on those.
         data_sources_for_sync = []
-        if self.overdrive:
-            data_sources_for_sync.append(
-                DataSource.lookup(_db, DataSource.OVERDRIVE)
-            )
-        if self.threem:
-            data_sources_for_sync.append(
-                DataSource.lookup(_db, DataSource.THREEM)
-            )
-        if self.axis:
-            data_sources_for_sync.append(
-                DataSource.lookup(_db, DataSource.AXIS_360)
-            )
-
+        self.data_source_id_for_api = {}
+        for api, name in (
+                (self.overdrive, DataSource.OVERDRIVE),
+                (self.threem, DataSource.THREEM),
+                (self.axis, DataSource.AXIS_360),
+        ):
+            if api:
+                data_source = DataSource.lookup(_db, name)
+                data_sources_for_sync.append(data_source)
+                self.data_source_id_for_api[api] = data_source.id
 
         h = dict()
         for ds in data_sources_for_sync:
@@ -265,6 +390,7 @@ class CirculationAPI(object):
             loan_info = api.checkout(
                 patron, pin, licensepool, internal_format
             )
+            self._invalidate_patron_activity(patron, licensepool)
 
             # We asked the API to create a loan and it gave us a
             # LoanInfo object, rather than raising an exception like
@@ -351,6 +477,7 @@ class CirculationAPI(object):
                     patron, pin, licensepool,
                     hold_notification_email
                 )
+                self._invalidate_patron_activity(patron, licensepool)
             except AlreadyOnHold, e:
                 hold_info = HoldInfo(
                     licensepool.identifier.type, licensepool.identifier.identifier,
@@ -381,6 +508,15 @@ class CirculationAPI(object):
         __transaction.commit()
         return None, hold, is_new
 
+    def _invalidate_patron_activity(self, patron, licensepool):
+        """We just changed the patron's loans or holds with the API
+        responsible for `licensepool`, so anything cached about their
+        activity with that API is now out of date.
+        """
+        self.patron_activity_cache.invalidate(
+            patron.id, licensepool.data_source.id
+        )
+
     def _collect_checkout_event(self, licensepool):
         """Collect an analytics event indicating the given LicensePool
         was checked out via the circulation manager.
@@ -434,6 +570,7 @@ class CirculationAPI(object):
             fulfillment = api.fulfill(
                 patron, pin, licensepool, internal_format
             )
+            self._invalidate_patron_activity(patron, licensepool)
             if not fulfillment or not (
                     fulfillment.content_link or fulfillment.content
             ):
@@ -522,6 +659,7 @@ class CirculationAPI(object):
                 # The book wasn't checked out in the first
                 # place. Everything's fine.
                 pass
+            self._invalidate_patron_activity(patron, licensepool)
         # Any other CannotReturn exception will be propagated upwards
         # at this point.
         return True
@@ -540,6 +678,7 @@ class CirculationAPI(object):
                 # The book wasn't on hold in the first place. Everything's
                 # fine.
                 pass
+            self._invalidate_patron_activity(patron, licensepool)
         # Any other CannotReleaseHold exception will be propagated
         # upwards at this point
         if hold:
@@ -561,74 +700,219 @@ class CirculationAPI(object):
         """Return a record of the patron's current activity
         vis-a-vis all data sources.
 
-        We check each data source in a separate thread for speed.
+        We check each data source in a separate worker thread for
+        speed. Each API's response is retrieved and parsed entirely
+        within its worker, so a full sync takes as long as the slowest
+        API rather than the sum of all of them. An API that doesn't
+        respond within PATRON_ACTIVITY_TIMEOUT seconds is treated as
+        though it had failed, but it's allowed to keep running in the
+        background, and its results will be applied to the database
+        once they come in.
 
-        :return: A 2-tuple (loans, holds) containing `HoldInfo` and
-        `LoanInfo` objects.
-        """
-        log = self.log
-        class PatronActivityThread(Thread):
-            def __init__(self, api, patron, pin):
-                self.api = api
-                self.patron = patron
-                self.pin = pin
-                self.activity = None
-                self.exception = None
-                super(PatronActivityThread, self).__init__()
-
-            def run(self):
-                before = time.time()
-                try:
-                    self.activity = self.api.patron_activity(
-                        self.patron, self.pin)
-                except Exception, e:
-                    self.exception = e
-                after = time.time()
-                log.debug(
-                    "Synced %s in %.2f sec", self.api.__class__.__name__,
-                    after-before
-                )
+        Each worker uses its own database session, so the request's
+        session is only ever used by the request thread.
 
-        threads = []
+        An API that recently told us about this patron's activity
+        isn't asked again; see PatronActivityCache.
+
+        :return: A 3-tuple (loans, holds, complete). `loans` and
+        `holds` contain `LoanInfo` and `HoldInfo` objects; `complete`
+        is False if any API failed to give us a full picture.
+        """
         before = time.time()
-        for api in self.apis:
-            thread = PatronActivityThread(api, patron, pin)
-            threads.append(thread)
-        for thread in threads:
-            thread.start()
-        for thread in threads:
-            thread.join()
+        deadline = before + self.patron_activity_timeout
         loans = []
         holds = []
         complete = True
-        for thread in threads:
-            if thread.exception:
+        jobs = []
+        # If the patron's activity is invalidated while we're fetching
+        # it, what we fetch won't be cached.
+        generation = self.patron_activity_cache.generation(patron.id)
+        for api in self.apis:
+            data_source_id = self.data_source_id_for_api.get(api)
+            activity = self.patron_activity_cache.get(
+                patron.id, data_source_id
+            )
+            if activity is not None:
+                self.log.debug(
+                    "Using cached activity from %s", api.__class__.__name__
+                )
+                api_loans, api_holds = self._loans_and_holds(activity)
+                loans.extend(api_loans)
+                holds.extend(api_holds)
+                continue
+            job = self.PATRON_ACTIVITY_POOL.submit(
+                self._patron_activity_for_api, api, patron.id, pin
+            )
+            jobs.append((api, job))
+
+        for api, job in jobs:
+            api_name = api.__class__.__name__
+            if not job.wait(max(deadline - time.time(), 0)):
+                # This API is taking too long. Stop waiting for it; we
+                # don't have a complete picture of the patron's loans.
+                complete = False
+                self.log.error(
+                    "%s did not respond within %.2f sec",
+                    api_name, self.patron_activity_timeout
+                )
+                job.add_done_callback(
+                    lambda job, api=api, patron_id=patron.id:
+                    self._schedule_late_patron_activity(
+                        api, patron_id, job, generation
+                    )
+                )
+                continue
+            self.log.debug("Synced %s in %.2f sec", api_name, job.elapsed)
+            if job.exception:
                 # Something went wrong, so we don't have a complete
                 # picture of the patron's loans.
                 complete = False
                 self.log.error(
-                    "%s errored out: %s", thread.api.__class__.__name__,
-                    thread.exception,
-                    exc_info=thread.exception
+                    "%s errored out: %s", api_name, job.exception,
+                    exc_info=job.exc_info
                 )
-            if thread.activity:
-                for i in thread.activity:
-                    l = None
-                    if isinstance(i, LoanInfo):
-                        l = loans
-                    elif isinstance(i, HoldInfo):
-                        l = holds
-                    else:
-                        self.log.warn(
-                            "value %r from patron_activity is neither a loan nor a hold.", 
-                            i
-                        )
-                    if l is not None:
-                        l.append(i)
+            else:
+                self.patron_activity_cache.put(
+                    patron.id, self.data_source_id_for_api.get(api),
+                    job.result, generation
+                )
+            api_loans, api_holds = self._loans_and_holds(job.result)
+            loans.extend(api_loans)
+            holds.extend(api_holds)
         after = time.time()
         self.log.debug("Full sync took %.2f sec", after-before)
         return loans, holds, complete
 
+    def _loans_and_holds(self, activity):
+        """Split one API's patron activity into loans and holds."""
+        loans = []
+        holds = []
+        for i in activity or []:
+            l = None
+            if isinstance(i, LoanInfo):
+                l = loans
+            elif isinstance(i, HoldInfo):
+                l = holds
+            else:
+                self.log.warn(
+                    "value %r from patron_activity is neither a loan nor a hold.", 
+                    i
+                )
+            if l is not None:
+                l.append(i)
+        return loans, holds
+
+    def _schedule_late_patron_activity(self, api, patron_id, job,
+                                       generation=None):
+        """Arrange for late results to be applied in a worker thread.
+
+        If the job finished just after we stopped waiting for it, this
+        is called in the request thread, which has no business doing
+        the work itself.
+        """
+        self.PATRON_ACTIVITY_POOL.submit(
+            self._apply_late_patron_activity, api, patron_id, job,
+            generation
+        )
+
+    def _apply_late_patron_activity(self, api, patron_id, job,
+                                    generation=None):
+        """Bring the database up to date with patron activity from an
+        API that responded after we stopped waiting for it.
+
+        This happens in a worker thread, long after the request that
+        started the sync is finished, so it uses its own database
+        session.
+
+        :param generation: The patron's PatronActivityCache generation
+        from before the API was called.
+        """
+        api_name = api.__class__.__name__
+        if job.exception:
+            self.log.error(
+                "%s errored out after the deadline: %s", api_name,
+                job.exception, exc_info=job.exc_info
+            )
+            return
+        self.log.info(
+            "%s responded after %.2f sec, applying its results now.",
+            api_name, job.elapsed
+        )
+        data_source_id = self.data_source_id_for_api.get(api)
+        self.patron_activity_cache.put(
+            patron_id, data_source_id, job.result, generation
+        )
+        loans, holds = self._loans_and_holds(job.result)
+
+        # Since this is one API's complete list of loans and holds, we
+        # can delete local loans and holds from this API that aren't
+        # on it.
+        if data_source_id:
+            data_source_ids = [data_source_id]
+        else:
+            data_source_ids = []
+
+        _db = self._worker_session()
+        circulation = copy.copy(self)
+        circulation._db = _db
+        try:
+            patron = get_one(_db, Patron, id=patron_id)
+            if patron:
+                # The patron may have borrowed or reserved a book
+                # while the API was working on its response.
+                fetched_at = datetime.datetime.utcfromtimestamp(
+                    job.started_at
+                )
+                circulation.apply_patron_activity(
+                    patron, loans, holds, complete=True,
+                    data_source_ids=data_source_ids, fetched_at=fetched_at
+                )
+                _db.commit()
+        except Exception, e:
+            _db.rollback()
+            self.log.error(
+                "Could not apply late results from %s: %s", api_name, e,
+                exc_info=e
+            )
+        finally:
+            if _db is not self._db:
+                _db.close()
+
+    def _worker_session(self):
+        """Create a database session for use outside the request thread."""
+        return Session(bind=self._db.get_bind())
+
+    def _patron_activity_for_api(self, api, patron_id, pin):
+        """Get a patron's activity from a single API, as a list.
+
+        This runs in a worker thread, possibly after the request that
+        asked for it is over, so it looks up the patron in a database
+        session of its own and gives the API a copy of itself that
+        uses that session. Anything the API changes (such as a
+        refreshed credential) is committed in that session.
+
+        Some APIs return a generator from patron_activity(). Running
+        the generator to completion here, rather than in the calling
+        thread, makes sure the HTTP requests happen in the worker.
+        """
+        _db = self._worker_session()
+        try:
+            api = copy.copy(api)
+            api._db = _db
+            patron = get_one(_db, Patron, id=patron_id)
+            activity = list(api.patron_activity(patron, pin))
+            if _db is not self._db:
+                _db.commit()
+            return activity
+        except Exception:
+            if _db is not self._db:
+                _db.rollback()
+            raise
+        finally:
+            if _db is not self._db:
+                _db.close()
+
     def local_loans(self, patron):
         return self._db.query(Loan).join(Loan.license_pool).filter(
             LicensePool.data_source_id.in_(self.data_source_ids_for_sync)
@@ -647,117 +931,225 @@ class CirculationAPI(object):
 
         # Get the external view of the patron's current state.
         remote_loans, remote_holds, complete = self.patron_activity(patron, pin)
+        return self.apply_patron_activity(
+            patron, remote_loans, remote_holds, complete
+        )
+
+    def apply_patron_activity(self, patron, remote_loans, remote_holds,
+                              complete, data_source_ids=None,
+                              fetched_at=None):
+        """Bring our view of a patron's loans and holds in line with
+        the remote view.
 
-        # Get our internal view of the patron's current state.
+        :param complete: If this is False, some API failed to tell us
+        about the patron's activity, so no local loans or holds will be
+        deleted.
+
+        :param data_source_ids: Only local loans and holds from these
+        data sources will be deleted. By default, every data source we
+        sync with is considered.
+
+        :param fetched_at: When we started asking for the remote view.
+        Local loans and holds that started after this time are never
+        deleted, since the remote couldn't have told us about them.
+
+        :return: A 2-tuple (active_loans, active_holds).
+        """
+        if data_source_ids is None:
+            data_source_ids = self.data_source_ids_for_sync
+
+        # Get our internal view of the patron's current state. Each
+        # local loan and hold is loaded along with its LicensePool and
+        # Identifier, so we don't need a query per item.
         __transaction = self._db.begin_nested()
-        local_loans = self.local_loans(patron)
-        local_holds = self.local_holds(patron)
+        local_loans = self.local_loans(patron).options(
+            joinedload(Loan.license_pool).joinedload(LicensePool.identifier)
+        )
+        local_holds = self.local_holds(patron).options(
+            joinedload(Hold.license_pool).joinedload(LicensePool.identifier)
+        )
 
         now = datetime.datetime.utcnow()
-        local_loans_by_identifier = {}
-        local_holds_by_identifier = {}
+        local_loans_by_pool_id = {}
+        local_holds_by_pool_id = {}
         for l in local_loans:
             if not l.license_pool:
                 self.log.error("Active loan with no license pool!")
                 continue
-            i = l.license_pool.identifier
-            if not i:
-                self.log.error(
-                    "Active loan on license pool %s, which has no identifier!",
-                    l.license_pool
-                )
-                continue
-            key = (i.type, i.identifier)
-            local_loans_by_identifier[key] = l
+            local_loans_by_pool_id[l.license_pool.id] = l
         for h in local_holds:
             if not h.license_pool:
                 self.log.error("Active hold with no license pool!")
                 continue
-            i = h.license_pool.identifier
-            if not i:
-                self.log.error(
-                    "Active hold on license pool %r, which has no identifier!",
-                    h.license_pool
-                )
-                continue
-            key = (i.type, i.identifier)
-            local_holds_by_identifier[key] = h
+            local_holds_by_pool_id[h.license_pool.id] = h
+
+        # Find the LicensePools for every remote loan and hold at once.
+        pools = self._license_pools_for(remote_loans + remote_holds)
 
+        # The remote may mention the same book twice, or mention two
+        # identifiers that turn out to belong to the same LicensePool.
+        # A patron can only have one loan or hold per LicensePool, so
+        # we keep track of the ones we've already dealt with.
         active_loans = []
         active_holds = []
+        active_loan_pool_ids = set()
+        active_hold_pool_ids = set()
         for loan in remote_loans:
             # This is a remote loan. Find or create the corresponding
             # local loan.
-            source_name = self.identifier_type_to_data_source_name[
-                loan.identifier_type
-            ]
-            source = DataSource.lookup(self._db, source_name)
-            key = (loan.identifier_type, loan.identifier)
-            pool, ignore = LicensePool.for_foreign_id(
-                self._db, source, loan.identifier_type,
-                loan.identifier)
-            start = loan.start_date or now
-            end = loan.end_date
-            local_loan, new = pool.loan_to(patron, start, end)
+            pool = pools[(loan.identifier_type, loan.identifier)]
+            if pool.id in active_loan_pool_ids:
+                continue
+            active_loan_pool_ids.add(pool.id)
+            local_loan = local_loans_by_pool_id.pop(pool.id, None)
+            if not local_loan:
+                # This is the equivalent of pool.loan_to(), but since
+                # we know the patron has no loan for this pool, there's
+                # no need to look for one first. The new loan will be
+                # inserted along with any others when the session is
+                # flushed.
+                local_loan = Loan(
+                    patron=patron, license_pool=pool,
+                    start=loan.start_date or now, end=loan.end_date
+                )
+                self._db.add(local_loan)
             active_loans.append(local_loan)
 
-            # Remove the local loan from the list so that we don't
-            # delete it later.
-            if key in local_loans_by_identifier:
-                del local_loans_by_identifier[key]
-
         for hold in remote_holds:
             # This is a remote hold. Find or create the corresponding
             # local hold.
-            key = (hold.identifier_type, hold.identifier)
-            source_name = self.identifier_type_to_data_source_name[
-                hold.identifier_type
-            ]
-            source = DataSource.lookup(self._db, source_name)
-            pool, ignore = LicensePool.for_foreign_id(
-                self._db, source, hold.identifier_type,
-                hold.identifier)
+            pool = pools[(hold.identifier_type, hold.identifier)]
+            if pool.id in active_hold_pool_ids:
+                continue
+            active_hold_pool_ids.add(pool.id)
             start = hold.start_date or now
             end = hold.end_date
             position = hold.hold_position
-            local_hold, new = pool.on_hold_to(patron, start, end, position)
+            local_hold = local_holds_by_pool_id.pop(pool.id, None)
+            if local_hold:
+                local_hold.update(start, end, position)
+            else:
+                # New holds are rare enough that it's worth going
+                # through on_hold_to(), which enforces the hold policy.
+                local_hold, new = pool.on_hold_to(
+                    patron, start, end, position
+                )
             active_holds.append(local_hold)
 
-            # Remove the local hold from the list so that we don't
-            # delete it later.
-            if key in local_holds_by_identifier:
-                del local_holds_by_identifier[key]
-
         # We only want to delete local loans and holds if we were able to
         # successfully sync with all the providers. If there was an error,
         # the provider might still know about a loan or hold that we don't
         # have in the remote lists.
         if complete:
-            # Every loan remaining in loans_by_identifier is a hold that
+            # Every loan remaining in local_loans_by_pool_id is a loan that
             # the provider doesn't know about. This usually means it's expired
             # and we should get rid of it, but it's possible the patron is
             # borrowing a book and syncing their bookshelf at the same time,
             # and the local loan was created after we got the remote loans.
             # If the loan's start date is less than a minute ago, we'll keep it.
-            for loan in local_loans_by_identifier.values():
-                if loan.license_pool.data_source.id in self.data_source_ids_for_sync:
-                    one_minute_ago = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
-                    if loan.start < one_minute_ago:
-                        logging.info("In sync_bookshelf for patron %s, deleting loan %d (patron %s)" % (patron.authorization_identifier, loan.id, loan.patron.authorization_identifier))
-                        self._db.delete(loan)
-                    else:
-                        logging.info("In sync_bookshelf for patron %s, found local loan %d created in the past minute that wasn't in remote loans" % (patron.authorization_identifier, loan.id))
-
-            # Every hold remaining in holds_by_identifier is a hold that
+            #
+            # The deletions are sent to the database as a batch when
+            # the session is flushed.
+            one_minute_ago = now - datetime.timedelta(minutes=1)
+            for loan in self._deletion_candidates(
+                    local_loans_by_pool_id, data_source_ids, fetched_at,
+                    "loan"):
+                if loan.start < one_minute_ago:
+                    logging.info("In sync_bookshelf for patron %s, deleting loan %d (patron %s)" % (patron.authorization_identifier, loan.id, loan.patron.authorization_identifier))
+                    self._db.delete(loan)
+                else:
+                    logging.info("In sync_bookshelf for patron %s, found local loan %d created in the past minute that wasn't in remote loans" % (patron.authorization_identifier, loan.id))
+
+            # Every hold remaining in local_holds_by_pool_id is a hold that
             # the provider doesn't know about, which means it's expired
             # and we should get rid of it.
-            for hold in local_holds_by_identifier.values():
-                if hold.license_pool.data_source.id in self.data_source_ids_for_sync:
-                    self._db.delete(hold)
+            for hold in self._deletion_candidates(
+                    local_holds_by_pool_id, data_source_ids, fetched_at,
+                    "hold"):
+                self._db.delete(hold)
 
         __transaction.commit()
         return active_loans, active_holds
 
+    def _deletion_candidates(self, by_pool_id, data_source_ids, fetched_at,
+                             noun):
+        """Find the local loans or holds that may be deleted because
+        the remote doesn't know about them.
+
+        Loans and holds whose LicensePool has no Identifier are left
+        alone, since we can't be sure the remote didn't mention them.
+        So are loans and holds that started after `fetched_at`.
+        """
+        for item in by_pool_id.values():
+            if fetched_at and item.start and item.start >= fetched_at:
+                continue
+            pool = item.license_pool
+            if not pool.identifier:
+                self.log.error(
+                    "Active %s on license pool %r, which has no identifier!",
+                    noun, pool
+                )
+                continue
+            if pool.data_source_id in data_source_ids:
+                yield item
+
+    def _license_pools_for(self, activity):
+        """Find or create the LicensePool for every LoanInfo or HoldInfo
+        in `activity`, using a single query for all the pools that
+        already exist.
+
+        :return: A dictionary mapping (identifier_type, identifier) to
+        LicensePool.
+        """
+        sources = {}
+        sources_by_name = {}
+        for item in activity:
+            key = (item.identifier_type, item.identifier)
+            if key in sources:
+                continue
+            source_name = self.identifier_type_to_data_source_name[
+                item.identifier_type
+            ]
+            if source_name not in sources_by_name:
+                sources_by_name[source_name] = DataSource.lookup(
+                    self._db, source_name
+                )
+            sources[key] = sources_by_name[source_name]
+
+        pools = {}
+        if sources:
+            clauses = [
+                and_(Identifier.type==type, Identifier.identifier==identifier)
+                for type, identifier in sources
+            ]
+            data_source_ids = set(x.id for x in sources.values())
+            qu = self._db.query(LicensePool).join(
+                LicensePool.identifier
+            ).options(
+                contains_eager(LicensePool.identifier)
+            ).filter(
+                LicensePool.data_source_id.in_(data_source_ids)
+            ).filter(
+                or_(*clauses)
+            )
+            for pool in qu:
+                key = (pool.identifier.type, pool.identifier.identifier)
+                if key in sources and sources[key].id == pool.data_source_id:
+                    pools[key] = pool
+
+        # Anything we didn't find needs to be created, or has an
+        # identifier that needs normalizing; for_foreign_id handles
+        # both cases.
+        for key, source in sources.items():
+            if key in pools:
+                continue
+            type, identifier = key
+            pool, ignore = LicensePool.for_foreign_id(
+                self._db, source, type, identifier
+            )
+            pools[key] = pool
+        return pools
+
 
 class BaseCirculationAPI(object):
     """Encapsulates logic common to all circulation APIs."""
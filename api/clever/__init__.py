@@ -22,7 +22,7 @@ from core.model import (
     DataSource,
     Patron,
 )
-from core.util.http import HTTP
+from api.util.http_client import PooledHTTPClient
 from api.problem_details import *
 
 
@@ -210,13 +210,17 @@ class CleverAuthenticationAPI(OAuthAuthenticationProvider):
         )
         return patrondata
    
+    @property
+    def http_client(self):
+        return PooledHTTPClient.for_integration(self.NAME)
+
     def _get_token(self, payload, headers):
-        response = HTTP.post_with_timeout(
+        response = self.http_client.post(
             self.CLEVER_TOKEN_URL, json.dumps(payload), headers=headers
         )
         return response.json()
 
     def _get(self, url, headers):
-        return HTTP.get_with_timeout(url, headers=headers).json()
+        return self.http_client.get(url, headers=headers).json()
 
 AuthenticationProvider = CleverAuthenticationAPI
@@ -30,6 +30,23 @@ class Configuration(CoreConfiguration):
 
     PRELOADED_CONTENT = "preloaded_content"
 
+    # How long, in seconds, to wait for a distributor to tell us about
+    # a patron's loans and holds before giving up on it.
+    PATRON_ACTIVITY_TIMEOUT = "patron_activity_timeout"
+
+    # What a distributor tells us about a patron's loans and holds is
+    # cached in memory for this many seconds.
+    PATRON_ACTIVITY_CACHE_TTL = "patron_activity_cache_ttl"
+    DEFAULT_PATRON_ACTIVITY_CACHE_TTL = 30
+
+    # Cache activity for at most this many (patron, distributor) pairs.
+    PATRON_ACTIVITY_CACHE_SIZE = "patron_activity_cache_size"
+    DEFAULT_PATRON_ACTIVITY_CACHE_SIZE = 10000
+
+    # Compressed copies of OPDS feeds are stored in this directory, so
+    # they can be shared between processes.
+    COMPRESSED_FEED_DIRECTORY = "compressed_feed_directory"
+
     ADOBE_VENDOR_ID_INTEGRATION = "Adobe Vendor ID"
     ADOBE_VENDOR_ID = "vendor_id"
     ADOBE_VENDOR_ID_NODE_VALUE = "node_value"
@@ -121,6 +138,31 @@ class Configuration(CoreConfiguration):
         )
         return MoneyUtility.parse(max_fines)
     
+    @classmethod
+    def patron_activity_timeout(cls):
+        value = cls.policy(cls.PATRON_ACTIVITY_TIMEOUT)
+        if value is None:
+            return None
+        return float(value)
+
+    @classmethod
+    def patron_activity_cache_ttl(cls):
+        return float(cls.policy(
+            cls.PATRON_ACTIVITY_CACHE_TTL,
+            default=cls.DEFAULT_PATRON_ACTIVITY_CACHE_TTL
+        ))
+
+    @classmethod
+    def patron_activity_cache_size(cls):
+        return int(cls.policy(
+            cls.PATRON_ACTIVITY_CACHE_SIZE,
+            default=cls.DEFAULT_PATRON_ACTIVITY_CACHE_SIZE
+        ))
+
+    @classmethod
+    def compressed_feed_directory(cls):
+        return cls.policy(cls.COMPRESSED_FEED_DIRECTORY)
+
     @classmethod
     def load(cls):
         CoreConfiguration.load()
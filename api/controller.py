@@ -1,4 +1,5 @@
 from nose.tools import set_trace
+import hashlib
 import json
 import logging
 import sys
@@ -17,6 +18,7 @@ from flask import (
     redirect,
 )
 from flask.ext.babel import lazy_gettext as _
+from werkzeug.http import is_resource_modified
 
 from core.app_server import (
     entry_response,
@@ -72,6 +74,7 @@ from core.util.flask_util import (
 )
 from core.util.problem_detail import ProblemDetail
 from core.util.http import (
+    HTTP,
     RemoteIntegrationException,
 )
 
@@ -120,10 +123,91 @@ from novelist import (
     MockNoveListAPI,
 )
 from base_controller import BaseCirculationManagerController
+from feed_compression import CompressedFeedCache
 from testing import MockCirculationAPI
 from services import ServiceStatus
 from core.analytics import Analytics
 
+
+def streaming_feed_response(feed, **kwargs):
+    """Send a StreamingFeed to the client as it's generated.
+
+    :param kwargs: Passed on to feed_response, which determines the
+    response headers.
+    """
+    headers = feed_response("", **kwargs).headers
+    headers = dict(
+        (k, v) for k, v in headers.items() if k.lower() != 'content-length'
+    )
+    return Response(flask.stream_with_context(iter(feed)), 200, headers)
+
+
+def client_has_current_copy(etag=None, last_modified=None):
+    """Check the request's If-None-Match and If-Modified-Since headers
+    against a cheap version stamp for a resource, so that a resource
+    the client already has doesn't have to be built.
+
+    :param etag: The ETag the resource would be served with.
+    :param last_modified: The datetime the resource last changed.
+    """
+    if not etag and not last_modified:
+        return False
+    return not is_resource_modified(
+        flask.request.environ, etag=etag, last_modified=last_modified
+    )
+
+
+def not_modified_response(etag, **kwargs):
+    """A 304 response telling the client its copy of a feed is current.
+
+    :param kwargs: Passed on to feed_response, so that the 304
+    response has the same caching headers as the feed would have.
+    """
+    headers = {'ETag': etag}
+    for k, v in feed_response("", **kwargs).headers.items():
+        if k.lower() in ('cache-control', 'expires'):
+            headers[k] = v
+    return Response(status=304, headers=headers)
+
+
+def conditional_feed_response(content, etag=None, compressed_feeds=None,
+                              **kwargs):
+    """Like feed_response, but with a strong ETag, and a 304 response
+    if the client already has this version of the feed.
+
+    :param etag: The quoted ETag to use. By default, it's derived from
+    the content of the feed.
+    :param compressed_feeds: A CompressedFeedCache. If this is
+    provided, the feed is sent compressed to clients that accept it.
+    :param kwargs: Passed on to feed_response.
+    """
+    if isinstance(content, unicode):
+        content = content.encode("utf8")
+    if etag is None:
+        etag = '"%s"' % hashlib.md5(content).hexdigest()
+
+    encoding = None
+    if compressed_feeds:
+        encoding = compressed_feeds.negotiate(flask.request)
+    if encoding:
+        # A compressed representation is a different sequence of
+        # bytes, so it needs a different strong ETag.
+        etag = '%s-%s"' % (etag[:-1], encoding)
+    headers = {'ETag': etag}
+    if compressed_feeds:
+        headers['Vary'] = 'Accept-Encoding'
+    if client_has_current_copy(etag=etag):
+        response = not_modified_response(etag, **kwargs)
+    else:
+        if encoding:
+            content = compressed_feeds.get(content, encoding)
+            headers['Content-Encoding'] = encoding
+        response = feed_response(content, **kwargs)
+    for k, v in headers.items():
+        response.headers[k] = v
+    return response
+
+
 class CirculationManager(object):
 
     def __init__(self, _db, lanes=None, testing=False):
@@ -152,6 +236,10 @@ class CirculationManager(object):
             Configuration.policy('lending', {})
         )
 
+        self.compressed_feeds = CompressedFeedCache(
+            Configuration.compressed_feed_directory()
+        )
+
         self.setup_controllers()
         self.setup_adobe_vendor_id()
 
@@ -220,7 +308,10 @@ class CirculationManager(object):
                 _db=self._db, 
                 threem=threem, 
                 overdrive=overdrive,
-                axis=axis
+                axis=axis,
+                patron_activity_timeout=Configuration.patron_activity_timeout(),
+                patron_activity_cache_ttl=Configuration.patron_activity_cache_ttl(),
+                patron_activity_cache_size=Configuration.patron_activity_cache_size(),
             )
 
     def setup_controllers(self):
@@ -423,7 +514,9 @@ class OPDSFeedController(CirculationManagerController):
 
         annotator = self.manager.annotator(lane)
         feed = AcquisitionFeed.groups(self._db, title, url, lane, annotator)
-        return feed_response(feed.content)
+        return conditional_feed_response(
+            feed.content, compressed_feeds=self.manager.compressed_feeds
+        )
 
     def feed(self, languages, lane_name):
         """Build or retrieve a paginated acquisition feed."""
@@ -449,7 +542,9 @@ class OPDSFeedController(CirculationManagerController):
             facets=facets,
             pagination=pagination,
         )
-        return feed_response(feed.content)
+        return conditional_feed_response(
+            feed.content, compressed_feeds=self.manager.compressed_feeds
+        )
 
     def search(self, languages, lane_name):
 
@@ -477,21 +572,78 @@ class OPDSFeedController(CirculationManagerController):
             url=this_url, lane=lane, search_engine=self.manager.external_search,
             query=query, annotator=annotator, pagination=pagination,
         )
-        return feed_response(opds_feed)
+        return conditional_feed_response(
+            opds_feed, compressed_feeds=self.manager.compressed_feeds
+        )
 
     def preload(self):
         this_url = url_for("preload", _external=True)
 
         annotator = self.manager.annotator(None)
-        opds_feed = PreloadFeed.page(
-            self._db, "Content to Preload", this_url,
-            annotator=annotator,
+
+        # Every new installation of the app asks for this feed, but it
+        # rarely changes, so it's only rendered when it has to be.
+        content, etag = PreloadFeed.cached_page(
+            self._db, "Content to Preload", this_url, annotator=annotator
+        )
+        return conditional_feed_response(
+            content, etag='"%s"' % etag,
+            compressed_feeds=self.manager.compressed_feeds
         )
-        return feed_response(opds_feed)
 
 
 class LoanController(CirculationManagerController):
 
+    # When we proxy a book from a remote server, it's sent on to the
+    # client in chunks of this size, rather than being read into
+    # memory all at once.
+    PROXY_CHUNK_SIZE = 64 * 1024
+
+    # These headers from the remote server are passed on to the client
+    # when we proxy a book. Hop-by-hop headers like Transfer-Encoding
+    # must not be passed on.
+    PROXIED_RESPONSE_HEADERS = [
+        'accept-ranges',
+        'content-encoding',
+        'content-length',
+        'content-range',
+        'content-type',
+        'etag',
+        'last-modified',
+    ]
+
+    # These headers from the client are passed on to the remote server.
+    PROXIED_REQUEST_HEADERS = ['Range', 'If-Range']
+
+    @classmethod
+    def stream_http_get(cls, url, headers, **kwargs):
+        """Make an HTTP GET request without reading the response into
+        memory.
+
+        :return: A 3-tuple (status_code, headers, content), like
+        Representation.simple_http_get, except that `content` is an
+        iterator over chunks of the raw response body.
+        """
+        response = HTTP.get_with_timeout(
+            url, headers=headers, stream=True, **kwargs
+        )
+        proxied_headers = dict(
+            (k, v) for k, v in response.headers.items()
+            if k.lower() in cls.PROXIED_RESPONSE_HEADERS
+        )
+
+        def content():
+            try:
+                # The body is passed on exactly as we got it, so that
+                # Content-Encoding and Content-Length stay accurate.
+                for chunk in response.raw.stream(
+                        cls.PROXY_CHUNK_SIZE, decode_content=False
+                ):
+                    yield chunk
+            finally:
+                response.close()
+        return response.status_code, proxied_headers, content()
+
     def sync(self):
         if flask.request.method=='HEAD':
             return Response()
@@ -510,10 +662,20 @@ class LoanController(CirculationManagerController):
                 # display the current active loans, as we understand them.
                 self.manager.log.error("ERROR DURING SYNC: %r", e, exc_info=e)
 
+        # If the client already has an up-to-date copy of the feed,
+        # there's no need to make it.
+        etag = CirculationManagerLoanAndHoldAnnotator.active_loans_etag(
+            self.circulation, patron
+        )
+        if client_has_current_copy(etag=etag):
+            return not_modified_response(etag, cache_for=None)
+
         # Then make the feed.
         feed = CirculationManagerLoanAndHoldAnnotator.active_loans_for(
-            self.circulation, patron)
-        return feed_response(feed, cache_for=None)
+            self.circulation, patron, stream=True)
+        response = streaming_feed_response(feed, cache_for=None)
+        response.headers['ETag'] = etag
+        return response
 
     def borrow(self, data_source, identifier_type, identifier, mechanism_id=None):
         """Create a new loan or hold for a book.
@@ -628,7 +790,7 @@ class LoanController(CirculationManagerController):
         serve an OPDS entry with a link to a third-party web page that
         streams the content.
         """
-        do_get = do_get or Representation.simple_http_get
+        do_get = do_get or self.stream_http_get
 
         patron = flask.request.patron
         header = self.authorization_header()
@@ -697,8 +859,20 @@ class LoanController(CirculationManagerController):
                 # If we have a link to the content on a remote server, web clients may not
                 # be able to access it if the remote server does not support CORS requests.
                 # We need to fetch the content and return it instead of redirecting to it.
+                #
+                # The content is streamed through to the client, so
+                # that large books (especially audiobooks) don't need to
+                # fit in memory. The client's Range header is passed
+                # along, so that it can resume an interrupted download.
+                request_headers = dict(
+                    (k, flask.request.headers[k])
+                    for k in self.PROXIED_REQUEST_HEADERS
+                    if k in flask.request.headers
+                )
                 try:
-                    status_code, headers, content = do_get(fulfillment.content_link, headers={})
+                    status_code, headers, content = do_get(
+                        fulfillment.content_link, headers=request_headers
+                    )
                     headers = dict(headers)
                 except RemoteIntegrationException, e:
                     return e.as_problem_detail_document(debug=False)
@@ -807,13 +981,21 @@ class AnnotationController(CirculationManagerController):
                                '<http://www.w3.org/TR/annotation-protocol/>; rel="http://www.w3.org/ns/ldp#constrainedBy"']
             headers['Content-Type'] = AnnotationWriter.CONTENT_TYPE
 
-            container, timestamp = AnnotationWriter.annotation_container_for(patron, identifier=identifier)
+            # The container only changes when an annotation is created,
+            # changed or deleted, so we can tell whether the client's
+            # copy is current without building it.
+            timestamp = AnnotationWriter.latest_timestamp_for(
+                patron, identifier=identifier
+            )
             etag = 'W/""'
             if timestamp:
                 etag = 'W/"%s"' % timestamp
                 headers['Last-Modified'] = format_date_time(mktime(timestamp.timetuple()))
             headers['ETag'] = etag
+            if client_has_current_copy(etag=etag, last_modified=timestamp):
+                return Response(status=304, headers=headers)
 
+            container, ignore = AnnotationWriter.annotation_container_for(patron, identifier=identifier)
             content = json.dumps(container)
             return Response(content, status=200, headers=headers)
 
@@ -899,7 +1081,10 @@ class WorkController(CirculationManagerController):
             facets=facets, pagination=pagination,
             annotator=annotator, cache_type=CachedFeed.CONTRIBUTOR_TYPE
         )
-        return feed_response(unicode(feed.content))
+        return conditional_feed_response(
+            unicode(feed.content),
+            compressed_feeds=self.manager.compressed_feeds
+        )
 
     def permalink(self, data_source, identifier_type, identifier):
         """Serve an entry for a single book.
@@ -956,7 +1141,10 @@ class WorkController(CirculationManagerController):
             facets=facets, pagination=pagination,
             annotator=annotator, cache_type=CachedFeed.RECOMMENDATIONS_TYPE
         )
-        return feed_response(unicode(feed.content))
+        return conditional_feed_response(
+            unicode(feed.content),
+            compressed_feeds=self.manager.compressed_feeds
+        )
 
     def related(self, data_source, identifier_type, identifier,
                 novelist_api=None):
@@ -993,7 +1181,10 @@ class WorkController(CirculationManagerController):
         feed = AcquisitionFeed.groups(
             self._db, lane.DISPLAY_NAME, url, lane, annotator=annotator
         )
-        return feed_response(unicode(feed.content))
+        return conditional_feed_response(
+            unicode(feed.content),
+            compressed_feeds=self.manager.compressed_feeds
+        )
 
     def report(self, data_source, identifier_type, identifier):
         """Report a problem with a book."""
@@ -1050,7 +1241,10 @@ class WorkController(CirculationManagerController):
             facets=facets, pagination=pagination,
             annotator=annotator, cache_type=CachedFeed.SERIES_TYPE
         )
-        return feed_response(unicode(feed.content))
+        return conditional_feed_response(
+            unicode(feed.content),
+            compressed_feeds=self.manager.compressed_feeds
+        )
 
 
 class ProfileController(CirculationManagerController):
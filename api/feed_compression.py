@@ -0,0 +1,188 @@
+from nose.tools import set_trace
+from cStringIO import StringIO
+import gzip
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from threading import Lock
+
+# Brotli support is optional. Without it, feeds are only offered
+# gzipped.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from util.lru import ExpiringLRUCache
+
+
+class CompressedFeedCache(object):
+    """Keep compressed copies of OPDS feeds, so that each version of a
+    feed is compressed once, rather than once per request.
+
+    Compressed copies are identified by a hash of the uncompressed
+    feed, so the scripts that regenerate feeds and the web application
+    can find the same copy without agreeing on anything else. If a
+    directory is provided, compressed copies are also stored there, so
+    that a feed compressed by a script is available to every web
+    application process.
+    """
+
+    GZIP = "gzip"
+    BROTLI = "br"
+
+    # If the client will take more than one encoding, the one that
+    # shows up first here wins.
+    if brotli:
+        ENCODINGS = [BROTLI, GZIP]
+    else:
+        ENCODINGS = [GZIP]
+
+    # A file in the directory that hasn't been rewritten in this many
+    # seconds belongs to a feed that has since been replaced, and is
+    # deleted.
+    MAX_AGE = 24 * 60 * 60
+
+    # Look for old files to delete at most this often.
+    PRUNE_INTERVAL = 60 * 60
+
+    def __init__(self, directory=None, max_size=1000, max_age=None):
+        """Constructor.
+
+        :param directory: Store compressed feeds in this directory as
+        well as in memory.
+        :param max_size: Keep at most this many compressed feeds in
+        memory, discarding the least recently used.
+        :param max_age: Delete files in `directory` that haven't been
+        rewritten in this many seconds.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        if max_age is None:
+            max_age = self.MAX_AGE
+        self.max_age = max_age
+        self._last_pruned = None
+        self._entries = ExpiringLRUCache(max_size)
+        self._lock = Lock()
+        self.log = logging.getLogger("Compressed feed cache")
+
+    @classmethod
+    def key(cls, content):
+        """The key under which compressed copies of `content` are stored.
+
+        This is the same hash used to build the feed's ETag.
+        """
+        return hashlib.md5(content).hexdigest()
+
+    @classmethod
+    def compress(cls, content, encoding):
+        if encoding == cls.BROTLI:
+            return brotli.compress(content)
+        if encoding == cls.GZIP:
+            out = StringIO()
+            # Leave the timestamp out of the header, so the same feed
+            # always compresses to the same bytes.
+            f = gzip.GzipFile(fileobj=out, mode="wb", mtime=0)
+            f.write(content)
+            f.close()
+            return out.getvalue()
+        raise ValueError("Unsupported encoding: %s" % encoding)
+
+    def negotiate(self, request):
+        """Choose the encoding to use for a response to `request`.
+
+        :return: One of ENCODINGS, or None if the feed should be sent
+        uncompressed.
+        """
+        return request.accept_encodings.best_match(self.ENCODINGS)
+
+    def store(self, content):
+        """Compress a newly generated feed in every supported encoding."""
+        if isinstance(content, unicode):
+            content = content.encode("utf8")
+        key = self.key(content)
+        for encoding in self.ENCODINGS:
+            compressed = self.compress(content, encoding)
+            self._put(key, encoding, compressed)
+            self._write(key, encoding, compressed)
+        self.prune()
+
+    def get(self, content, encoding):
+        """Find a compressed copy of `content`, compressing it now if
+        necessary.
+        """
+        if isinstance(content, unicode):
+            content = content.encode("utf8")
+        key = self.key(content)
+        compressed = self._get(key, encoding)
+        if compressed is None:
+            compressed = self._read(key, encoding)
+            if compressed is None:
+                compressed = self.compress(content, encoding)
+            self._put(key, encoding, compressed)
+        return compressed
+
+    def _get(self, key, encoding):
+        return self._entries.get((key, encoding))
+
+    def _put(self, key, encoding, compressed):
+        self._entries.put((key, encoding), compressed)
+
+    def _path(self, key, encoding):
+        return os.path.join(self.directory, "%s.%s" % (key, encoding))
+
+    def _read(self, key, encoding):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key, encoding), "rb") as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _write(self, key, encoding, compressed):
+        if not self.directory:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Write to a temporary file and move it into place, so a
+            # reader never sees a partly written file.
+            fd, temp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, "wb") as f:
+                f.write(compressed)
+            os.rename(temp_path, self._path(key, encoding))
+        except (IOError, OSError), e:
+            self.log.error(
+                "Could not store compressed feed %s: %s", key, e, exc_info=e
+            )
+
+    def prune(self, now=None):
+        """Delete files that haven't been rewritten in `max_age` seconds.
+
+        A feed that's still current is rewritten every time it's
+        regenerated, so an old file belongs to a version of a feed
+        that's been replaced.
+        """
+        if not self.directory:
+            return
+        now = now or time.time()
+        with self._lock:
+            if (self._last_pruned is not None
+                and now - self._last_pruned < self.PRUNE_INTERVAL):
+                return
+            self._last_pruned = now
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return
+        for filename in filenames:
+            path = os.path.join(self.directory, filename)
+            try:
+                if now - os.path.getmtime(path) > self.max_age:
+                    os.remove(path)
+            except OSError:
+                # Another process got to it first.
+                pass
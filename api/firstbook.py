@@ -17,6 +17,8 @@ from core.model import (
     get_one_or_create,
     Patron,
 )
+from core.util.http import RemoteIntegrationException
+from util.http_client import PooledHTTPClient
 
 class FirstBookAuthenticationAPI(BasicAuthenticationProvider):
 
@@ -49,6 +51,7 @@ class FirstBookAuthenticationAPI(BasicAuthenticationProvider):
         else:
             url += '?'
         self.root = url + 'key=' + key
+        self.http_client = PooledHTTPClient.for_integration(self.NAME)
 
     # Begin implementation of BasicAuthenticationProvider abstract
     # methods.
@@ -77,9 +80,10 @@ class FirstBookAuthenticationAPI(BasicAuthenticationProvider):
         ))
         try:
             response = self.request(url)
-        except requests.exceptions.ConnectionError, e:
+        except (requests.exceptions.ConnectionError,
+                RemoteIntegrationException), e:
             raise RemoteInitiatedServerError(
-                str(e.message),
+                str(e),
                 self.NAME
             )
         if response.status_code != 200:
@@ -96,7 +100,7 @@ class FirstBookAuthenticationAPI(BasicAuthenticationProvider):
 
         Defined solely so it can be overridden in the mock.
         """
-        return requests.get(url)
+        return self.http_client.request("GET", url)
 
 
 class MockFirstBookResponse(object):
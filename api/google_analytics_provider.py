@@ -1,20 +1,61 @@
 from config import Configuration
+import atexit
+import errno
+import logging
+import os
 import uuid
 import urllib
 import re
+import time
+from collections import (
+    Counter,
+    deque,
+)
+from Queue import (
+    Queue,
+    Empty,
+    Full,
+)
+from threading import (
+    Lock,
+    Thread,
+)
 from core.util.http import HTTP
 
 class GoogleAnalyticsProvider(object):
     INTEGRATION_NAME = "Google Analytics"
-    
+
+    COLLECT_URL = "http://www.google-analytics.com/collect"
+    BATCH_URL = "http://www.google-analytics.com/batch"
+
+    # Keys in the integration configuration that control background
+    # dispatch.
+    ASYNCHRONOUS = "asynchronous"
+    QUEUE_SIZE = "queue_size"
+    SPOOL_DIRECTORY = "spool_directory"
+
     @classmethod
     def from_config(cls, config):
-        tracking_id = config[Configuration.INTEGRATIONS][cls.INTEGRATION_NAME]['tracking_id']
-        return cls(tracking_id)
+        integration = config[Configuration.INTEGRATIONS][cls.INTEGRATION_NAME]
+        tracking_id = integration['tracking_id']
+        provider = cls(tracking_id)
+        if integration.get(cls.ASYNCHRONOUS, True):
+            provider.dispatcher = GoogleAnalyticsDispatcher(
+                provider.post,
+                queue_size=integration.get(
+                    cls.QUEUE_SIZE, GoogleAnalyticsDispatcher.QUEUE_SIZE
+                ),
+                spool_directory=integration.get(cls.SPOOL_DIRECTORY),
+            )
+        return provider
 
-    def __init__(self, tracking_id):
+    def __init__(self, tracking_id, dispatcher=None):
         self.tracking_id = tracking_id
 
+        # If there's a dispatcher, hits are handed off to it, to be
+        # sent in the background. Otherwise they're sent immediately.
+        self.dispatcher = dispatcher
+
     def collect_event(self, _db, license_pool, event_type, time, **kwargs):
         client_id = uuid.uuid4()
         fields = {
@@ -52,10 +93,415 @@ class GoogleAnalyticsProvider(object):
         # urlencode doesn't like unicode strings so we convert them to utf8
         fields = {k: unicode(v).encode('utf8') for k, v in fields.iteritems()}
         params = re.sub(r"=None(&?)", r"=\1", urllib.urlencode(fields))
-        self.post("http://www.google-analytics.com/collect", params)
+        if self.dispatcher:
+            self.dispatcher.add(params)
+        else:
+            self.post(self.COLLECT_URL, params)
 
     def post(self, url, params):
         response = HTTP.post_with_timeout(url, params)
 
-        
+
+class GoogleAnalyticsDispatcher(object):
+    """Send hits to Google Analytics from a background thread, so that
+    the code that generated an event never waits on the HTTP request.
+
+    Hits are sent in batches through the Measurement Protocol's batch
+    endpoint. If a spool directory is configured, the background
+    thread writes each hit it's about to send to a spool segment, and
+    records in that segment when the hit has been dealt with. A
+    segment is deleted once every hit in it has been dealt with, and
+    hits left behind in the segments of a process that died are sent
+    by a later process.
+    """
+
+    # These limits are imposed by the batch endpoint.
+    MAX_BATCH_SIZE = 20
+    MAX_BATCH_BYTES = 16 * 1024
+
+    # By default, this many hits can be waiting to be sent. Past that
+    # point new hits are dropped rather than holding up the caller.
+    QUEUE_SIZE = 1000
+
+    # A batch is tried this many times before it's given up on.
+    MAX_ATTEMPTS = 3
+
+    # Wait this many seconds (times the number of failed attempts)
+    # before retrying a batch.
+    RETRY_DELAY = 5
+
+    # When the process exits, wait at most this many seconds for
+    # queued hits to be sent.
+    SHUTDOWN_TIMEOUT = 10
+
+    # Put on the queue to tell the background thread to send what it
+    # has and stop.
+    _STOP = object()
+
+    # Start a new spool segment after writing this many hits to one.
+    SEGMENT_SIZE = 1000
+
+    # A line in a spool segment that starts with this is not a hit; it
+    # records how many of the segment's hits have been dealt with.
+    # Hits are urlencoded, so they never start with it.
+    ACKNOWLEDGED = "#"
+
+    def __init__(self, post, queue_size=QUEUE_SIZE, spool_directory=None):
+        """Constructor.
+
+        :param post: A callable that takes a URL and a request body and
+        makes an HTTP POST request.
+        :param queue_size: Hold at most this many unsent hits.
+        :param spool_directory: Write unsent hits to files in this
+        directory.
+        """
+        self.post = post
+        self.queue = Queue(queue_size)
+        self.spool_directory = spool_directory
+        self.lock = Lock()
+        self.thread = None
+        self.log = logging.getLogger("Google Analytics dispatcher")
+        self._pid = None
+        self._shutdown_registered = False
+        self._reset()
+
+    def _reset(self):
+        """Forget about hits taken off the queue by some other process.
+
+        Everything set here is only used by the background thread.
+        """
+        # (hit, spool segment) 2-tuples that have been taken off the
+        # queue but not yet sent, in the order they'll be sent.
+        self._pending = deque()
+
+        # The spool segment new hits are written to.
+        self._segment = None
+        self._segment_path = None
+        self._segment_number = 0
+        self._segment_hits = 0
+
+        # The number of hits in each spool segment that haven't been
+        # dealt with yet.
+        self._unacknowledged = {}
+
+        # Set once the background thread has been told to stop.
+        self._stopping = False
+
+    def add(self, hit):
+        """Queue a hit to be sent in the background.
+
+        :param hit: The urlencoded parameters for a single hit.
+        :return: True if the hit was queued, False if the queue was
+        full and the hit was dropped.
+        """
+        self._ensure_sender()
+        try:
+            self.queue.put_nowait(hit)
+        except Full:
+            self.log.error(
+                "Analytics queue is full, dropping hit: %s", hit
+            )
+            return False
+        return True
+
+    def send_pending(self):
+        """Send every hit that's currently queued.
+
+        :return: The number of hits sent.
+        """
+        sent = 0
+        while True:
+            batch = self._next_batch(block=False)
+            if not batch:
+                return sent
+            self._send_and_acknowledge(batch)
+            sent += len(batch)
+
+    def send(self, batch):
+        """Send a batch of hits to Google Analytics, retrying on failure.
+
+        :return: True if the batch was sent, False if we gave up.
+        """
+        if len(batch) == 1:
+            url = GoogleAnalyticsProvider.COLLECT_URL
+        else:
+            url = GoogleAnalyticsProvider.BATCH_URL
+        body = "\n".join(batch)
+        for attempt in range(1, self.MAX_ATTEMPTS+1):
+            try:
+                self.post(url, body)
+                return True
+            except Exception, e:
+                self.log.warn(
+                    "Could not send %d hit(s) to Google Analytics (attempt %d): %s",
+                    len(batch), attempt, e, exc_info=e
+                )
+                if attempt < self.MAX_ATTEMPTS:
+                    time.sleep(self.RETRY_DELAY * attempt)
+        self.log.error(
+            "Giving up on %d hit(s) to Google Analytics.", len(batch)
+        )
+        return False
+
+    def _send_and_acknowledge(self, batch):
+        """Send a batch taken from _next_batch, then record in the
+        spool that its hits have been dealt with, whether or not they
+        were sent.
+        """
+        try:
+            return self.send([hit for hit, segment in batch])
+        finally:
+            self._acknowledge(batch)
+
+    def _next_batch(self, block=True):
+        """Take as many pending hits as will fit in one batch request.
+
+        :return: A list of (hit, spool segment) 2-tuples.
+        """
+        self._take_from_queue(block)
+        batch = []
+        size = 0
+        while self._pending and len(batch) < self.MAX_BATCH_SIZE:
+            hit, segment = self._pending[0]
+            if batch and size + len(hit) + 1 > self.MAX_BATCH_BYTES:
+                # This hit will have to wait for the next batch.
+                break
+            batch.append(self._pending.popleft())
+            size += len(hit) + 1
+        return batch
+
+    def _take_from_queue(self, block):
+        """Move hits from the queue to the list of pending hits,
+        spooling them on the way.
+
+        At most queue.maxsize hits are kept pending, so that while
+        Google Analytics is down the queue fills up and new hits are
+        dropped, rather than piling up in memory.
+        """
+        limit = self.queue.maxsize
+        if block and not self._pending:
+            self._receive(self.queue.get())
+        while limit <= 0 or len(self._pending) < limit:
+            try:
+                hit = self.queue.get_nowait()
+            except Empty:
+                break
+            self._receive(hit)
+
+    def _receive(self, hit):
+        if hit is self._STOP:
+            self._stopping = True
+        else:
+            self._pend(hit)
+
+    def _pend(self, hit):
+        self._pending.append((hit, self._write_to_spool(hit)))
+
+    def _run(self):
+        try:
+            self._recover_spool()
+        except Exception, e:
+            self.log.error("Error recovering analytics: %s", e, exc_info=e)
+        while True:
+            try:
+                batch = self._next_batch(block=not self._stopping)
+                if batch:
+                    self._send_and_acknowledge(batch)
+                elif self._stopping:
+                    return
+            except Exception, e:
+                self.log.error("Error sending analytics: %s", e, exc_info=e)
+
+    def shutdown(self, timeout=None):
+        """Send every hit that's been queued, and stop the background
+        thread.
+
+        This is called when the process exits, so that hits from a
+        script that exits right after collecting them aren't lost.
+
+        :param timeout: Wait at most this many seconds. Hits that
+        haven't been sent by then are lost, unless they're in the
+        spool.
+        """
+        if timeout is None:
+            timeout = self.SHUTDOWN_TIMEOUT
+        thread = self.thread
+        if not thread or not thread.is_alive():
+            return
+        deadline = time.time() + timeout
+        try:
+            self.queue.put(self._STOP, timeout=timeout)
+        except Full:
+            pass
+        thread.join(max(0, deadline - time.time()))
+        if thread.is_alive():
+            self.log.warn(
+                "Gave up waiting for %d analytics hit(s) to be sent.",
+                self.queue.qsize() + len(self._pending)
+            )
+
+    def _ensure_sender(self):
+        """Start the background thread if it's not running.
+
+        The thread is started on demand, rather than in the
+        constructor, so that a process that forks after loading its
+        configuration gets a working thread in each child.
+        """
+        if self.thread and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            pid = os.getpid()
+            if self._pid != pid:
+                # Hits that were pending in our parent process are
+                # its responsibility, not ours.
+                self._reset()
+                self._pid = pid
+            self._stopping = False
+            if not self._shutdown_registered:
+                atexit.register(self.shutdown)
+                self._shutdown_registered = True
+            self.thread = Thread(
+                target=self._run, name="Google Analytics dispatcher"
+            )
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _spool_path(self, pid, segment_number):
+        return os.path.join(
+            self.spool_directory, "%d-%d.spool" % (pid, segment_number)
+        )
+
+    def _write_to_spool(self, hit):
+        """Record an unsent hit on disk.
+
+        :return: The path to the spool segment the hit was written
+        to, or None if it wasn't written anywhere.
+        """
+        if not self.spool_directory:
+            return None
+        try:
+            if self._segment is None:
+                if not os.path.isdir(self.spool_directory):
+                    os.makedirs(self.spool_directory)
+                self._segment_number += 1
+                self._segment_path = self._spool_path(
+                    os.getpid(), self._segment_number
+                )
+                self._segment = open(self._segment_path, "a")
+                self._segment_hits = 0
+            self._segment.write(hit + "\n")
+            self._segment.flush()
+        except (IOError, OSError), e:
+            self.log.error("Could not spool analytics hit: %s", e, exc_info=e)
+            return None
+        path = self._segment_path
+        self._unacknowledged[path] = self._unacknowledged.get(path, 0) + 1
+        self._segment_hits += 1
+        if self._segment_hits >= self.SEGMENT_SIZE:
+            # Start a new segment, so that this one can be deleted
+            # once its hits are dealt with.
+            self._close_segment()
+        return path
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+        self._segment = None
+
+    def _acknowledge(self, batch):
+        """Record that the hits in a batch have been dealt with.
+
+        A spool segment is deleted once every hit written to it has
+        been dealt with. Hits are dealt with in the order they were
+        spooled, so for any other segment it's enough to record how
+        many of its hits are done.
+        """
+        counts = Counter(segment for hit, segment in batch if segment)
+        for path, count in counts.items():
+            remaining = self._unacknowledged.get(path, 0) - count
+            try:
+                if remaining > 0:
+                    self._unacknowledged[path] = remaining
+                    line = "%s%d\n" % (self.ACKNOWLEDGED, count)
+                    if path == self._segment_path and self._segment:
+                        self._segment.write(line)
+                        self._segment.flush()
+                    else:
+                        with open(path, "a") as f:
+                            f.write(line)
+                else:
+                    self._unacknowledged.pop(path, None)
+                    if path == self._segment_path:
+                        self._close_segment()
+                    os.remove(path)
+            except (IOError, OSError), e:
+                self.log.error(
+                    "Could not update analytics spool %s: %s", path, e,
+                    exc_info=e
+                )
+
+    @classmethod
+    def _read_spool(cls, path):
+        """Find the hits in a spool segment that were never dealt with."""
+        hits = []
+        acknowledged = 0
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                if line.startswith(cls.ACKNOWLEDGED):
+                    acknowledged += int(line[len(cls.ACKNOWLEDGED):])
+                else:
+                    hits.append(line)
+        return hits[acknowledged:]
+
+    def _recover_spool(self):
+        """Take on the hits left behind by processes that have died.
+
+        Recovered hits are written to our own spool before the dead
+        process's segment is deleted, so a hit is never only in
+        memory.
+        """
+        if not self.spool_directory:
+            return
+        if not os.path.isdir(self.spool_directory):
+            os.makedirs(self.spool_directory)
+        my_pid = os.getpid()
+        for filename in sorted(os.listdir(self.spool_directory)):
+            if not filename.endswith(".spool"):
+                continue
+            try:
+                pid = int(filename[:-len(".spool")].split("-")[0])
+            except ValueError:
+                continue
+            if pid == my_pid or self._process_is_alive(pid):
+                continue
+
+            # Claim the file so no other process recovers it too.
+            path = os.path.join(self.spool_directory, filename)
+            claimed = "%s.%d.recovering" % (path, my_pid)
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            hits = self._read_spool(claimed)
+            self.log.info(
+                "Recovered %d unsent hit(s) from %s", len(hits), filename
+            )
+            for hit in hits:
+                self._pend(hit)
+            os.remove(claimed)
+
+    @classmethod
+    def _process_is_alive(cls, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno == errno.EPERM
+        return True
+
+
 Provider = GoogleAnalyticsProvider
@@ -23,8 +23,8 @@ from core.model import (
     get_one_or_create,
     Patron,
 )
-from core.util.http import HTTP
 from core.util import MoneyUtility
+from util.http_client import PooledHTTPClient
 
 class MilleniumPatronAPI(BasicAuthenticationProvider, XMLParser):
 
@@ -64,6 +64,7 @@ class MilleniumPatronAPI(BasicAuthenticationProvider, XMLParser):
             url = url + "/"
         self.root = url
         self.verify_certificate=verify_certificate
+        self.http_client = PooledHTTPClient.for_integration(self.NAME)
         self.parser = etree.HTMLParser()
         self.blacklist = [re.compile(x, re.I)
                           for x in authorization_identifier_blacklist]
@@ -107,10 +108,10 @@ class MilleniumPatronAPI(BasicAuthenticationProvider, XMLParser):
         can override it.
         """
         self._update_request_kwargs(kwargs)
-        return HTTP.request_with_timeout("GET", url, *args, **kwargs)
+        return self.http_client.request("GET", url, *args, **kwargs)
 
     def _update_request_kwargs(self, kwargs):
-        """Modify the kwargs to HTTP.request_with_timeout to reflect the API
+        """Modify the kwargs to PooledHTTPClient.request to reflect the API
         configuration, in a testable way.
         """
         kwargs['verify'] = self.verify_certificate
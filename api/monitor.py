@@ -11,9 +11,12 @@ from core.monitor import (
     WorkSweepMonitor,
 )
 from core.model import (
+    get_one,
+    get_one_or_create,
     DataSource,
     Edition,
     LicensePool,
+    Timestamp,
 )
 from core.external_search import ExternalSearchIndex
 
@@ -64,3 +67,50 @@ class SearchIndexMonitor(WorkSweepMonitor):
         for work, message in failures:
             self.log.error("Failed to update search index for %s: %s" % (work, message))
 
+
+class MonitorCheckpoint(object):
+    """Keep track of how far a Monitor has gotten through a long run,
+    so that if the Monitor is restarted it can pick up where it left
+    off instead of starting the run over.
+
+    The checkpoint is stored in its own Timestamp. `timestamp` holds
+    the start time of the run in progress, and `counter` holds a
+    number saying how far the run has gotten -- usually the number of
+    items from that run which have been processed.
+    """
+
+    def __init__(self, _db, service_name):
+        self._db = _db
+        self.service = "%s (checkpoint)" % service_name
+
+    def position(self, run_start):
+        """How many items from the run that started at `run_start` have
+        already been processed?
+
+        :return: 0 if there's no checkpoint for that run.
+        """
+        timestamp = get_one(self._db, Timestamp, service=self.service)
+        if (not timestamp or timestamp.timestamp != run_start
+            or not timestamp.counter):
+            return 0
+        return timestamp.counter
+
+    def save(self, run_start, position):
+        """Record that `position` items from the run that started at
+        `run_start` have been processed.
+
+        The checkpoint takes effect when the database session is
+        committed.
+        """
+        timestamp, is_new = get_one_or_create(
+            self._db, Timestamp, service=self.service
+        )
+        timestamp.timestamp = run_start
+        timestamp.counter = position
+
+    def clear(self):
+        """Record that there's no run in progress."""
+        timestamp = get_one(self._db, Timestamp, service=self.service)
+        if timestamp:
+            timestamp.timestamp = None
+            timestamp.counter = None
@@ -49,6 +49,8 @@ from core.util.http import (
     BadResponseException,
 )
 
+from util.http_client import PooledHTTPClient
+
 
 class OneClickAPI(BaseOneClickAPI, BaseCirculationAPI):
 
@@ -61,6 +63,7 @@ class OneClickAPI(BaseOneClickAPI, BaseCirculationAPI):
 
     def __init__(self, *args, **kwargs):
         super(OneClickAPI, self).__init__(*args, **kwargs)
+        self.http_client = PooledHTTPClient.for_integration(self.NAME)
         self.bibliographic_coverage_provider = (
             OneClickBibliographicCoverageProvider(
                 self._db, oneclick_api=self
@@ -72,6 +75,13 @@ class OneClickAPI(BaseOneClickAPI, BaseCirculationAPI):
         num_days = int(self.eaudio_loan_length)
         self.eaudio_expiration_default = datetime.timedelta(days=num_days)
 
+    def _make_request(self, url, method, headers, data=None, params=None,
+                      **kwargs):
+        """Make an HTTP request over a pooled connection."""
+        return self.http_client.request(
+            method, url, headers=headers, data=data, params=params, **kwargs
+        )
+
 
     def checkin(self, patron, pin, licensepool):
         """
@@ -1,12 +1,27 @@
 import urllib
 import copy
+import hashlib
+import re
 from nose.tools import set_trace
+import flask
 from flask import url_for
 from lxml import etree
 from collections import defaultdict
 import uuid
+import weakref
 
-from sqlalchemy.orm import lazyload
+from sqlalchemy import (
+    and_,
+    event,
+    or_,
+)
+
+from sqlalchemy.orm import (
+    joinedload,
+    lazyload,
+    subqueryload,
+)
+from sqlalchemy.orm.attributes import get_history
 
 from config import Configuration
 from core.opds import (
@@ -18,13 +33,17 @@ from core.util.opds_writer import (
     OPDSFeed,
 )
 from core.model import (
+    Contribution,
     Credential,
     DataSource,
     DeliveryMechanism,
+    Hold,
     Identifier,
     LicensePool,
     LicensePoolDeliveryMechanism,
+    Loan,
     Patron,
+    Resource,
     Session,
     BaseMaterializedWork,
     Work,
@@ -38,16 +57,277 @@ from novelist import NoveListAPI
 from lanes import QueryGeneratedLane
 from annotations import AnnotationWriter
 from adobe_vendor_id import AuthdataUtility
+from util.lru import ExpiringLRUCache
+
+class URLTemplates(object):
+    """Build URLs for the routes that show up once per entry in an OPDS
+    feed without going through the full url_for() machinery every time.
+
+    The first time a route is used with a given set of arguments, we
+    call url_for() with a placeholder for each argument, and turn the
+    result into a format string. After that, URLs for that route are
+    built by string substitution.
+
+    Argument values that would need anything more complicated than a
+    space escaped are passed on to url_for() as usual.
+    """
+
+    # Values made up entirely of these characters look the same in a
+    # URL path, except that spaces become %20.
+    SAFE_VALUE = re.compile("^[A-Za-z0-9_.:/ -]*$")
+
+    PLACEHOLDER = "URLTEMPLATEPLACEHOLDER%dX"
+
+    def __init__(self, url_for=url_for, verify=False, max_size=1000):
+        """Constructor.
+
+        :param url_for: The function to use when we can't use a
+        template.
+
+        :param verify: If this is True, every URL built from a template
+        is compared against the result of url_for(), and a ValueError
+        is raised if they differ. This is for use in tests.
+
+        :param max_size: Keep at most this many templates, discarding
+        the least recently used. Templates are specific to the URL
+        root of the request, which comes from the client, so there's
+        no natural limit on how many there could be.
+        """
+        self._url_for = url_for
+        self.verify = verify
+        self.templates = ExpiringLRUCache(max_size)
+
+    def url_for(self, endpoint, **kwargs):
+        values = {}
+        options = {}
+        for k, v in kwargs.items():
+            if k.startswith('_'):
+                options[k] = v
+            elif v is not None:
+                # url_for() ignores arguments whose value is None.
+                values[k] = v
+
+        if flask.has_request_context():
+            url_root = flask.request.url_root
+        else:
+            url_root = None
+        key = (endpoint, url_root, tuple(sorted(options.items())),
+               tuple(sorted(values.keys())))
+        template = self.templates.get(key)
+        if template is None:
+            template = self._make_template(endpoint, values, options)
+            self.templates.put(key, template)
+
+        quoted = self._quote(values)
+        if not template or quoted is None:
+            return self._url_for(endpoint, **kwargs)
+
+        url = template % quoted
+        if self.verify:
+            expect = self._url_for(endpoint, **kwargs)
+            if url != expect:
+                raise ValueError(
+                    "URL template for %s gave %s, url_for gave %s" % (
+                        endpoint, url, expect
+                    )
+                )
+        return url
+
+    def _make_template(self, endpoint, values, options):
+        """Turn a route into a format string.
+
+        :return: A format string, or False if this route can't be
+        turned into a template.
+        """
+        placeholders = {}
+        for i, k in enumerate(sorted(values.keys())):
+            placeholders[k] = self.PLACEHOLDER % i
+        kwargs = dict(placeholders)
+        kwargs.update(options)
+        url = self._url_for(endpoint, **kwargs)
+
+        path = url.split('?', 1)[0]
+        template = url.replace('%', '%%')
+        for k, placeholder in placeholders.items():
+            if url.count(placeholder) != 1 or placeholder not in path:
+                # This argument ended up in the query string, which is
+                # escaped differently.
+                return False
+            template = template.replace(placeholder, "%%(%s)s" % k)
+        return template
+
+    def _quote(self, values):
+        """Escape values for substitution into a template.
+
+        :return: A dictionary, or None if any of the values needs
+        escaping beyond what a template can handle.
+        """
+        quoted = {}
+        for k, v in values.items():
+            if isinstance(v, unicode):
+                try:
+                    v = v.encode("ascii")
+                except UnicodeEncodeError, e:
+                    return None
+            else:
+                v = str(v)
+            if not self.SAFE_VALUE.match(v):
+                return None
+            quoted[k] = v.replace(" ", "%20")
+        return quoted
+
+
+class EntryFragmentCache(object):
+    """Remember the circulation links CirculationManagerAnnotator adds
+    to a book's entry when the patron has no loan, hold or fulfillment
+    for the book.
+
+    Those links are the same for every patron, so once they've been
+    built for one feed they can be copied into the next. The cache key
+    includes everything the links depend on, including the license
+    pool's availability, so an entry is never stale; it just stops
+    being used.
+    """
+
+    def __init__(self, max_size=10000):
+        """Constructor.
+
+        :param max_size: Keep at most this many entries, discarding the
+        least recently used.
+        """
+        self.max_size = max_size
+        self._entries = ExpiringLRUCache(max_size)
+
+    def get(self, key):
+        """Find the cached links for an entry.
+
+        :return: A list of newly parsed elements, or None if nothing
+        is cached.
+        """
+        elements = self._entries.get(key)
+        if elements is None:
+            return None
+        # The elements are cached as serialized XML, so every caller
+        # gets its own copy to modify.
+        return [etree.fromstring(x) for x in elements]
+
+    def put(self, key, elements):
+        self._entries.put(key, [etree.tostring(x) for x in elements])
+
+
+class ContributionCache(object):
+    """Remember which editions have contributors.
+
+    Whether or not an entry gets a link to related books depends on
+    whether its edition has any contributors. This lets us answer that
+    question without loading every edition's contributions.
+
+    Caches are updated as Contributions are created, changed and
+    deleted in this process. Changes made by other processes are
+    picked up when an entry expires.
+    """
+
+    # Every ContributionCache in the process, so that all of them can
+    # be told about a change to an edition's contributions.
+    _instances = weakref.WeakSet()
+
+    def __init__(self, ttl=3600, max_size=100000):
+        """Constructor.
+
+        :param ttl: An entry is good for this many seconds.
+        :param max_size: Keep at most this many entries, discarding the
+        least recently used.
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = ExpiringLRUCache(max_size, ttl)
+        self._instances.add(self)
+
+    @classmethod
+    def invalidate_everywhere(cls, edition_id):
+        for cache in list(cls._instances):
+            cache.invalidate(edition_id)
+
+    def get(self, edition_id):
+        """:return: True or False if we know whether the edition has
+        contributors, None if we don't.
+        """
+        return self._entries.get(edition_id)
+
+    def put(self, edition_id, value):
+        self._entries.put(edition_id, value)
+
+    def invalidate(self, edition_id):
+        self._entries.remove(edition_id)
+
+    def prime(self, _db, edition_ids):
+        """Find out, with a single query, which of the given editions
+        have contributors.
+        """
+        ids = set(
+            x for x in edition_ids if x and self.get(x) is None
+        )
+        if not ids:
+            return
+        qu = _db.query(Contribution.edition_id).filter(
+            Contribution.edition_id.in_(ids)
+        ).distinct()
+        have_contributors = set(edition_id for [edition_id] in qu)
+        for edition_id in ids:
+            self.put(edition_id, edition_id in have_contributors)
+
+    def has_contributors(self, edition):
+        value = self.get(edition.id)
+        if value is None:
+            if 'contributions' in edition.__dict__:
+                # The contributions are already loaded.
+                value = bool(edition.contributions)
+            else:
+                _db = Session.object_session(edition)
+                value = _db.query(Contribution.id).filter(
+                    Contribution.edition_id==edition.id
+                ).limit(1).first() is not None
+            self.put(edition.id, value)
+        return value
+
+
+def _contributions_changed(mapper, connection, contribution):
+    # If a contribution moved from one edition to another, both
+    # editions have changed.
+    history = get_history(contribution, 'edition_id')
+    for edition_id in set(history.sum() + [contribution.edition_id]):
+        if edition_id is not None:
+            ContributionCache.invalidate_everywhere(edition_id)
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Contribution, _event, _contributions_changed)
+
 
 class CirculationManagerAnnotator(Annotator):
+
+    # URL templates are shared by every annotator in the process.
+    url_templates = URLTemplates()
+
+    # So are the patron-independent parts of entries.
+    entry_fragments = EntryFragmentCache()
+
+    # And what we know about which editions have contributors.
+    contributions = ContributionCache()
    
     def __init__(self, circulation, lane, patron=None,
                  active_loans_by_work={}, active_holds_by_work={},
                  active_fulfillments_by_work={},
                  facet_view='feed',
                  test_mode=False,
-                 top_level_title="All Books"
+                 top_level_title="All Books",
+                 entry_fragment_cache=None,
     ):
+        """Constructor.
+
+        :param entry_fragment_cache: An EntryFragmentCache to use
+        instead of the one shared by the whole process. In test mode,
+        entries are not cached unless one is provided.
+        """
         self.circulation = circulation
         self.lane = lane
         self.patron = patron
@@ -58,7 +338,16 @@ class CirculationManagerAnnotator(Annotator):
         self.facet_view = facet_view
         self.test_mode = test_mode
         self._adobe_id_tags = {}
+        self._adobe_patron_identifiers = {}
+        self._fragment_key_parts = {}
         self._top_level_title = top_level_title
+        if entry_fragment_cache is None and not test_mode:
+            entry_fragment_cache = self.entry_fragments
+        self.entry_fragment_cache = entry_fragment_cache
+        if test_mode:
+            self.contribution_cache = ContributionCache()
+        else:
+            self.contribution_cache = self.contributions
 
     def top_level_title(self):
         return self._top_level_title
@@ -73,6 +362,14 @@ class CirculationManagerAnnotator(Annotator):
         else:
             return url_for(*args, **kwargs)
 
+    def templated_url_for(self, endpoint, **kwargs):
+        """Like url_for, but for routes that are used in every entry of a
+        feed, which are built from cached URL templates.
+        """
+        if self.test_mode:
+            return self.url_for(endpoint, **kwargs)
+        return self.url_templates.url_for(endpoint, **kwargs)
+
     def cdn_url_for(self, *args, **kwargs):
         if self.test_mode:
             return self.test_url_for(True, *args, **kwargs)
@@ -110,7 +407,7 @@ class CirculationManagerAnnotator(Annotator):
         return self.feed_url(self.lane, facets=facets, default_route=self.facet_view)
 
     def permalink_for(self, work, license_pool, identifier):
-        return self.url_for(
+        return self.templated_url_for(
             'permalink', data_source=license_pool.data_source.name,
             identifier_type=identifier.type, identifier=identifier.identifier, _external=True
         )
@@ -230,6 +527,21 @@ class CirculationManagerAnnotator(Annotator):
                 active_license_pool = identifier.licensed_through
             data_source_name = active_license_pool.data_source.name
 
+        # Unless the patron has some relationship with this book, the
+        # links we're about to add are the same for everyone, and
+        # we may have built them already.
+        cache_key = None
+        if (self.entry_fragment_cache is not None and active_license_pool
+            and not (active_loan or active_hold or active_fulfillment)):
+            cache_key = self._entry_fragment_key(
+                active_license_pool, data_source_name, identifier
+            )
+            cached = self.entry_fragment_cache.get(cache_key)
+            if cached is not None:
+                entry.extend(cached)
+                return
+        first_new_element = len(entry)
+
         # First, add a permalink.
         feed.add_link_to_entry(
             entry, 
@@ -244,7 +556,7 @@ class CirculationManagerAnnotator(Annotator):
         feed.add_link_to_entry(
             entry, 
             rel='issues',
-            href=self.url_for(
+            href=self.templated_url_for(
                 'report', data_source=data_source_name,
                 identifier_type=identifier.type,
                 identifier=identifier.identifier, _external=True)
@@ -266,7 +578,7 @@ class CirculationManagerAnnotator(Annotator):
                 rel='related',
                 type=OPDSFeed.ACQUISITION_FEED_TYPE,
                 title='Recommended Works',
-                href=self.url_for(
+                href=self.templated_url_for(
                     'related_books',
                     data_source=data_source_name, identifier_type=identifier.type,
                     identifier=identifier.identifier, _external=True
@@ -278,7 +590,7 @@ class CirculationManagerAnnotator(Annotator):
             entry,
             rel="http://www.w3.org/ns/oa#annotationService",
             type=AnnotationWriter.CONTENT_TYPE,
-            href=self.url_for(
+            href=self.templated_url_for(
                 'annotations_for_work',
                 identifier_type=identifier.type,
                 identifier=identifier.identifier,
@@ -286,14 +598,102 @@ class CirculationManagerAnnotator(Annotator):
             )
         )
 
-    @classmethod
-    def related_books_available(cls, license_pool):
+        if cache_key is not None:
+            self.entry_fragment_cache.put(
+                cache_key, entry[first_new_element:]
+            )
+
+    def _entry_fragment_key(self, license_pool, data_source_name, identifier):
+        """Everything that can change the patron-independent links in
+        an entry.
+
+        The parts of the key that aren't stored on the LicensePool
+        itself are looked up for a whole page of works at once by
+        prepare_works(), so finding a cached entry doesn't take any
+        queries. They're only looked up here for a LicensePool that
+        wasn't prepared.
+        """
+        if not self.test_mode and flask.has_request_context():
+            url_root = flask.request.url_root
+        else:
+            url_root = None
+        parts = self._fragment_key_parts.get(license_pool.id)
+        if parts is None:
+            mechanisms = tuple(sorted(
+                (lpdm.delivery_mechanism_id, lpdm.resource_id,
+                 lpdm.resource and lpdm.resource.url)
+                for lpdm in license_pool.delivery_mechanisms
+            ))
+            parts = (
+                mechanisms, bool(self.related_books_available(license_pool))
+            )
+        return (
+            self.test_mode, url_root, self.circulation is None,
+            license_pool.id, identifier.id, data_source_name,
+            license_pool.last_checked, license_pool.open_access,
+            license_pool.licenses_owned, license_pool.licenses_available,
+            license_pool.licenses_reserved,
+            license_pool.patrons_in_hold_queue,
+        ) + parts
+
+    def related_books_available(self, license_pool):
         """:return: bool asserting whether related books are available for a
         particular work
         """
-        contributions = license_pool.presentation_edition.contributions
-        series = license_pool.presentation_edition.series
-        return contributions or series or NoveListAPI.is_configured()
+        if NoveListAPI.is_configured():
+            return True
+        edition = license_pool.presentation_edition
+        if edition.series:
+            return True
+        return self.contribution_cache.has_contributors(edition)
+
+    def prepare_works(self, _db, works):
+        """Look up, all at once, what's needed to decide whether each
+        of these works gets a related books link, and to find each
+        work's cached entry fragment.
+        """
+        pools = []
+        for work in works:
+            pool = self.active_licensepool_for(work)
+            if pool:
+                pools.append(pool)
+        if not pools:
+            return
+
+        novelist = NoveListAPI.is_configured()
+        series = {}
+        if not novelist:
+            edition_ids = [pool.presentation_edition_id for pool in pools]
+            self.contribution_cache.prime(_db, edition_ids)
+            qu = _db.query(Edition.id, Edition.series).filter(
+                Edition.id.in_([x for x in edition_ids if x])
+            )
+            series = dict(qu)
+
+        mechanisms = defaultdict(list)
+        qu = _db.query(
+            LicensePoolDeliveryMechanism.license_pool_id,
+            LicensePoolDeliveryMechanism.delivery_mechanism_id,
+            LicensePoolDeliveryMechanism.resource_id, Resource.url,
+        ).outerjoin(
+            LicensePoolDeliveryMechanism.resource
+        ).filter(
+            LicensePoolDeliveryMechanism.license_pool_id.in_(
+                [pool.id for pool in pools]
+            )
+        )
+        for pool_id, mechanism_id, resource_id, url in qu:
+            mechanisms[pool_id].append((mechanism_id, resource_id, url))
+
+        for pool in pools:
+            edition_id = pool.presentation_edition_id
+            related_books = novelist or bool(
+                series.get(edition_id)
+                or self.contribution_cache.get(edition_id)
+            )
+            self._fragment_key_parts[pool.id] = (
+                tuple(sorted(mechanisms[pool.id])), related_books
+            )
 
     def annotate_feed(self, feed, lane):
         if self.patron:
@@ -390,7 +790,7 @@ class CirculationManagerAnnotator(Annotator):
         # add a link to revoke it.
         revoke_links = []
         if can_revoke:
-            url = self.url_for(
+            url = self.templated_url_for(
                 'revoke_loan_or_hold', data_source=data_source_name,
                 identifier_type=identifier.type,
                 identifier=identifier.identifier, _external=True)
@@ -513,7 +913,7 @@ class CirculationManagerAnnotator(Annotator):
             # Following this link will borrow the book but not set 
             # its delivery mechanism.
             mechanism_id = None
-        borrow_url = self.url_for(
+        borrow_url = self.templated_url_for(
             "borrow", data_source=data_source_name,
             identifier_type=identifier.type,
             identifier=identifier.identifier, 
@@ -562,7 +962,7 @@ class CirculationManagerAnnotator(Annotator):
         if not format_types:
             return None
             
-        fulfill_url = self.url_for(
+        fulfill_url = self.templated_url_for(
             "fulfill", data_source=data_source_name,
             identifier_type=identifier.type,
             identifier=identifier.identifier,
@@ -631,11 +1031,16 @@ class CirculationManagerAnnotator(Annotator):
         # CirculationManagerAnnotators are created per request.
         # Within the context of a single request, we can cache the
         # tags that explain how the patron can get an Adobe ID, and
-        # reuse them across <entry> tags. This saves a little time,
-        # makes tests more reliable, and stops us from providing a
-        # different authdata value for every <entry> tag.
+        # reuse them across <entry> tags. The tags are cached as
+        # serialized XML, so every caller gets its own copy to modify.
         if isinstance(patron_identifier, Patron):
-            patron_identifier = self._adobe_patron_identifier(patron_identifier)
+            # The same patron shows up in every entry of a loans feed,
+            # so only look up their Credential once per request.
+            patron = patron_identifier
+            patron_identifier = self._adobe_patron_identifiers.get(patron.id)
+            if patron_identifier is None:
+                patron_identifier = self._adobe_patron_identifier(patron)
+                self._adobe_patron_identifiers[patron.id] = patron_identifier
         cached = self._adobe_id_tags.get(patron_identifier)
         if cached is None:
             cached = []
@@ -647,7 +1052,7 @@ class CirculationManagerAnnotator(Annotator):
                 # a device. So we've used this alternate technique
                 # that's much smaller than a JWT and can be smuggled
                 # into username/password.
-                vendor_id, jwt = authdata.encode_short_client_token(patron_identifier)
+                vendor_id, jwt = authdata.short_client_token(patron_identifier)
 
                 drm_licensor = OPDSFeed.makeelement("{%s}licensor" % OPDSFeed.DRM_NS)
                 vendor_attr = "{%s}vendor" % OPDSFeed.DRM_NS
@@ -665,12 +1070,10 @@ class CirculationManagerAnnotator(Annotator):
                     "adobe_drm_devices", _external=True
                 )
                 drm_licensor.append(device_list_link)
-                cached = [drm_licensor]
+                cached = [etree.tostring(drm_licensor)]
 
             self._adobe_id_tags[patron_identifier] = cached
-        else:
-            cached = copy.deepcopy(cached)
-        return cached
+        return [etree.fromstring(x) for x in cached]
         
     def open_access_link(self, lpdm):
         url = cdnify(lpdm.resource.url, Configuration.cdns())
@@ -696,33 +1099,192 @@ class CirculationManagerAnnotator(Annotator):
         feed_obj.feed.append(patron_tag)
 
 
+class StreamingFeed(object):
+    """An acquisition feed that's serialized one entry at a time, so it
+    can be sent to the client while it's still being built.
+
+    Each entry is created, serialized and thrown away before the next
+    one is created, so the whole feed never has to be in memory at
+    once.
+    """
+
+    def __init__(self, feed, works, url):
+        """Constructor.
+
+        :param feed: An AcquisitionFeed with no entries, which provides
+        the feed-level tags and the machinery for creating entries.
+        :param works: The works to put in the feed.
+        :param url: The URL to the feed.
+        """
+        self.feed = feed
+        self.works = works
+        self.lane_link = dict(rel="collection", href=url)
+
+    def __iter__(self):
+        """Yield the feed as a series of UTF-8 encoded strings."""
+        header = etree.tostring(self.feed.feed, encoding=unicode)
+        footer_starts = header.rindex("</")
+        yield header[:footer_starts].encode("utf8")
+        for work in self.works:
+            entry = self.feed.add_entry(work, self.lane_link)
+            if entry is None:
+                continue
+            # Serialize the entry while it's still in the feed, so it
+            # uses the feed's namespace prefixes.
+            data = etree.tostring(entry, encoding=unicode)
+            self.feed.feed.remove(entry)
+            yield data.encode("utf8")
+        yield header[footer_starts:].encode("utf8")
+
+    def __unicode__(self):
+        return "".join(self).decode("utf8")
+
+
 class CirculationManagerLoanAndHoldAnnotator(CirculationManagerAnnotator):
 
     @classmethod
-    def active_loans_for(cls, circulation, patron, test_mode=False):
+    def active_loans_for(cls, circulation, patron, test_mode=False,
+                         stream=False):
+        """Create a feed of the patron's loans and holds.
+
+        :param stream: If this is True, return a StreamingFeed instead
+        of an AcquisitionFeed.
+        """
         db = Session.object_session(patron)
+        works = []
         active_loans_by_work = {}
-        for loan in patron.loans:
+        for loan in cls._load_with_works(db, Loan, patron):
             work = loan.work
             if work:
                 active_loans_by_work[work] = loan
+                works.append(work)
         active_holds_by_work = {}
-        for hold in patron.holds:
+        for hold in cls._load_with_works(db, Hold, patron):
             work = hold.work
             if work:
                 active_holds_by_work[work] = hold
+                if work not in active_loans_by_work:
+                    works.append(work)
 
         annotator = cls(
             circulation, None, patron, active_loans_by_work, active_holds_by_work,
             test_mode=test_mode
         )
         url = annotator.url_for('active_loans', _external=True)
-        works = patron.works_on_loan_or_on_hold()
 
-        feed_obj = AcquisitionFeed(db, "Active loans and holds", url, works, annotator)
+        title = "Active loans and holds"
+        if stream:
+            feed_obj = AcquisitionFeed(db, title, url, [], annotator)
+            annotator.annotate_feed(feed_obj, None)
+            return StreamingFeed(feed_obj, works, url)
+
+        feed_obj = AcquisitionFeed(db, title, url, works, annotator)
         annotator.annotate_feed(feed_obj, None)
         return feed_obj
     
+    @classmethod
+    def active_loans_etag(cls, circulation, patron, test_mode=False):
+        """Calculate an ETag for the patron's loans feed without building
+        the feed.
+
+        The ETag covers the patron's loans and holds, the availability,
+        presentation and formats of the books involved, the hold
+        policy, and the DRM tags that go into the feed, so it changes
+        whenever the feed would.
+
+        :return: A weak ETag. Two feeds with the same ETag say the same
+        thing, but they're generated on the fly and may not be
+        byte-for-byte identical.
+        """
+        _db = Session.object_session(patron)
+        pool_columns = (
+            LicensePool.id, LicensePool.licenses_owned,
+            LicensePool.licenses_available, LicensePool.licenses_reserved,
+            LicensePool.patrons_in_hold_queue, LicensePool.last_checked,
+            Work.last_update_time,
+        )
+        loans = _db.query(
+            Loan.id, Loan.start, Loan.end, Loan.fulfillment_id, *pool_columns
+        ).join(
+            LicensePool, Loan.license_pool_id==LicensePool.id
+        ).outerjoin(
+            Work, LicensePool.work_id==Work.id
+        ).filter(Loan.patron_id==patron.id).order_by(Loan.id)
+        holds = _db.query(
+            Hold.id, Hold.start, Hold.end, Hold.position, *pool_columns
+        ).join(
+            LicensePool, Hold.license_pool_id==LicensePool.id
+        ).outerjoin(
+            Work, LicensePool.work_id==Work.id
+        ).filter(Hold.patron_id==patron.id).order_by(Hold.id)
+
+        # The formats a book is available in determine the acquisition
+        # links in its entry.
+        pool_ids = _db.query(Loan.license_pool_id).filter(
+            Loan.patron_id==patron.id
+        ).union(
+            _db.query(Hold.license_pool_id).filter(Hold.patron_id==patron.id)
+        ).subquery()
+        mechanisms = _db.query(
+            LicensePool.id, LicensePoolDeliveryMechanism.delivery_mechanism_id,
+            LicensePoolDeliveryMechanism.resource_id,
+        ).join(
+            LicensePool.delivery_mechanisms
+        ).filter(
+            LicensePool.id.in_(pool_ids)
+        ).order_by(
+            LicensePool.id, LicensePoolDeliveryMechanism.delivery_mechanism_id,
+            LicensePoolDeliveryMechanism.resource_id,
+        )
+
+        annotator = cls(circulation, None, patron, test_mode=test_mode)
+        drm_tags = [
+            etree.tostring(x)
+            for x in annotator.drm_device_registration_feed_tags(patron)
+        ]
+        if not test_mode and flask.has_request_context():
+            url_root = flask.request.url_root
+        else:
+            url_root = None
+        stamp = repr((
+            url_root, patron.username, patron.authorization_identifier,
+            [tuple(x) for x in loans], [tuple(x) for x in holds],
+            [tuple(x) for x in mechanisms], Configuration.hold_policy(),
+            drm_tags,
+        ))
+        return 'W/"%s"' % hashlib.md5(stamp).hexdigest()
+
+    @classmethod
+    def _load_with_works(cls, _db, model, patron):
+        """Load a patron's loans or holds, along with everything needed to
+        build their feed entries.
+
+        The number of queries this takes doesn't depend on the number
+        of loans or holds.
+
+        :param model: Loan or Hold.
+        """
+        pool = model.license_pool
+        qu = _db.query(model).filter(model.patron_id==patron.id).options(
+            joinedload(pool).joinedload(LicensePool.data_source),
+            joinedload(pool).joinedload(LicensePool.identifier),
+            joinedload(pool).joinedload(LicensePool.work).joinedload(
+                Work.presentation_edition
+            ),
+            joinedload(pool).joinedload(
+                LicensePool.presentation_edition
+            ).subqueryload(Edition.contributions),
+            joinedload(pool).subqueryload(
+                LicensePool.delivery_mechanisms
+            ).joinedload(LicensePoolDeliveryMechanism.delivery_mechanism),
+            joinedload(pool).subqueryload(
+                LicensePool.delivery_mechanisms
+            ).joinedload(LicensePoolDeliveryMechanism.resource).joinedload(
+                Resource.representation
+            ),
+        )
+        return qu.all()
+
     @classmethod
     def single_loan_feed(cls, circulation, loan, test_mode=False):
         db = Session.object_session(loan)
@@ -776,7 +1338,7 @@ class CirculationManagerLoanAndHoldAnnotator(CirculationManagerAnnotator):
         logout, even if there is no active loan that requires one.
         """
         _db = Session.object_session(patron)
-        tags = copy.deepcopy(self.adobe_id_tags(_db, patron))
+        tags = self.adobe_id_tags(_db, patron)
         attr = '{%s}scheme' % OPDSFeed.DRM_NS
         for tag in tags:
             tag.attrib[attr] = "http://librarysimplified.org/terms/drm/scheme/ACS"
@@ -810,15 +1372,85 @@ class CirculationManagerLoanAndHoldAnnotator(CirculationManagerAnnotator):
 
 class PreloadFeed(AcquisitionFeed):
 
+    # The most recently rendered preload feed, as a 3-tuple
+    # (key, content, ETag). See cached_page().
+    _rendered = None
+
+    @classmethod
+    def preloaded_identifier_ids(cls, _db):
+        """Look up the configured content to preload, in a single query."""
+        configured_content = Configuration.policy(
+            Configuration.PRELOADED_CONTENT
+        ) or []
+        clauses = []
+        for urn in configured_content:
+            identifier_type, identifier = (
+                Identifier.type_and_identifier_for_urn(urn)
+            )
+            clauses.append(and_(Identifier.type==identifier_type,
+                                Identifier.identifier==identifier))
+        if not clauses:
+            return []
+        qu = _db.query(Identifier.id).filter(or_(*clauses))
+        return [identifier_id for [identifier_id] in qu]
+
+    @classmethod
+    def availability_stamp(cls, _db, identifier_ids):
+        """Everything about the preloaded books that can change their
+        entries in the feed.
+        """
+        if not identifier_ids:
+            return ()
+        qu = _db.query(
+            LicensePool.id, LicensePool.work_id, LicensePool.suppressed,
+            LicensePool.open_access, LicensePool.licenses_owned,
+            LicensePool.licenses_available, LicensePool.licenses_reserved,
+            LicensePool.patrons_in_hold_queue, LicensePool.last_checked,
+            Work.last_update_time,
+        ).outerjoin(
+            Work, LicensePool.work_id==Work.id
+        ).filter(
+            LicensePool.identifier_id.in_(identifier_ids)
+        ).order_by(LicensePool.id)
+        return tuple(tuple(row) for row in qu)
+
+    @classmethod
+    def cached_page(cls, _db, title, url, annotator):
+        """Render the feed of content to preload, or reuse the last one
+        rendered if neither the configured content nor the books'
+        availability has changed.
+
+        :return: A 2-tuple (content, ETag). The content is a UTF-8
+        bytestring.
+        """
+        identifier_ids = cls.preloaded_identifier_ids(_db)
+        key = (
+            title, url, tuple(sorted(identifier_ids)),
+            cls.availability_stamp(_db, identifier_ids)
+        )
+        rendered = cls._rendered
+        if rendered and rendered[0] == key:
+            return rendered[1], rendered[2]
+        content = cls.page(
+            _db, title, url, annotator, identifier_ids=identifier_ids
+        )
+        if isinstance(content, unicode):
+            content = content.encode("utf8")
+        etag = hashlib.md5(content).hexdigest()
+        cls._rendered = (key, content, etag)
+        return content, etag
+
     @classmethod
     def page(cls, _db, title, url, annotator=None,
-             use_materialized_works=True):
+             use_materialized_works=True, identifier_ids=None):
 
-        """Create a feed of content to preload on devices."""
-        configured_content = Configuration.policy(Configuration.PRELOADED_CONTENT)
+        """Create a feed of content to preload on devices.
 
-        identifiers = [Identifier.parse_urn(_db, urn)[0] for urn in configured_content]
-        identifier_ids = [identifier.id for identifier in identifiers]
+        :param identifier_ids: The IDs of the Identifiers to preload,
+        if they've already been looked up.
+        """
+        if identifier_ids is None:
+            identifier_ids = cls.preloaded_identifier_ids(_db)
 
         if use_materialized_works:
             from core.model import MaterializedWork
@@ -837,6 +1469,8 @@ class PreloadFeed(AcquisitionFeed):
             q = q.filter(Edition.primary_identifier_id.in_(identifier_ids))
 
         works = q.all()
+        if annotator:
+            annotator.prepare_works(_db, works)
         feed = cls(_db, title, url, works, annotator)
 
         annotator.annotate_feed(feed, None)
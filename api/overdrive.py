@@ -1,8 +1,11 @@
 from nose.tools import set_trace
+from collections import deque
 import datetime
 import json
 import requests
 import flask
+import time
+from threading import Lock
 
 from sqlalchemy.orm import contains_eager
 
@@ -37,11 +40,101 @@ from core.monitor import (
     Monitor,
     IdentifierSweepMonitor,
 )
-from core.util.http import HTTP
+from util.http_client import PooledHTTPClient
+from util.lru import ExpiringLRUCache
+from util.worker_pool import WorkerPool
 from core.metadata_layer import ReplacementPolicy
 
 from circulation_exceptions import *
 from core.analytics import Analytics
+from monitor import MonitorCheckpoint
+
+class PatronTokenCache(object):
+    """Keep patron OAuth tokens in memory, so that a patron's token is
+    looked up in the database once, rather than once per request.
+
+    A token is refreshed a little while before it expires, and only
+    one thread at a time refreshes the token for a given patron.
+    """
+
+    # Refresh a token when it's this close to expiring.
+    REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+
+        # Maps each key to a 2-tuple (token, expiration date).
+        self._entries = ExpiringLRUCache(max_size)
+
+        # For each key whose token is being refreshed, a 2-tuple (lock,
+        # number of threads holding or waiting for the lock). An
+        # entry is removed once no thread needs it, so there are never
+        # more entries than threads.
+        self._lock = Lock()
+        self._refresh_locks = {}
+
+    def expiring(self, expires, now=None):
+        """Is a token with this expiration date due to be refreshed?"""
+        if expires is None:
+            return False
+        now = now or datetime.datetime.utcnow()
+        return expires - self.REFRESH_MARGIN <= now
+
+    def get(self, key):
+        """Find a cached token that isn't about to expire."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        token, expires = entry
+        if self.expiring(expires):
+            return None
+        return token
+
+    def put(self, key, token, expires):
+        self._entries.put(key, (token, expires))
+
+    def invalidate(self, key):
+        self._entries.remove(key)
+
+    def token(self, key, refresh, rejected=None):
+        """Find a usable token, refreshing it if necessary.
+
+        :param refresh: A callable that takes a boolean (whether or
+        not the token must be replaced even if it hasn't expired) and
+        returns a 2-tuple (token, expires).
+        :param rejected: A token which the remote server has rejected,
+        and which must not be returned.
+        """
+        if rejected is None:
+            token = self.get(key)
+            if token is not None:
+                return token
+        with self._lock:
+            refresh_lock, users = self._refresh_locks.get(key, (None, 0))
+            if refresh_lock is None:
+                refresh_lock = Lock()
+            self._refresh_locks[key] = (refresh_lock, users + 1)
+        try:
+            with refresh_lock:
+                # Another thread may have refreshed the token while
+                # we were waiting.
+                token = self.get(key)
+                if token is not None and token != rejected:
+                    return token
+                token, expires = refresh(rejected is not None)
+                self.put(key, token, expires)
+                return token
+        finally:
+            with self._lock:
+                refresh_lock, users = self._refresh_locks[key]
+                if users > 1:
+                    self._refresh_locks[key] = (refresh_lock, users - 1)
+                else:
+                    # Nobody else is waiting for this lock, so a
+                    # thread that comes along later can safely make a
+                    # new one.
+                    del self._refresh_locks[key]
+
 
 class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
 
@@ -72,8 +165,14 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
     # displayed to a patron, so it doesn't matter much.
     DEFAULT_ERROR_URL = "http://librarysimplified.org/"
 
+    # Patron OAuth tokens are shared by every OverdriveAPI in the
+    # process.
+    PATRON_TOKENS = PatronTokenCache()
+
     def __init__(self, *args, **kwargs):
         super(OverdriveAPI, self).__init__(*args, **kwargs)
+        self.http_client = PooledHTTPClient.for_integration("Overdrive")
+        self.patron_tokens = self.PATRON_TOKENS
         self.overdrive_bibliographic_coverage_provider = (
             OverdriveBibliographicCoverageProvider(
                 self._db, overdrive_api=self
@@ -86,8 +185,8 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
 
         The results are never cached.
         """
-        patron_credential = self.get_patron_credential(patron, pin)
-        headers = dict(Authorization="Bearer %s" % patron_credential.credential)
+        token = self.patron_access_token(patron, pin)
+        headers = dict(Authorization="Bearer %s" % token)
         headers.update(extra_headers)
         if method and method.lower() in ('get', 'post', 'put', 'delete'):
             method = method.lower()
@@ -96,7 +195,7 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
                 method = 'post'
             else:
                 method = 'get'
-        response = HTTP.request_with_timeout(
+        response = self.http_client.request(
             method, url, headers=headers, data=data
         )
         if response.status_code == 401:
@@ -105,10 +204,9 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
                 raise Exception("Something's wrong with the patron OAuth Bearer Token!")
             else:
                 # Refresh the token and try again.
-                self.refresh_patron_access_token(
-                    patron_credential, patron, pin)
+                self.patron_access_token(patron, pin, rejected=token)
                 return self.patron_request(
-                    patron, pin, url, extra_headers, data, True)
+                    patron, pin, url, extra_headers, data, True, method)
         else:
             # This is commented out because it may expose patron
             # information.
@@ -116,6 +214,22 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
             # self.log.debug("%s: %s", url, response.status_code)
             return response
 
+    def patron_access_token(self, patron, pin, rejected=None):
+        """Find an OAuth bearer token for the given patron.
+
+        Tokens are kept in memory and only looked up in (or written
+        to) the database when they're missing or about to expire.
+
+        :param rejected: A token which Overdrive has just rejected.
+        """
+        def refresh(force):
+            credential = self.get_patron_credential(patron, pin)
+            if force or self.patron_tokens.expiring(credential.expires):
+                self.refresh_patron_access_token(credential, patron, pin)
+            return credential.credential, credential.expires
+        key = (self.website_id, patron.id)
+        return self.patron_tokens.token(key, refresh, rejected)
+
     def get_patron_credential(self, patron, pin):
         """Create an OAuth token for the given patron."""
         def refresh(credential):
@@ -640,7 +754,20 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
         ensured for the Overdrive Identifier, and a Work will be
         created for the LicensePool and set as presentation-ready.
         """
-        # Retrieve current circulation information about this book
+        return self.apply_availability(self.fetch_availability(book_id))
+
+    def fetch_availability(self, book_id):
+        """Retrieve current circulation information about a single book.
+
+        This only touches the database if Overdrive rejects the
+        collection token and the token has to be refreshed. Before
+        calling this from a worker thread, make sure the token is
+        current by calling check_creds() in the thread that owns the
+        database session.
+
+        :return: A dictionary of information about the book, or None
+        if the information couldn't be retrieved.
+        """
         try:
             book, (status_code, headers, content) = self.circulation_lookup(
                 book_id
@@ -657,11 +784,21 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
                 "Could not get availability for %s: status code %s",
                 book_id, status_code
             )
-            return None, None, False
+            return None
 
         if isinstance(content, basestring):
             content = json.loads(content)
         book.update(content)
+        return book
+
+    def apply_availability(self, book):
+        """Update a book's LicensePool with information obtained from
+        fetch_availability.
+
+        :return: A 3-tuple (license_pool, is_new, is_changed).
+        """
+        if book is None:
+            return None, None, False
 
         # Update book_id now that we know we have new data.
         book_id = book['id']
@@ -774,6 +911,11 @@ class MockOverdriveAPI(BaseMockOverdriveAPI, OverdriveAPI):
 
     collection_token = 'fake token'
 
+    def __init__(self, *args, **kwargs):
+        super(MockOverdriveAPI, self).__init__(*args, **kwargs)
+        # Tests shouldn't see each other's patron tokens.
+        self.patron_tokens = PatronTokenCache()
+
     def patron_request(self, patron, pin, *args, **kwargs):
         response = self._make_request(*args, **kwargs)
 
@@ -792,14 +934,46 @@ class OverdriveCirculationMonitor(Monitor):
 
     Bibliographic data isn't inserted into new LicensePools until
     we hear from the metadata wrangler.
+
+    Availability information is fetched by a pool of worker threads,
+    which stay a few books ahead of the main thread while it updates
+    the database. The main thread checks the collection token before
+    each batch, so the workers never need to refresh it (and touch
+    the database) themselves.
     """
+
+    # By default, fetch availability information for this many books
+    # at once.
+    DEFAULT_WORKERS = 5
+
+    # By default, commit after updating this many books.
+    DEFAULT_BATCH_SIZE = 25
+
+    # If this is True, a checkpoint is saved with every commit, and an
+    # interrupted run is resumed after the last book committed. This
+    # is only safe if recently_changed_ids returns the same books in
+    # the same order each time it's called with the same arguments.
+    RESUMABLE = False
+
     def __init__(self, _db, name="Overdrive Circulation Monitor",
                  interval_seconds=500,
-                 maximum_consecutive_unchanged_books=None):
+                 maximum_consecutive_unchanged_books=None,
+                 workers=None, batch_size=None):
         super(OverdriveCirculationMonitor, self).__init__(
             _db, name, interval_seconds=interval_seconds)
         self.maximum_consecutive_unchanged_books = (
             maximum_consecutive_unchanged_books)
+        self.workers = workers or self.DEFAULT_WORKERS
+        self.batch_size = batch_size or self.DEFAULT_BATCH_SIZE
+        self.pool = WorkerPool(self.workers, name)
+        if self.RESUMABLE:
+            self.checkpoint = MonitorCheckpoint(_db, name)
+        else:
+            self.checkpoint = None
+
+        # Keep this many availability requests in flight, so that a
+        # worker is never left idle waiting for the main thread.
+        self.lookahead = self.workers * 2
 
     def recently_changed_ids(self, start, cutoff):
         return self.api.recently_changed_ids(start, cutoff)
@@ -810,25 +984,88 @@ class OverdriveCirculationMonitor(Monitor):
 
     def run_once(self, start, cutoff):
         _db = self._db
-        added_books = 0
-        overdrive_data_source = DataSource.lookup(
-            _db, DataSource.OVERDRIVE)
+        started = time.time()
+
+        resume_after = 0
+        if self.checkpoint:
+            resume_after = self.checkpoint.position(start)
+            if resume_after:
+                self.log.info(
+                    "Resuming interrupted run after %d books.", resume_after
+                )
 
+        self.api.check_creds()
+        ids = iter(self.recently_changed_ids(start, cutoff))
+        jobs = deque()
         total_books = 0
+        updated_books = 0
+        failed_books = 0
+        uncommitted_books = 0
         consecutive_unchanged_books = 0
-        for i, book in enumerate(self.recently_changed_ids(start, cutoff)):
-            total_books += 1
-            if not total_books % 100:
-                self.log.info("%s books processed", total_books)
-            if not book:
+
+        # The checkpoint must never move past a book whose
+        # availability couldn't be fetched, or a resumed run would
+        # skip it. This is the position of the last book before the
+        # first failure.
+        checkpoint_limit = None
+        while True:
+            # Hand the next few books to the worker threads.
+            while ids is not None and len(jobs) < self.lookahead:
+                try:
+                    book = next(ids)
+                except StopIteration:
+                    ids = None
+                    break
+                total_books += 1
+                if book and total_books > resume_after:
+                    job = self.pool.submit(self.api.fetch_availability, book)
+                    jobs.append((total_books, job))
+            if not jobs:
+                break
+
+            position, job = jobs.popleft()
+            job.wait()
+            if job.exception:
+                self.log.error(
+                    "Error fetching availability: %s", job.exception,
+                    exc_info=job.exc_info
+                )
+            if job.result is None:
+                # We don't know anything about this book, so it
+                # doesn't count as updated or as unchanged.
+                failed_books += 1
+                if checkpoint_limit is None:
+                    checkpoint_limit = position - 1
                 continue
-            license_pool, is_new, is_changed = self.api.update_licensepool(book)
+
+            license_pool, is_new, is_changed = self.api.apply_availability(
+                job.result
+            )
+            updated_books += 1
+            if not updated_books % 100:
+                self.log.info(
+                    "%s books processed (%.2f books/sec)", updated_books,
+                    self.throughput(updated_books, started)
+                )
             # Log a circulation event for this work.
             if is_new:
                 Analytics.collect_event(
                     _db, license_pool, CirculationEvent.DISTRIBUTOR_TITLE_ADD, license_pool.last_checked)
 
-            _db.commit()
+            uncommitted_books += 1
+            if uncommitted_books >= self.batch_size:
+                if self.checkpoint:
+                    if checkpoint_limit is None:
+                        self.checkpoint.save(start, position)
+                    else:
+                        self.checkpoint.save(start, checkpoint_limit)
+                _db.commit()
+                uncommitted_books = 0
+
+                # The collection token is good for an hour, and it's
+                # treated as expired a few minutes early, so if it's
+                # current now it'll last through the next batch.
+                self.api.check_creds()
 
             if is_changed:
                 consecutive_unchanged_books = 0
@@ -845,8 +1082,29 @@ class OverdriveCirculationMonitor(Monitor):
                                   consecutive_unchanged_books)
                     break
 
+        # If we stopped early, some requests may still be in flight.
+        # Let them finish before the run is marked complete; their
+        # results are thrown away.
+        for position, job in jobs:
+            job.wait()
+
+        if self.checkpoint:
+            self.checkpoint.clear()
+        _db.commit()
         if total_books:
-            self.log.info("Processed %d books total.", total_books)
+            self.log.info(
+                "Processed %d books total, updated %d, failed %d "
+                "(%.2f books/sec).",
+                total_books, updated_books, failed_books,
+                self.throughput(updated_books, started)
+            )
+
+    @classmethod
+    def throughput(cls, books, started):
+        elapsed = time.time() - started
+        if not elapsed:
+            return 0
+        return books / elapsed
 
 class FullOverdriveCollectionMonitor(OverdriveCirculationMonitor):
     """Monitor every single book in the Overdrive collection.
@@ -855,9 +1113,18 @@ class FullOverdriveCollectionMonitor(OverdriveCirculationMonitor):
     are not found in our collection.
     """
 
-    def __init__(self, _db, interval_seconds=3600*4):
+    # A run takes hours, so it's worth resuming one that was
+    # interrupted. Overdrive pages through the collection in a
+    # consistent order, so a resumed run skips the books that were
+    # already processed. (A book added to the collection in the
+    # meantime may push an unprocessed book into the skipped part of
+    # the list, but that book will be processed on the next run.)
+    RESUMABLE = True
+
+    def __init__(self, _db, interval_seconds=3600*4, **kwargs):
         super(FullOverdriveCollectionMonitor, self).__init__(
-            _db, "Overdrive Collection Overview", interval_seconds)
+            _db, "Overdrive Collection Overview", interval_seconds,
+            **kwargs)
 
     def recently_changed_ids(self, start, cutoff):
         """Ignore the dates and return all IDs."""
@@ -890,10 +1157,10 @@ class RecentOverdriveCollectionMonitor(OverdriveCirculationMonitor):
     """Monitor recently changed books in the Overdrive collection."""
 
     def __init__(self, _db, interval_seconds=60,
-                 maximum_consecutive_unchanged_books=100):
+                 maximum_consecutive_unchanged_books=100, **kwargs):
         super(RecentOverdriveCollectionMonitor, self).__init__(
             _db, "Reverse Chronological Overdrive Collection Monitor",
-            interval_seconds, maximum_consecutive_unchanged_books)
+            interval_seconds, maximum_consecutive_unchanged_books, **kwargs)
 
 class OverdriveFormatSweep(IdentifierSweepMonitor):
     """Check the current formats of every Overdrive book
@@ -4,7 +4,10 @@ from api.authenticator import (
     BasicAuthenticationProvider,
     PatronData,
 )
-from api.sip.client import SIPClient
+from api.sip.client import (
+    SIPClient,
+    SIPClientPool,
+)
 from core.util.http import RemoteIntegrationException
 from core.util import MoneyUtility
 
@@ -16,7 +19,8 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
 
     def __init__(self, server, port, login_user_id,
                  login_password, location_code, field_separator='|',
-                 client=None,
+                 client=None, connection_pool_size=5,
+                 keepalive_interval=60,
                  **kwargs):
         """An object capable of communicating with a SIP server.
 
@@ -47,23 +51,39 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
         :param client: A drop-in replacement for the SIPClient
         object. Only intended for use during testing.
 
+        :param connection_pool_size: Keep up to this many connections
+        open to the SIP server, so that several patrons can be
+        authenticated at once.
+
+        :param keepalive_interval: Send an SC Status message over any
+        connection that has been idle for this many seconds, so the
+        server doesn't close it.
         """
         super(SIP2AuthenticationProvider, self).__init__(**kwargs)
-        try:
-            if client:
-                if callable(client):
-                    client = client()
+        if client:
+            if callable(client):
+                create_client = client
             else:
-                client = SIPClient(
-                    target_server=server, target_port=port,
-                    login_user_id=login_user_id, login_password=login_password,
-                    location_code=location_code, separator=field_separator
-                )
+                # A single client instance can only be used by one
+                # thread at a time.
+                create_client = lambda: client
+                connection_pool_size = 1
+            keepalive_interval = None
+        else:
+            create_client = lambda: SIPClient(
+                target_server=server, target_port=port,
+                login_user_id=login_user_id, login_password=login_password,
+                location_code=location_code, separator=field_separator
+            )
+        try:
+            self.pool = SIPClientPool(
+                create_client, size=connection_pool_size,
+                keepalive_interval=keepalive_interval
+            )
         except IOError, e:
             raise RemoteIntegrationException(
                 server or 'unknown server', e.message
             )
-        self.client = client
 
     def remote_authenticate(self, username, password):
         """Authenticate a patron with the SIP2 server.
@@ -73,10 +93,11 @@ class SIP2AuthenticationProvider(BasicAuthenticationProvider):
         :param password: The patron's password/pin/access code.
         """
         try:
-            info = self.client.patron_information(username, password)
+            with self.pool.connection() as client:
+                info = client.patron_information(username, password)
         except IOError, e:
             raise RemoteIntegrationException(
-                self.client.target_server or 'unknown server',
+                self.pool.target_server or 'unknown server',
                 e.message
             )
         return self.info_to_patrondata(info)
@@ -25,6 +25,7 @@ limitations under the License.
 
 """
 
+import contextlib
 import datetime
 import logging
 from nose.tools import set_trace
@@ -77,6 +78,18 @@ fixed._add('recall_items_count', 4)
 fixed._add('unavailable_holds_count', 4)
 fixed._add('login_ok', 1)
 
+# Fields in the ACS Status message.
+fixed._add('online_status', 1)
+fixed._add('checkin_ok', 1)
+fixed._add('checkout_ok', 1)
+fixed._add('acs_renewal_policy', 1)
+fixed._add('status_update_ok', 1)
+fixed._add('offline_ok', 1)
+fixed._add('timeout_period', 3)
+fixed._add('retries_allowed', 3)
+fixed._add('date_time_sync', 18)
+fixed._add('protocol_version', 4)
+
 class named(object):
     """A variable-length field in a SIP2 response."""
     def __init__(self, internal_name, sip_code, required=False,
@@ -148,6 +161,9 @@ named._add("home_address", "BD")
 named._add("email_address", "BE")
 named._add("phone_number", "BF")
 named._add("sequence_number", "AY")
+named._add("library_name", "AM")
+named._add("supported_messages", "BX")
+named._add("terminal_location", "AN")
 
 # The spec doesn't say there can be more than one screen message,
 # but I have seen it happen.
@@ -178,7 +194,54 @@ class Constants(object):
     UNKNOWN_LANGUAGE = "000"
     ENGLISH = "001"
 
-    
+
+class SIPMessageReader(object):
+    """Split the data coming in over a socket into SIP2 messages.
+
+    Data is read into a preallocated chunk with recv_into() and
+    appended to a buffer, which is scanned for the \r that ends a
+    message. Only the newly arrived bytes are scanned each time, so
+    reading a large message takes time proportional to its size. Any
+    bytes that arrive after the end of a message are kept for the next
+    call.
+    """
+
+    TERMINATOR = '\r'
+
+    def __init__(self, recv_into, chunk_size=4096):
+        """Constructor.
+
+        :param recv_into: A function like socket.recv_into, which reads
+        data into a writable buffer and returns the number of bytes
+        read.
+        """
+        self.recv_into = recv_into
+        self.chunk = memoryview(bytearray(chunk_size))
+        self.buffer = bytearray()
+
+        # Everything in the buffer before this point has been checked
+        # for a terminator.
+        self.scanned = 0
+
+    def read_message(self, max_size=1024*1024):
+        """Read a single SIP2 message, including the \r that ends it."""
+        while True:
+            end = self.buffer.find(self.TERMINATOR, self.scanned)
+            if end != -1:
+                end += 1
+                message = str(self.buffer[:end])
+                del self.buffer[:end]
+                self.scanned = 0
+                return message
+            self.scanned = len(self.buffer)
+            if self.scanned > max_size:
+                raise IOError("SIP2 response too large.")
+            size = self.recv_into(self.chunk)
+            if not size:
+                raise IOError("No data read from socket.")
+            self.buffer += self.chunk[:size]
+
+
 class SIPClient(Constants):
 
     log = logging.getLogger("SIPClient")
@@ -235,6 +298,18 @@ class SIPClient(Constants):
             *args, **kwargs
         )
             
+    def sc_status(self, *args, **kwargs):
+        """Tell the SIP server we're still here, and find out how it's
+        doing.
+
+        This is mainly useful as a way of keeping an idle connection
+        alive.
+        """
+        return self.make_request(
+            self.sc_status_message, self.acs_status_parser,
+            *args, **kwargs
+        )
+
     def connect(self):
         """Create a socket connection to a SIP server."""
         with self.socket_lock:
@@ -245,8 +320,22 @@ class SIPClient(Constants):
             # and, potentially, logged_in.
             self.reset_connection_state()
             self.socket = sock
+            self.reader = SIPMessageReader(sock.recv_into)
         return sock
 
+    def disconnect(self):
+        """Close the socket connection to the SIP server, if any."""
+        with self.socket_lock:
+            sock = getattr(self, 'socket', None)
+            self.socket = None
+            self.reader = None
+            self.reset_connection_state()
+        if sock:
+            try:
+                sock.close()
+            except socket.error, e:
+                pass
+
     def reset_connection_state(self):
         """Reset connection-specific state.
 
@@ -340,6 +429,34 @@ class SIPClient(Constants):
             fixed.login_ok
         )
 
+    def sc_status_message(self, status_code="0", max_print_width="080",
+                          protocol_version="2.00"):
+        """Generate an SC Status message."""
+        return "99" + status_code + max_print_width + protocol_version
+
+    def acs_status_parser(self, message):
+        """Parse the response to an SC Status message."""
+        return self.parse_response(
+            message,
+            98,
+            fixed.online_status,
+            fixed.checkin_ok,
+            fixed.checkout_ok,
+            fixed.acs_renewal_policy,
+            fixed.status_update_ok,
+            fixed.offline_ok,
+            fixed.timeout_period,
+            fixed.retries_allowed,
+            fixed.date_time_sync,
+            fixed.protocol_version,
+            named.institution_id.required,
+            named.library_name,
+            named.supported_messages.required,
+            named.terminal_location,
+            named.screen_message,
+            named.print_line,
+        )
+
     def patron_information_request(
             self, patron_identifier, patron_password="", institution_id="",
             terminal_password="",
@@ -610,20 +727,7 @@ class SIPClient(Constants):
 
         A SIP2 message ends with a \r character.
         """
-        done = False
-        data = ""
-        tmp = ""
-        while not done:
-            tmp = self.socket.recv(4096)
-            data = data + tmp
-            if not data:
-                raise IOError("No data read from socket.")
-            if ord(data[-1]) == 13:
-                done = True
-            if len(data) > max_size:
-                raise IOError("SIP2 response too large.")
-
-        return data
+        return self.reader.read_message(max_size)
   
     def append_checksum(self, text, include_sequence_number=True):
         """Calculates checksum for passed-in message, and returns the message
@@ -667,6 +771,176 @@ class SIPClient(Constants):
         return text      
 
 
+class SIPClientPool(object):
+    """A pool of SIPClient objects, each with its own socket connection
+    and SIP session.
+
+    A SIPClient only sends one message at a time, so if every thread
+    shares one client, simultaneous patron authentications queue up
+    behind each other. Instead, each thread borrows a client from the
+    pool for the length of a request.
+
+    Idle clients are kept logged in by a background thread which
+    periodically sends them an SC Status message. A client that fails
+    that check, or has any trouble during a request, is closed and
+    replaced.
+    """
+
+    log = logging.getLogger("SIPClientPool")
+
+    def __init__(self, create_client, size=5, keepalive_interval=None,
+                 checkout_timeout=30):
+        """Constructor.
+
+        :param create_client: A function that creates and connects a
+        new SIPClient.
+
+        :param size: The maximum number of simultaneous connections.
+
+        :param keepalive_interval: Send an SC Status message over any
+        connection that has been idle for this many seconds. If this
+        is None, idle connections are left alone.
+
+        :param checkout_timeout: When every connection is in use, wait
+        this many seconds for one to free up before giving up.
+        """
+        self.create_client = create_client
+        self.size = size
+        self.keepalive_interval = keepalive_interval
+        self.checkout_timeout = checkout_timeout
+        self.condition = threading.Condition()
+
+        # A list of (SIPClient, time last used) 2-tuples, most recently
+        # used last.
+        self.idle = []
+
+        # The number of clients in existence, idle or not.
+        self.open_connections = 0
+
+        self.keepalive_thread = None
+
+        # Create the first client right away, so that a
+        # misconfiguration shows up immediately.
+        self.open_connections += 1
+        try:
+            client = self.create_client()
+        except Exception, e:
+            self.open_connections -= 1
+            raise
+        self.target_server = getattr(client, 'target_server', None)
+        self.checkin(client)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a client for the duration of a `with` block."""
+        client = self.checkout()
+        try:
+            yield client
+        except Exception, e:
+            # We don't know what state the connection is in, so it
+            # can't be reused.
+            self.discard(client)
+            raise
+        self.checkin(client)
+
+    def checkout(self):
+        """Take an idle client from the pool, creating one if necessary.
+
+        :raise IOError: If every client is busy and none frees up
+        within `checkout_timeout` seconds.
+        """
+        deadline = time.time() + self.checkout_timeout
+        client = None
+        with self.condition:
+            while True:
+                if self.idle:
+                    client, last_used = self.idle.pop()
+                    break
+                if self.open_connections < self.size:
+                    # We'll create a new client, outside the lock.
+                    self.open_connections += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise IOError(
+                        "Timed out waiting for a SIP2 connection."
+                    )
+                self.condition.wait(remaining)
+
+        if client is None:
+            try:
+                client = self.create_client()
+            except Exception, e:
+                with self.condition:
+                    self.open_connections -= 1
+                    self.condition.notify()
+                raise
+        self._ensure_keepalive()
+        return client
+
+    def checkin(self, client):
+        """Return a client to the pool so it can be reused."""
+        with self.condition:
+            self.idle.append((client, time.time()))
+            self.condition.notify()
+
+    def discard(self, client):
+        """Close a client and remove it from the pool."""
+        try:
+            client.disconnect()
+        except Exception, e:
+            self.log.warn("Error closing SIP2 connection: %s", e)
+        with self.condition:
+            self.open_connections -= 1
+            self.condition.notify()
+
+    def keepalive(self):
+        """Send an SC Status message over each connection that's been
+        idle for longer than `keepalive_interval`.
+
+        If the client needs to log in again, that happens here, rather
+        than during a patron's request.
+        """
+        cutoff = time.time() - self.keepalive_interval
+        with self.condition:
+            stale = [client for client, last_used in self.idle
+                     if last_used < cutoff]
+            self.idle = [(client, last_used)
+                         for client, last_used in self.idle
+                         if last_used >= cutoff]
+        for client in stale:
+            try:
+                client.sc_status(fail_on_network_error=True)
+            except Exception, e:
+                self.log.info("Discarding dead SIP2 connection: %s", e)
+                self.discard(client)
+                continue
+            self.checkin(client)
+
+    def _ensure_keepalive(self):
+        """Start the keepalive thread if it's not running."""
+        if not self.keepalive_interval:
+            return
+        if self.keepalive_thread and self.keepalive_thread.is_alive():
+            return
+        with self.condition:
+            if self.keepalive_thread and self.keepalive_thread.is_alive():
+                return
+            self.keepalive_thread = threading.Thread(
+                target=self._keepalive_loop, name="SIP2 keepalive"
+            )
+            self.keepalive_thread.daemon = True
+            self.keepalive_thread.start()
+
+    def _keepalive_loop(self):
+        while True:
+            time.sleep(self.keepalive_interval)
+            try:
+                self.keepalive()
+            except Exception, e:
+                self.log.error("Error in SIP2 keepalive: %s", e, exc_info=e)
+
+
 class MockSIPClient(SIPClient):
     """A SIP client that relies on canned responses rather than a socket
     connection.
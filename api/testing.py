@@ -50,6 +50,10 @@ class MockAdobeConfiguration(object):
         library.library_registry_short_name = cls.LIBRARY_REGISTRY_SHORT_NAME
         library.library_registry_shared_secret = cls.LIBRARY_REGISTRY_SHARED_SECRET
 
+        # AuthdataUtility.from_config() may be holding on to library
+        # information from a previous test.
+        AuthdataUtility._from_config = None
+
     @contextlib.contextmanager
     def temp_config(self):
         """Configure a basic Vendor ID Service setup."""
@@ -1,6 +1,7 @@
 from lxml import etree
 
 from cStringIO import StringIO
+from collections import deque
 import itertools
 import datetime
 import os
@@ -49,6 +50,9 @@ from core.threem import (
 
 from circulation_exceptions import *
 from core.analytics import Analytics
+from monitor import MonitorCheckpoint
+from util.http_client import PooledHTTPClient
+from util.worker_pool import WorkerPool
 
 class ThreeMAPI(BaseThreeMAPI, BaseCirculationAPI):
 
@@ -67,6 +71,16 @@ class ThreeMAPI(BaseThreeMAPI, BaseCirculationAPI):
         (Representation.MP3_MEDIA_TYPE, adobe_drm) : 'MP3'
     }
 
+    def __init__(self, *args, **kwargs):
+        super(ThreeMAPI, self).__init__(*args, **kwargs)
+        self.http_client = PooledHTTPClient.for_integration(
+            self.SERVICE_NAME
+        )
+
+    def _request_with_timeout(self, method, url, *args, **kwargs):
+        """Make an HTTP request over a pooled connection."""
+        return self.http_client.request(method, url, *args, **kwargs)
+
     def get_events_between(self, start, end, cache_result=False):
         """Return event objects for events between the given times."""
         start = start.strftime(self.ARGUMENT_TIME_FORMAT)
@@ -693,9 +707,15 @@ class ThreeMEventMonitor(Monitor):
 
     TWO_YEARS_AGO = datetime.timedelta(365*2)
 
+    # By default, fetch this many days' events at once.
+    DEFAULT_WORKERS = 5
+
+    # Never fetch more than this many days' events at once.
+    MAX_WORKERS = 10
+
     def __init__(self, _db, default_start_time=None,
                  account_id=None, library_id=None, account_key=None,
-                 cli_date=None, api=None):
+                 cli_date=None, api=None, workers=None):
         self.service_name = "3M Event Monitor"
         if not default_start_time:
             default_start_time = self.create_default_start_time(_db, cli_date)
@@ -707,6 +727,14 @@ class ThreeMEventMonitor(Monitor):
         self.bibliographic_coverage_provider = ThreeMBibliographicCoverageProvider(
             self._db, threem_api=self.api
         )
+        self.checkpoint = MonitorCheckpoint(self._db, self.service_name)
+        self.workers = max(
+            1, min(workers or self.DEFAULT_WORKERS, self.MAX_WORKERS)
+        )
+        if self.workers > 1:
+            self.pool = WorkerPool(self.workers, self.service_name)
+        else:
+            self.pool = None
 
     def create_default_start_time(self, _db, cli_date):
         """Sets the default start time if it's passed as an argument.
@@ -751,26 +779,108 @@ class ThreeMEventMonitor(Monitor):
             yield slice_start, slice_cutoff, full_slice
             slice_start = slice_start + increment
 
+    def slices_with_events(self, slices):
+        """Arrange for the events in each of `slices` to be retrieved.
+
+        :yield: A 4-tuple (start, cutoff, full_slice, get_events) for
+        each slice, in order. get_events() returns a list of the
+        events in the slice.
+
+        If there's more than one worker, upcoming slices are fetched
+        and parsed in worker threads while the caller is handling
+        events from earlier slices. Responses fetched this way aren't
+        cached, since caching a response uses the database. (The
+        checkpoint in run_once doesn't rely on getting the same
+        response as last time, so this is safe.)
+        """
+        if not self.pool:
+            for start, cutoff, full_slice in slices:
+                get_events = (
+                    lambda start=start, cutoff=cutoff, full_slice=full_slice:
+                    self.api.get_events_between(start, cutoff, full_slice)
+                )
+                yield start, cutoff, full_slice, get_events
+            return
+
+        def fetch(start, cutoff):
+            return list(self.api.get_events_between(start, cutoff))
+
+        def wait_for(job):
+            job.wait()
+            if job.exception:
+                raise job.exc_info[0], job.exc_info[1], job.exc_info[2]
+            return job.result
+
+        slices = iter(slices)
+        jobs = deque()
+        while True:
+            # Keep the worker threads busy with upcoming slices.
+            while slices is not None and len(jobs) < self.workers * 2:
+                try:
+                    start, cutoff, full_slice = next(slices)
+                except StopIteration:
+                    slices = None
+                    break
+                job = self.pool.submit(fetch, start, cutoff)
+                jobs.append((start, cutoff, full_slice, job))
+            if not jobs:
+                return
+            start, cutoff, full_slice, job = jobs.popleft()
+            yield start, cutoff, full_slice, lambda job=job: wait_for(job)
+
     def run_once(self, start, cutoff):
+        """Handle events one day at a time.
+
+        Days are handled in order, although upcoming days' events may
+        be fetched in the background (see slices_with_events).
+
+        The monitor's timestamp is committed as soon as a day's events
+        have been handled. Within a day, a checkpoint is committed
+        every 1000 events, so that if the monitor is interrupted it
+        won't handle the earlier events again.
+        """
         added_books = 0
         i = 0
         one_day = datetime.timedelta(days=1)
-        for start, cutoff, full_slice in self.slice_timespan(
-                start, cutoff, one_day):
+        slices = self.slices_with_events(
+            self.slice_timespan(start, cutoff, one_day)
+        )
+        for start, cutoff, full_slice, get_events in slices:
             most_recent_timestamp = start
             self.log.info("Asking for events between %r and %r", start, cutoff)
+
+            # Events are handled in the order they happened. The
+            # checkpoint records how many seconds into the slice the
+            # last event we handled happened, so a restarted run can
+            # skip the events before that no matter what order 3M
+            # sends them in. Events from that second are handled
+            # again, which does no harm, since handling an event
+            # twice doesn't log it twice.
+            resume_from = None
+            position = self.checkpoint.position(start)
+            if position:
+                resume_from = start + datetime.timedelta(seconds=position)
+                self.log.info("Resuming from %r.", resume_from)
             try:
                 event = None
-                events = self.api.get_events_between(start, cutoff, full_slice)
+                # Each event is (threem_id, isbn, foreign_patron_id,
+                # start_time, end_time, internal_event_type).
+                events = sorted(get_events(), key=lambda event: event[3])
                 for event in events:
+                    if resume_from and event[3] and event[3] < resume_from:
+                        continue
                     event_timestamp = self.handle_event(*event)
                     if (not most_recent_timestamp or
                         (event_timestamp > most_recent_timestamp)):
                         most_recent_timestamp = event_timestamp
                     i += 1
                     if not i % 1000:
+                        if event_timestamp:
+                            self.checkpoint.save(
+                                start,
+                                int((event_timestamp - start).total_seconds())
+                            )
                         self._db.commit()
-                self._db.commit()
             except Exception, e:
                 if event:
                     self.log.error(
@@ -784,6 +894,8 @@ class ThreeMEventMonitor(Monitor):
                     )
                 raise e
             self.timestamp.timestamp = most_recent_timestamp
+            self.checkpoint.clear()
+            self._db.commit()
         self.log.info("Handled %d events total", i)
         return most_recent_timestamp
 
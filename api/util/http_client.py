@@ -0,0 +1,179 @@
+from nose.tools import set_trace
+import logging
+import os
+import time
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from core.util.http import (
+    BadResponseException,
+    RequestNetworkException,
+    RequestTimedOut,
+)
+
+
+class PooledHTTPClient(object):
+    """An HTTP client for talking to a single integration (a
+    distributor, an ILS, an OAuth provider), which keeps connections
+    alive between requests instead of opening a new one every time.
+
+    Timeouts, network errors and bad responses are handled the same
+    way as in HTTP.request_with_timeout: a request times out after
+    DEFAULT_TIMEOUT seconds unless told otherwise, network problems
+    become RemoteIntegrationExceptions, and a 5xx response (or any
+    response not in `allowed_response_codes`) raises
+    BadResponseException.
+    """
+
+    # A request times out after this many seconds unless a `timeout`
+    # is given.
+    DEFAULT_TIMEOUT = 20
+
+    # Keep connection pools for at most this many hosts.
+    POOL_CONNECTIONS = 10
+
+    # Keep at most this many connections open to any one host. A
+    # request that needs a connection while this many are in use
+    # waits for one to be freed.
+    CONNECTIONS_PER_HOST = 10
+
+    _clients = {}
+    _clients_lock = Lock()
+
+    @classmethod
+    def for_integration(cls, name, **kwargs):
+        """Find the client shared by everything in this process that
+        talks to the named integration, creating it if necessary.
+
+        :param kwargs: Passed into the constructor if a new client
+        is created; ignored otherwise.
+        """
+        with cls._clients_lock:
+            client = cls._clients.get(name)
+            if client is None:
+                client = cls(name, **kwargs)
+                cls._clients[name] = client
+            return client
+
+    def __init__(self, name, pool_connections=None,
+                 connections_per_host=None, timing_hooks=None):
+        """Constructor.
+
+        :param name: The name of the integration, used in log messages
+        and passed into timing hooks.
+        :param pool_connections: Keep connection pools for at most
+        this many hosts.
+        :param connections_per_host: Keep at most this many
+        connections open to any one host.
+        :param timing_hooks: A list of callables, each of which is
+        called after every request as hook(client, method, url,
+        response, elapsed). `response` is None if the request raised
+        an exception.
+        """
+        self.name = name
+        self.pool_connections = pool_connections or self.POOL_CONNECTIONS
+        self.connections_per_host = (
+            connections_per_host or self.CONNECTIONS_PER_HOST
+        )
+        self.timing_hooks = list(timing_hooks or [])
+        self.log = logging.getLogger("HTTP client (%s)" % name)
+        self._lock = Lock()
+        self._session = None
+        self._session_pid = None
+
+    def add_timing_hook(self, hook):
+        self.timing_hooks.append(hook)
+
+    @property
+    def session(self):
+        """The requests.Session used to make requests.
+
+        Open connections can't be shared with a forked process, so
+        each process gets its own session.
+        """
+        pid = os.getpid()
+        if self._session is None or self._session_pid != pid:
+            with self._lock:
+                if self._session is None or self._session_pid != pid:
+                    self._session = self._create_session()
+                    self._session_pid = pid
+        return self._session
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.connections_per_host,
+            pool_block=True,
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def request(self, http_method, url, *args, **kwargs):
+        """Make an HTTP request over a pooled connection.
+
+        Arguments are the same as for HTTP.request_with_timeout.
+
+        :param allowed_response_codes: If this is provided, a response
+        with any other status code raises BadResponseException. Codes
+        may be given as integers or as a series like "2xx".
+        :param disallowed_response_codes: A response with any of these
+        status codes raises BadResponseException.
+        """
+        allowed = kwargs.pop('allowed_response_codes', None)
+        disallowed = kwargs.pop('disallowed_response_codes', None)
+        kwargs.setdefault('timeout', self.DEFAULT_TIMEOUT)
+        start = time.time()
+        response = None
+        try:
+            try:
+                response = self.session.request(
+                    http_method, url, *args, **kwargs
+                )
+            except requests.exceptions.Timeout, e:
+                raise RequestTimedOut(url, e.message)
+            except requests.exceptions.RequestException, e:
+                raise RequestNetworkException(url, e.message)
+            if not self._status_code_ok(
+                    response.status_code, allowed, disallowed):
+                bad_response = response
+                response = None
+                raise BadResponseException.bad_status_code(url, bad_response)
+            return response
+        finally:
+            self._timed(http_method, url, response, time.time() - start)
+
+    @classmethod
+    def _status_code_ok(cls, status_code, allowed, disallowed):
+        series = "%sxx" % (status_code // 100)
+        if allowed:
+            return status_code in allowed or series in allowed
+        if disallowed and (status_code in disallowed
+                           or series in disallowed):
+            return False
+        return series != "5xx"
+
+    def get(self, url, *args, **kwargs):
+        return self.request("GET", url, *args, **kwargs)
+
+    def post(self, url, payload, *args, **kwargs):
+        kwargs['data'] = payload
+        return self.request("POST", url, *args, **kwargs)
+
+    def _timed(self, http_method, url, response, elapsed):
+        for hook in self.timing_hooks:
+            try:
+                hook(self, http_method, url, response, elapsed)
+            except Exception, e:
+                self.log.error("Error in timing hook: %s", e, exc_info=e)
+
+    def close(self):
+        """Close every open connection."""
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self._session_pid = None
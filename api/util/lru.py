@@ -0,0 +1,105 @@
+from nose.tools import set_trace
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class ExpiringLRUCache(object):
+    """A dictionary that can be shared between threads, which holds at
+    most `max_size` entries, discarding the least recently used, and
+    which forgets an entry once it's older than its time-to-live.
+    """
+
+    def __init__(self, max_size, ttl=None, on_discard=None):
+        """Constructor.
+
+        :param max_size: Keep at most this many entries.
+        :param ttl: By default, an entry is good for this many
+        seconds. If this is None, entries don't expire.
+        :param on_discard: A callable that's called as
+        on_discard(key, value) whenever an entry is discarded to make
+        room for another. It's called while the cache is locked, so it
+        must not use the cache.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_discard = on_discard
+
+        # Maps each key to a 2-tuple (expiration time, value), in
+        # order from least to most recently used.
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """Find the value for `key`, and mark it as the most recently
+        used.
+
+        :return: The value, or `default` if there is no value or it
+        has expired.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires is not None and expires < time.time():
+                return default
+            self._entries[key] = entry
+            return value
+
+    def put(self, key, value, ttl=None):
+        """Store a value for `key`.
+
+        :param ttl: The value is good for this many seconds. If this
+        is None, the cache's default is used.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        if ttl is None:
+            expires = None
+        else:
+            expires = time.time() + ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.max_size:
+                discarded_key, (ignore, discarded) = self._entries.popitem(
+                    last=False
+                )
+                if self.on_discard:
+                    self.on_discard(discarded_key, discarded)
+
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def remove_where(self, condition):
+        """Remove every entry for which condition(key, value) is true."""
+        with self._lock:
+            for key, (expires, value) in self._entries.items():
+                if condition(key, value):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def keys(self):
+        """:return: A list of keys, least recently used first. Expired
+        entries that haven't been cleaned up yet are included.
+        """
+        with self._lock:
+            return self._entries.keys()
+
+    def values(self):
+        """:return: A list of values, least recently used first. Expired
+        entries that haven't been cleaned up yet are included.
+        """
+        with self._lock:
+            return [value for expires, value in self._entries.values()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,164 @@
+from nose.tools import set_trace
+import logging
+import sys
+import time
+from Queue import Queue
+from threading import (
+    Event,
+    Lock,
+    Thread,
+)
+
+
+class Job(object):
+    """A unit of work to be run by a WorkerPool.
+
+    Once the job has run, exactly one of `result` and `exception` will
+    be meaningful.
+    """
+
+    def __init__(self, f, *args, **kwargs):
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.exception = None
+        self.exc_info = None
+        self.started_at = None
+        self.finished_at = None
+        self.callbacks = []
+        self._ran = False
+        self._lock = Lock()
+        self._finished = Event()
+        self.log = logging.getLogger("Worker pool job")
+
+    def run(self):
+        self.started_at = time.time()
+        try:
+            self.result = self.f(*self.args, **self.kwargs)
+        except Exception, e:
+            self.exception = e
+            self.exc_info = sys.exc_info()
+        finally:
+            self.finished_at = time.time()
+            with self._lock:
+                self._ran = True
+                callbacks = list(self.callbacks)
+            for callback in callbacks:
+                self._call(callback)
+            self._finished.set()
+
+    def add_done_callback(self, callback):
+        """Arrange for callback(job) to be called once the job has run.
+
+        The callback is called in the worker thread, before anyone
+        waiting on the job is released. If the job has already run,
+        the callback is called immediately, in this thread.
+        """
+        with self._lock:
+            if not self._ran:
+                self.callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception, e:
+            self.log.error(
+                "Error in callback for %r: %s", self.f, e, exc_info=e
+            )
+
+    @property
+    def done(self):
+        return self._finished.is_set()
+
+    @property
+    def elapsed(self):
+        """How long the job took to run, in seconds."""
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def wait(self, timeout=None):
+        """Wait for the job to finish.
+
+        :param timeout: Give up after this many seconds. If this is
+        None, wait forever.
+
+        :return: True if the job finished, False if we gave up.
+        """
+        self._finished.wait(timeout)
+        return self.done
+
+
+class WorkerPool(object):
+    """A fixed number of daemon threads which run Jobs from a shared
+    queue.
+
+    The threads are started the first time a job is submitted and are
+    reused from then on, so callers don't pay for thread creation on
+    every request.
+    """
+
+    def __init__(self, size, name="Worker pool"):
+        if size < 1:
+            raise ValueError("A WorkerPool needs at least one thread.")
+        self.size = size
+        self.name = name
+        self.queue = Queue()
+        self.threads = []
+        self.lock = Lock()
+        self.log = logging.getLogger(name)
+
+    def submit(self, f, *args, **kwargs):
+        """Arrange for f(*args, **kwargs) to be called in a worker thread.
+
+        :return: A Job that can be used to wait for the result.
+        """
+        job = Job(f, *args, **kwargs)
+        self._ensure_threads()
+        self.queue.put(job)
+        return job
+
+    def _ensure_threads(self):
+        with self.lock:
+            # Threads don't survive a fork, so a pool inherited from a
+            # parent process may need to be restarted.
+            self.threads = [x for x in self.threads if x.is_alive()]
+            while len(self.threads) < self.size:
+                thread = Thread(
+                    target=self._work,
+                    name="%s %d" % (self.name, len(self.threads))
+                )
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def shutdown(self):
+        """Stop the worker threads once they've run every job already
+        submitted, and wait for them to finish.
+
+        If another job is submitted later, new threads are started.
+        """
+        with self.lock:
+            threads = self.threads
+            self.threads = []
+            for thread in threads:
+                # Each thread stops when it gets a None.
+                self.queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            try:
+                job.run()
+            except Exception, e:
+                self.log.error("Error running job: %s", e, exc_info=e)
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,58 @@
+"""Time how long SIPClient takes to read SIP2 responses of various
+sizes.
+
+The responses come from a local socket pair rather than a real SIP
+server, so this measures only the client's own framing overhead.
+"""
+from pdb import set_trace
+import socket
+import threading
+import time
+import numpy
+
+from api.sip.client import (
+    SIPClient,
+    SIPMessageReader,
+)
+
+class LocalSIPClient(SIPClient):
+    """A SIPClient that reads from one end of a socket pair."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        super(LocalSIPClient, self).__init__(None, None)
+
+    def connect(self):
+        self.reset_connection_state()
+        self.socket = self.sock
+        self.reader = SIPMessageReader(self.sock.recv_into)
+
+def feed(sock, message, repetitions):
+    for i in range(repetitions):
+        sock.sendall(message)
+
+sizes = [1024, 16*1024, 128*1024, 1024*1024]
+repetitions = 20
+
+for size in sizes:
+    client_sock, server_sock = socket.socketpair()
+    client = LocalSIPClient(client_sock)
+    message = "64" + ("x" * (size-3)) + "\r"
+    writer = threading.Thread(
+        target=feed, args=(server_sock, message, repetitions)
+    )
+    writer.start()
+
+    elapsed = []
+    for i in range(repetitions):
+        a = time.time()
+        response = client.read_message(max_size=size*2)
+        elapsed.append(time.time()-a)
+        assert response == message
+    writer.join()
+    client_sock.close()
+    server_sock.close()
+
+    print "%8d bytes: mean %.5fs, median %.5fs, max %.5fs" % (
+        size, numpy.mean(elapsed), numpy.median(elapsed), numpy.max(elapsed)
+    )
@@ -0,0 +1,51 @@
+"""Compare the time it takes to build the per-entry URLs for a
+100-entry OPDS feed with url_for() and with URLTemplates.
+"""
+from pdb import set_trace
+import os
+import time
+from flask import url_for
+
+os.environ['AUTOINITIALIZE'] = "False"
+from api.app import app
+from api.opds import URLTemplates
+
+entries = 100
+repetitions = 20
+
+def entry_urls(url_for, i):
+    """Build the URLs CirculationManagerAnnotator puts in one entry."""
+    args = dict(data_source="Overdrive", identifier_type="Overdrive ID",
+                identifier="%08d-abcd-ef01-2345-6789abcdef01" % i,
+                _external=True)
+    url_for('permalink', **args)
+    url_for('report', **args)
+    url_for('related_books', **args)
+    url_for('revoke_loan_or_hold', **args)
+    url_for('borrow', mechanism_id=None, **args)
+    url_for('fulfill', mechanism_id=i % 5, **args)
+    del args['data_source']
+    url_for('annotations_for_work', **args)
+
+def time_feed(url_for):
+    elapsed = []
+    for i in range(repetitions):
+        a = time.time()
+        for j in range(entries):
+            entry_urls(url_for, j)
+        elapsed.append(time.time()-a)
+    return sum(elapsed) / len(elapsed)
+
+with app.test_request_context("/"):
+    templates = URLTemplates()
+
+    # Make sure the templates give the same results as url_for.
+    for j in range(entries):
+        entry_urls(URLTemplates(verify=True).url_for, j)
+
+    plain = time_feed(url_for)
+    templated = time_feed(templates.url_for)
+
+print "%d-entry feed, mean of %d runs" % (entries, repetitions)
+print "url_for:       %.4fs" % plain
+print "URLTemplates:  %.4fs" % templated
@@ -12,11 +12,14 @@ import time
 import urlparse
 import logging
 import argparse
+import multiprocessing
+from Queue import Empty
 
 from sqlalchemy import (
     or_,
     func,
 )
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import (
     contains_eager, 
     defer
@@ -49,6 +52,7 @@ from core.model import (
     LicensePool,
     LicensePoolDeliveryMechanism,
     Loan,
+    production_session,
     Representation,
     Subject,
     Timestamp,
@@ -280,38 +284,205 @@ class UpdateStaffPicksScript(Script):
         return StringIO(representation.content)
 
 class LaneSweeperScript(Script):
-    """Do something to each lane in the application."""
+    """Do something to each lane in the application.
 
-    def __init__(self, _db=None, testing=False):
+    Lanes can be divided among a number of worker processes, each with
+    its own database session and request context, and the whole sweep
+    can be limited to a certain amount of time.
+    """
+
+    # Report timing for this many of the slowest lanes.
+    SLOWEST_LANES_REPORTED = 10
+
+    def __init__(self, _db=None, testing=False, workers=1, max_time=None):
+        """Constructor.
+
+        :param workers: Divide the lanes among this many processes.
+        :param max_time: Don't start processing a lane once this many
+        seconds have passed since the sweep began.
+        """
         super(LaneSweeperScript, self).__init__(_db)
+        self.testing = testing
+        self.workers = workers
+        self.max_time = max_time
+        self.setup_app()
+        self.base_url = Configuration.integration_url(
+            Configuration.CIRCULATION_MANAGER_INTEGRATION, required=True
+        )
+
+    def setup_app(self):
+        """Set up a web application that uses this script's database
+        session.
+        """
         os.environ['AUTOINITIALIZE'] = "False"
         from api.app import app
         del os.environ['AUTOINITIALIZE']
-        app.manager = CirculationManager(self._db, testing=testing)
+        app.manager = CirculationManager(self._db, testing=self.testing)
         self.app = app
-        self.base_url = Configuration.integration_url(
-            Configuration.CIRCULATION_MANAGER_INTEGRATION, required=True
-        )
 
-    def run(self):
-        begin = time.time()
-        client = self.app.test_client()
-        ctx = self.app.test_request_context(base_url=self.base_url)
-        ctx.push()
+    def lanes(self):
+        """Find every lane that should be processed, in breadth-first
+        order.
+        """
+        lanes = []
         queue = [self.app.manager.top_level_lane]
         while queue:
             new_queue = []
             self.log.debug("Beginning of loop: %d lanes to process", len(queue))
             for l in queue:
                 if self.should_process_lane(l):
-                    self.process_lane(l)
-                    self._db.commit()
+                    lanes.append(l)
                 for sublane in l.sublanes:
                     new_queue.append(sublane)
             queue = new_queue
-        ctx.pop()
+        return lanes
+
+    def run(self):
+        begin = time.time()
+        deadline = None
+        if self.max_time:
+            deadline = begin + self.max_time
+        ctx = self.app.test_request_context(base_url=self.base_url)
+        ctx.push()
+        lanes = self.lanes()
+        if self.workers > 1 and len(lanes) > 1:
+            ctx.pop()
+            timings = self.process_lanes_in_parallel(len(lanes), deadline)
+        else:
+            timings = self.process_lanes(lanes, deadline)
+            ctx.pop()
         end = time.time()
+
+        if len(timings) < len(lanes):
+            # Either we ran out of time, or there were errors, which
+            # have already been logged.
+            self.log.warn(
+                "Only %d of %d lanes were processed.",
+                len(timings), len(lanes)
+            )
+        slowest = sorted(timings, key=lambda x: x[1], reverse=True)
+        for lane_key, elapsed in slowest[:self.SLOWEST_LANES_REPORTED]:
+            self.log.info("%s took %.2fsec", lane_key, elapsed)
         self.log.info("Entire process took %.2fsec", (end-begin))
+        return timings
+
+    def process_lanes(self, lanes, deadline=None):
+        """Process lanes one at a time, in this process.
+
+        :return: A list of (lane key, seconds taken) 2-tuples, one for
+        every lane that was processed before the deadline.
+        """
+        timings = []
+        for lane in lanes:
+            if deadline and time.time() > deadline:
+                break
+            timings.append(self.process_and_time_lane(lane))
+        return timings
+
+    def process_and_time_lane(self, lane):
+        a = time.time()
+        self.process_lane(lane)
+        self._db.commit()
+        elapsed = time.time() - a
+        lane_key = "%s/%s" % (lane.language_key, lane.name)
+        self.log.debug("Processed %s in %.2fsec", lane_key, elapsed)
+        return lane_key, elapsed
+
+    def process_lanes_in_parallel(self, lane_count, deadline=None):
+        """Divide lanes among worker processes.
+
+        Lanes are handed out one at a time, so a worker that gets a
+        slow lane doesn't hold up the others.
+
+        :return: A list of (lane key, seconds taken) 2-tuples.
+        """
+        tasks = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        for index in range(lane_count):
+            tasks.put(index)
+        self.release_database_connections()
+        processes = []
+        for i in range(min(self.workers, lane_count)):
+            # Every worker stops when it gets a None.
+            tasks.put(None)
+            process = multiprocessing.Process(
+                target=self.work, args=(tasks, results, deadline),
+                name="%s worker %d" % (self.__class__.__name__, i)
+            )
+            process.start()
+            processes.append(process)
+
+        timings = []
+        finished = 0
+        while finished < len(processes):
+            try:
+                result = results.get(timeout=1)
+            except Empty:
+                if not any(x.is_alive() for x in processes):
+                    self.log.error("Worker processes died unexpectedly.")
+                    break
+                continue
+            if result is None:
+                finished += 1
+            else:
+                timings.append(result)
+        for process in processes:
+            process.join()
+        return timings
+
+    def release_database_connections(self):
+        """Close this process's database connections before forking.
+
+        Otherwise a worker process would inherit the connections, and
+        when it cleaned them up it would send messages (such as a
+        ROLLBACK) over sockets that belong to this process. A
+        connection is opened again the next time this process uses
+        the database.
+        """
+        bind = self._db.get_bind()
+        if isinstance(bind, Engine):
+            self._db.close()
+            bind.dispose()
+
+    def setup_worker(self):
+        """Prepare a newly forked worker process to process lanes."""
+        # A forked process can't use its parent's database
+        # connection, or anything that depends on it.
+        self._session = production_session()
+        self.setup_app()
+
+    def work(self, tasks, results, deadline):
+        """Process lanes in a worker process until told to stop.
+
+        :param tasks: A queue of lanes, identified by their position
+        in lanes().
+        :param results: A queue which will receive a (lane key,
+        seconds taken) 2-tuple for each lane processed, and a None
+        when this worker stops.
+        """
+        try:
+            self.setup_worker()
+            ctx = self.app.test_request_context(base_url=self.base_url)
+            ctx.push()
+            lanes = self.lanes()
+            while True:
+                index = tasks.get()
+                if index is None:
+                    break
+                if deadline and time.time() > deadline:
+                    continue
+                lane = lanes[index]
+                try:
+                    results.put(self.process_and_time_lane(lane))
+                except Exception, e:
+                    self.log.error(
+                        "Error processing %s/%s: %s", lane.language_key,
+                        lane.name, e, exc_info=e
+                    )
+                    self._db.rollback()
+            ctx.pop()
+        finally:
+            results.put(None)
 
     def should_process_lane(self, lane):
         return True
@@ -344,6 +515,18 @@ class CacheRepresentationPerLane(LaneSweeperScript):
             type=int,
             default=1
         )
+        parser.add_argument(
+            '--workers',
+            help='Divide the lanes among this many processes.',
+            type=int,
+            default=1
+        )
+        parser.add_argument(
+            '--max-time',
+            help="Don't start on a new lane once this many seconds have passed.",
+            type=int,
+            default=None
+        )
         return parser
 
     def __init__(self, _db=None, cmd_args=None, *args, **kwargs):
@@ -363,6 +546,8 @@ class CacheRepresentationPerLane(LaneSweeperScript):
                     self.log.warn("Ignored unrecognized language code %s", alpha)
         self.max_depth = parsed.max_depth
         self.min_depth = parsed.min_depth
+        self.workers = max(parsed.workers, 1)
+        self.max_time = parsed.max_time
 
         # Return the parsed arguments in case a subclass needs to
         # process more args.
@@ -418,6 +603,18 @@ class CacheRepresentationPerLane(LaneSweeperScript):
             "Generating feed(s) for %s", lane_key
         )
         cached_feeds = list(self.do_generate(lane))
+
+        # Compress each feed now, so that the web application doesn't
+        # have to do it when serving the feed. This may be happening
+        # in a worker process, and the web application is a different
+        # process anyway, so the compressed copies are only useful if
+        # they can be written to the directory the web application
+        # reads from.
+        compressed_feeds = self.app.manager.compressed_feeds
+        if compressed_feeds.directory:
+            for cached_feed in cached_feeds:
+                if cached_feed and cached_feed.content:
+                    compressed_feeds.store(cached_feed.content)
         b = time.time()
         total_size = sum(len(x.content) for x in cached_feeds if x)
         self.log.info(
@@ -144,6 +144,23 @@ class TestSIP2AuthenticationProvider(object):
             "username", "password",
         )
         
+    def test_connection_pool(self):
+        # A client class is used to create as many connections as
+        # the pool allows.
+        provider = SIP2AuthenticationProvider(
+            None, None, None, None, None, client=MockSIPClient,
+            connection_pool_size=3
+        )
+        eq_(3, provider.pool.size)
+        eq_(None, provider.pool.keepalive_interval)
+
+        # A client instance can only be used by one thread at a time.
+        provider = SIP2AuthenticationProvider(
+            None, None, None, None, None, client=MockSIPClient(),
+            connection_pool_size=3
+        )
+        eq_(1, provider.pool.size)
+
     def test_parse_date(self):
         parse = SIP2AuthenticationProvider.parse_date
         eq_(datetime(2011, 1, 2), parse("20110102"))
@@ -10,6 +10,8 @@ from api.sip.client import (
     CannotReceiveMockSIPClient,
     CannotSendMockSIPClient,
     MockSIPClient,
+    SIPClientPool,
+    SIPMessageReader,
 )
 
 class TestBasicProtocol(object):
@@ -240,3 +242,160 @@ class TestPatronResponse(object):
         assert with_password.endswith(
             'AApatron_identifier|AC|ADpatron_password'
         )
+
+
+class MockSocket(object):
+    """Hands out canned data in whatever size pieces it's told to."""
+
+    def __init__(self, *pieces):
+        self.pieces = list(pieces)
+
+    def recv_into(self, buffer):
+        if not self.pieces:
+            return 0
+        piece = self.pieces.pop(0)
+        if len(piece) > len(buffer):
+            # Only part of this piece fits; the rest will be
+            # delivered next time.
+            self.pieces.insert(0, piece[len(buffer):])
+            piece = piece[:len(buffer)]
+        buffer[:len(piece)] = piece
+        return len(piece)
+
+
+class TestSIPMessageReader(object):
+
+    def test_message_in_one_piece(self):
+        reader = SIPMessageReader(MockSocket("941AY0AZFDFC\r").recv_into)
+        eq_("941AY0AZFDFC\r", reader.read_message())
+
+    def test_message_split_across_reads(self):
+        socket = MockSocket("94", "1AY0", "AZFDFC", "\r")
+        reader = SIPMessageReader(socket.recv_into)
+        eq_("941AY0AZFDFC\r", reader.read_message())
+
+    def test_message_larger_than_chunk(self):
+        message = "64" + ("x" * 100) + "\r"
+        reader = SIPMessageReader(MockSocket(message).recv_into, chunk_size=7)
+        eq_(message, reader.read_message())
+
+    def test_leftover_bytes_kept_for_next_message(self):
+        socket = MockSocket("941AY0AZFDFC\r941A", "Y1AZFDFB\r")
+        reader = SIPMessageReader(socket.recv_into)
+        eq_("941AY0AZFDFC\r", reader.read_message())
+        eq_("941AY1AZFDFB\r", reader.read_message())
+
+    def test_connection_closed(self):
+        reader = SIPMessageReader(MockSocket("941AY0").recv_into)
+        assert_raises(IOError, reader.read_message)
+
+    def test_message_too_large(self):
+        socket = MockSocket("x" * 100)
+        reader = SIPMessageReader(socket.recv_into, chunk_size=10)
+        assert_raises(IOError, reader.read_message, max_size=50)
+
+
+class TestSCStatus(object):
+
+    def test_sc_status_message(self):
+        sip = MockSIPClient()
+        eq_("9900802.00", sip.sc_status_message())
+
+    def test_acs_status_response(self):
+        sip = MockSIPClient()
+        sip.queue_response("98YYYNYN01000320170406    1200002.00AOinstitution|AMSome Library|BXYYYYYYYYYYYYYYYY|AY1AZE1D1")
+        response = sip.sc_status()
+        eq_("Y", response['online_status'])
+        eq_("N", response['acs_renewal_policy'])
+        eq_("010", response['timeout_period'])
+        eq_("003", response['retries_allowed'])
+        eq_("2.00", response['protocol_version'])
+        eq_("Some Library", response['library_name'])
+        eq_("YYYYYYYYYYYYYYYY", response['supported_messages'])
+
+
+class TestSIPClientPool(object):
+
+    def setup(self):
+        self.created = []
+        def create_client():
+            client = MockSIPClient()
+            self.created.append(client)
+            return client
+        self.create_client = create_client
+
+    def test_first_client_created_immediately(self):
+        pool = SIPClientPool(self.create_client, size=2)
+        eq_(1, len(self.created))
+        eq_(1, pool.open_connections)
+
+        # The client that was created is the one handed out.
+        eq_(self.created[0], pool.checkout())
+
+    def test_connect_error_raised_from_constructor(self):
+        def cannot_connect():
+            raise IOError("Doom!")
+        assert_raises(IOError, SIPClientPool, cannot_connect)
+
+    def test_clients_are_reused(self):
+        pool = SIPClientPool(self.create_client, size=2)
+        with pool.connection() as client1:
+            pass
+        with pool.connection() as client2:
+            pass
+        eq_(client1, client2)
+        eq_(1, len(self.created))
+
+    def test_busy_pool_creates_new_clients_up_to_size(self):
+        pool = SIPClientPool(self.create_client, size=2, checkout_timeout=0)
+        client1 = pool.checkout()
+        client2 = pool.checkout()
+        assert client1 != client2
+        eq_(2, pool.open_connections)
+
+        # The pool is full, and no client frees up in time.
+        assert_raises(IOError, pool.checkout)
+
+        pool.checkin(client1)
+        eq_(client1, pool.checkout())
+
+    def test_client_discarded_after_error(self):
+        pool = SIPClientPool(self.create_client, size=2)
+        try:
+            with pool.connection() as client:
+                raise IOError("Doom!")
+        except IOError, e:
+            pass
+        eq_(0, pool.open_connections)
+        eq_([], pool.idle)
+
+        # The next request gets a brand new client.
+        with pool.connection() as new_client:
+            assert new_client != client
+
+    def test_keepalive(self):
+        pool = SIPClientPool(self.create_client, size=2, keepalive_interval=60)
+        healthy = self.created[0]
+        dead = CannotSendMockSIPClient()
+        pool.checkin(dead)
+        pool.open_connections += 1
+        healthy.queue_response("98YYYNYN01000320170406    1200002.00AOinstitution|BXYYYYYYYYYYYYYYYY|AY1AZE1D1")
+
+        # Neither client has been idle long enough to need a keepalive.
+        pool.keepalive()
+        eq_([], healthy.requests)
+        eq_(2, len(pool.idle))
+
+        # Now they both have.
+        pool.idle = [(client, 0) for client, last_used in pool.idle]
+        pool.keepalive()
+
+        # The healthy client was sent an SC Status message and put back
+        # in the pool, with a new last-used time.
+        assert healthy.requests[0].startswith("99")
+        [(client, last_used)] = pool.idle
+        eq_(healthy, client)
+        assert last_used > 0
+
+        # The client that couldn't send the message was discarded.
+        eq_(1, pool.open_connections)
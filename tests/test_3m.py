@@ -1,6 +1,7 @@
 from nose.tools import set_trace, eq_
 import datetime
 import pkgutil
+import time
 from api.threem import (
     CirculationParser,
     EventParser,
@@ -8,6 +9,7 @@ from api.threem import (
     ThreeMEventMonitor,
 )
 from core.model import (
+    get_one_or_create,
     CirculationEvent,
     Contributor,
     DataSource,
@@ -237,3 +239,89 @@ class TestThreeMEventMonitor(DatabaseTest):
         proper_args = ['2013-04-02']
         default_start_time = monitor.create_default_start_time(self._db, proper_args)
         eq_(datetime.datetime(2013, 4, 2), default_start_time)
+
+    def test_run_once_resumes_from_checkpoint(self):
+        api = MockThreeMAPI(self._db)
+        monitor = ThreeMEventMonitor(self._db, api=api, workers=1)
+        monitor.timestamp, ignore = get_one_or_create(
+            self._db, Timestamp, service=monitor.service_name
+        )
+        start = datetime.datetime(2016, 1, 1)
+        cutoff = start + datetime.timedelta(days=1, hours=12)
+
+        def event(name, hours):
+            time = start + datetime.timedelta(hours=hours)
+            return (name, "isbn", "patron", time, None, "checkout")
+
+        requests = []
+        def get_events_between(start, cutoff, full_slice):
+            requests.append(full_slice)
+            # The events don't come back in the order they happened.
+            return [event("event 3", 3), event("event 1", 1),
+                    event("event 2", 2)]
+        api.get_events_between = get_events_between
+
+        handled = []
+        def handle_event(threem_id, isbn, patron, start_time, end_time,
+                         type):
+            handled.append(threem_id)
+            return start_time
+        monitor.handle_event = handle_event
+
+        # A previous run was interrupted after handling the event
+        # that happened two hours into the first day.
+        monitor.checkpoint.save(start, 2 * 60 * 60)
+        monitor.run_once(start, cutoff)
+
+        # The event before that was skipped. The event at the time of
+        # the checkpoint was handled again, which is harmless. The
+        # checkpoint was for the first day, so it didn't affect the
+        # second.
+        eq_([True, False], requests)
+        eq_(["event 2", "event 3", "event 1", "event 2", "event 3"],
+            handled)
+
+        # The run is over, so the checkpoint is gone.
+        eq_(0, monitor.checkpoint.position(start))
+
+    def test_run_once_fetches_days_in_parallel(self):
+        api = MockThreeMAPI(self._db)
+        monitor = ThreeMEventMonitor(self._db, api=api, workers=3)
+        monitor.timestamp, ignore = get_one_or_create(
+            self._db, Timestamp, service=monitor.service_name
+        )
+        start = datetime.datetime(2016, 1, 1)
+        cutoff = start + datetime.timedelta(days=5)
+
+        def get_events_between(start, cutoff, cache_result=False):
+            # Earlier days take longer to fetch, so the worker
+            # threads finish them out of order.
+            day = start.day
+            time.sleep(0.01 * (6-day))
+            return [("day %d" % day, "isbn", "patron",
+                     start + datetime.timedelta(hours=1), None, "checkout")]
+        api.get_events_between = get_events_between
+
+        handled = []
+        def handle_event(threem_id, isbn, patron, start_time, end_time,
+                         type):
+            handled.append(threem_id)
+            return start_time
+        monitor.handle_event = handle_event
+
+        most_recent = monitor.run_once(start, cutoff)
+        monitor.pool.shutdown()
+
+        # The events were still handled in order.
+        eq_(["day 1", "day 2", "day 3", "day 4", "day 5"], handled)
+        eq_(datetime.datetime(2016, 1, 5, 1), most_recent)
+        eq_(most_recent, monitor.timestamp.timestamp)
+
+        # The number of worker threads is bounded.
+        monitor = ThreeMEventMonitor(self._db, api=api, workers=1000)
+        eq_(ThreeMEventMonitor.MAX_WORKERS, monitor.workers)
+        eq_(ThreeMEventMonitor.MAX_WORKERS, monitor.pool.size)
+
+        # The pool's threads aren't started until there's work for
+        # them to do.
+        eq_([], monitor.pool.threads)
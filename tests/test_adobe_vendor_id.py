@@ -624,6 +624,41 @@ class TestAuthdataUtility(VendorIDTest):
                 utility.library_uris_by_short_name
             )
             
+            eq_(AuthdataUtility.DEFAULT_SHORT_CLIENT_TOKEN_REUSE,
+                utility.short_client_token_reuse)
+
+            # As long as the configuration doesn't change, we get the
+            # same utility every time, without looking up the library.
+            def expire_library():
+                # Make it look like LIBRARY_CACHE_TIME has passed.
+                key, library_key, utility, check_at = (
+                    AuthdataUtility._from_config
+                )
+                AuthdataUtility._from_config = (
+                    key, library_key, utility, 0
+                )
+            assert utility is AuthdataUtility.from_config(self._db)
+            library.library_registry_shared_secret = "new secret"
+            assert utility is AuthdataUtility.from_config(self._db)
+
+            # Once it's time to check the library again, a change to
+            # the library gets us a new utility.
+            expire_library()
+            new_utility = AuthdataUtility.from_config(self._db)
+            assert new_utility is not utility
+            eq_("new secret", new_utility.secret)
+
+            # If the library hasn't changed, the utility is kept.
+            expire_library()
+            assert new_utility is AuthdataUtility.from_config(self._db)
+            library.library_registry_shared_secret = "some secret"
+            expire_library()
+
+            integration = config[Configuration.INTEGRATIONS][name]
+            integration[AuthdataUtility.SHORT_CLIENT_TOKEN_REUSE_KEY] = 60
+            eq_(60, AuthdataUtility.from_config(self._db).short_client_token_reuse)
+            del integration[AuthdataUtility.SHORT_CLIENT_TOKEN_REUSE_KEY]
+
             # If an integration is set up but incomplete, from_config
             # raises CannotLoadConfiguration.
             integration = config[Configuration.INTEGRATIONS][name]
@@ -795,6 +830,32 @@ class TestAuthdataUtility(VendorIDTest):
         eq_(self.authdata.library_uri, library_uri)
         eq_("a patron", patron)
 
+    def test_short_client_token_reuse(self):
+        # By default, every call to short_client_token() signs a new
+        # token.
+        eq_(0, self.authdata.short_client_token_reuse)
+        self.authdata.encode_short_client_token = lambda x: (x, object())
+        assert (self.authdata.short_client_token("a patron")
+                != self.authdata.short_client_token("a patron"))
+
+        # If token reuse is enabled, a patron gets the same token
+        # until the reuse window is over.
+        self.authdata.short_client_token_reuse = 600
+        token = self.authdata.short_client_token("a patron")
+        eq_(token, self.authdata.short_client_token("a patron"))
+        assert token != self.authdata.short_client_token("another patron")
+
+        self.authdata._short_client_tokens.put("a patron", token, -1)
+        assert token != self.authdata.short_client_token("a patron")
+
+        # The reuse window can't be so long that a client might be
+        # given a token that's about to expire.
+        utility = AuthdataUtility(
+            "vendor", "http://a-library/", "LBRY", "secret",
+            short_client_token_reuse=24*60*60
+        )
+        eq_(30*60, utility.short_client_token_reuse)
+
     def test_short_client_token_encode_known_value(self):
         """Verify that the encoding algorithm gives a known value on known
         input.
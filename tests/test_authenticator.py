@@ -42,6 +42,7 @@ from api.authenticator import (
     Authenticator,
     AuthenticationProvider,
     BasicAuthenticationProvider,
+    CredentialCache,
     OAuthController,
     OAuthAuthenticationProvider,
     PatronData,
@@ -1261,12 +1262,138 @@ class TestBasicAuthenticationProviderAuthenticate(DatabaseTest):
         # new identifiers.
         eq_(new_username, patron.username)
 
+    def test_credentials_are_cached(self):
+        patron = self._patron()
+        patrondata = PatronData(permanent_id=patron.external_identifier)
+        provider = MockBasic(patrondata)
+        eq_(patron, provider.authenticate(self._db, self.credentials))
+
+        # The ILS stops responding, but it doesn't matter, because
+        # we remember that these credentials are good.
+        provider.patrondata = UNSUPPORTED_AUTHENTICATION_MECHANISM
+        eq_(patron, provider.authenticate(self._db, self.credentials))
+
+        # Different credentials have to be checked with the ILS.
+        eq_(UNSUPPORTED_AUTHENTICATION_MECHANISM, provider.authenticate(
+            self._db, dict(username="user", password="other password")
+        ))
+
+    def test_invalid_credentials_are_cached(self):
+        patron = self._patron()
+        provider = MockBasic(None)
+        eq_(None, provider.authenticate(self._db, self.credentials))
+
+        # Even though the ILS would now accept these credentials,
+        # we remember that they were wrong a moment ago.
+        provider.patrondata = PatronData(
+            permanent_id=patron.external_identifier
+        )
+        eq_(None, provider.authenticate(self._db, self.credentials))
+
+    def test_credential_caching_can_be_disabled(self):
+        patron = self._patron()
+        provider = MockBasic(
+            None, credential_cache_ttl=0, failed_credential_cache_ttl=0
+        )
+        eq_(None, provider.authenticate(self._db, self.credentials))
+        provider.patrondata = PatronData(
+            permanent_id=patron.external_identifier
+        )
+        eq_(patron, provider.authenticate(self._db, self.credentials))
+        provider.patrondata = None
+        eq_(None, provider.authenticate(self._db, self.credentials))
+
+    def test_blocked_patron_credentials_not_cached(self):
+        patron = self._patron()
+        patrondata = PatronData(
+            permanent_id=patron.external_identifier,
+            block_reason=PatronData.UNKNOWN_BLOCK
+        )
+        provider = MockBasic(patrondata)
+        eq_(patron, provider.authenticate(self._db, self.credentials))
+
+        # Since the patron is blocked, the next request goes to the ILS.
+        provider.patrondata = None
+        eq_(None, provider.authenticate(self._db, self.credentials))
+
     # Notice what's missing: If a patron has no permanent identifier,
     # _and_ their username and authorization identifier both change,
     # then we have no way of locating them in our database. They will
     # appear no different to us than a patron who has never used the
     # circulation manager before.
 
+class TestCredentialCache(DatabaseTest):
+
+    def test_get_and_put(self):
+        cache = CredentialCache(ttl=60, failed_ttl=60)
+        eq_((False, None), cache.get("user", "pass"))
+
+        cache.put("user", "pass", 1)
+        eq_((True, 1), cache.get("user", "pass"))
+        eq_((False, None), cache.get("user", "pass2"))
+
+        # Invalid credentials are remembered as belonging to no patron.
+        cache.put("user", "pass2", None)
+        eq_((True, None), cache.get("user", "pass2"))
+
+        # The credentials themselves aren't stored anywhere.
+        for key in cache.entries:
+            assert "pass" not in key
+
+    def test_expiration(self):
+        cache = CredentialCache(ttl=60, failed_ttl=0)
+        cache.put("user", "pass", 1)
+        key = cache.hash("user", "pass")
+        cache.entries.put(key, 1, ttl=-1)
+        eq_((False, None), cache.get("user", "pass"))
+
+        # A failed_ttl of zero means invalid credentials are never
+        # remembered.
+        cache.put("user", "pass2", None)
+        eq_((False, None), cache.get("user", "pass2"))
+
+    def test_max_size(self):
+        cache = CredentialCache(ttl=60, max_size=2)
+        cache.put("user1", "pass", 1)
+        cache.put("user2", "pass", 2)
+        cache.put("user3", "pass", 3)
+        eq_((False, None), cache.get("user1", "pass"))
+        eq_((True, 3), cache.get("user3", "pass"))
+
+        # The least recently used credentials are the ones dropped,
+        # even if they weren't the least recently added.
+        eq_((True, 2), cache.get("user2", "pass"))
+        cache.put("user4", "pass", 4)
+        eq_((False, None), cache.get("user3", "pass"))
+        eq_((True, 2), cache.get("user2", "pass"))
+        eq_((True, 4), cache.get("user4", "pass"))
+
+    def test_apply_invalidates_blocked_patron(self):
+        patron = self._patron()
+        cache = CredentialCache(ttl=60)
+        cache.put("user", "pass", patron.id)
+        cache.put("other", "pass", patron.id + 1)
+
+        # Applying data that doesn't block the patron leaves the
+        # cache alone.
+        PatronData(permanent_id=patron.external_identifier).apply(patron)
+        eq_((True, patron.id), cache.get("user", "pass"))
+
+        # Once the patron is blocked, every cache forgets the
+        # credentials they used.
+        PatronData(block_reason=PatronData.UNKNOWN_BLOCK).apply(patron)
+        eq_((False, None), cache.get("user", "pass"))
+        eq_((True, patron.id + 1), cache.get("other", "pass"))
+
+    def test_apply_invalidates_expired_patron(self):
+        patron = self._patron()
+        cache = CredentialCache(ttl=60)
+        cache.put("user", "pass", patron.id)
+        yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+        PatronData(authorization_expires=yesterday).apply(patron)
+        eq_((False, None), cache.get("user", "pass"))
+
+
 class TestOAuthAuthenticationProvider(DatabaseTest):
 
     def test_from_config(self):
@@ -15,13 +15,19 @@ from datetime import (
     datetime, 
     timedelta,
 )
+import threading
+import time
+
+from sqlalchemy import event
 
 from api.circulation_exceptions import *
 from api.circulation import (
+    BaseCirculationAPI,
     CirculationAPI,
     FulfillmentInfo,
     LoanInfo,
     HoldInfo,
+    PatronActivityCache,
 )
 
 from core.analytics import Analytics
@@ -39,6 +45,7 @@ from core.mock_analytics_provider import MockAnalyticsProvider
 
 from . import DatabaseTest, sample_data
 from api.testing import MockCirculationAPI
+from api.util.worker_pool import Job
 from api.threem import MockThreeMAPI
 
 
@@ -646,6 +653,119 @@ class TestCirculationAPI(DatabaseTest):
         loans = self._db.query(Loan).all()
         eq_([], loans)
 
+    def test_sync_bookshelf_applies_remote_loans_and_holds(self):
+        # The patron has a local hold which the remote says is still
+        # active, but their position has changed.
+        edition, hold_pool = self._edition(with_license_pool=True)
+        hold, ignore = hold_pool.on_hold_to(self.patron, position=10)
+        self.circulation.add_remote_hold(
+            hold_pool.identifier.type, hold_pool.identifier.identifier,
+            None, None, 4
+        )
+
+        # They also have a remote loan on a book we know about, and
+        # another on a book we've never heard of.
+        self.circulation.add_remote_loan(
+            self.identifier.type, self.identifier.identifier,
+            self.YESTERDAY, self.IN_TWO_WEEKS
+        )
+        self.circulation.add_remote_loan(
+            Identifier.THREEM_ID, "new-3m-book", None, None
+        )
+
+        loans, holds = self.sync_bookshelf()
+
+        # The existing hold was updated rather than replaced.
+        eq_([hold], holds)
+        eq_(4, hold.position)
+
+        # Two new loans were created, one of them for a brand new
+        # LicensePool.
+        eq_(2, len(loans))
+        eq_(set(loans), set(self._db.query(Loan).all()))
+        [known, unknown] = loans
+        eq_(self.pool, known.license_pool)
+        eq_(self.YESTERDAY, known.start)
+        eq_(self.IN_TWO_WEEKS, known.end)
+        eq_("new-3m-book", unknown.license_pool.identifier.identifier)
+        eq_(DataSource.THREEM, unknown.license_pool.data_source.name)
+
+        # Syncing again finds the same loans rather than creating
+        # new ones.
+        loans2, holds2 = self.sync_bookshelf()
+        eq_(loans, loans2)
+        eq_(holds, holds2)
+
+    def test_sync_bookshelf_with_duplicate_remote_loans_and_holds(self):
+        # The remote mentions the same loan and the same hold twice.
+        edition, hold_pool = self._edition(with_license_pool=True)
+        for i in range(2):
+            self.circulation.add_remote_loan(
+                self.identifier.type, self.identifier.identifier,
+                self.YESTERDAY, self.IN_TWO_WEEKS
+            )
+            self.circulation.add_remote_hold(
+                hold_pool.identifier.type, hold_pool.identifier.identifier,
+                None, None, 4
+            )
+
+        # Only one local loan and one local hold are created.
+        loans, holds = self.sync_bookshelf()
+        self._db.flush()
+        [loan] = loans
+        eq_(self.pool, loan.license_pool)
+        eq_([loan], self._db.query(Loan).all())
+        [hold] = holds
+        eq_(hold_pool, hold.license_pool)
+        eq_([hold], self._db.query(Hold).all())
+
+    def test_apply_patron_activity_query_count(self):
+        # The number of statements needed to apply a patron's activity
+        # doesn't depend on how many loans and holds they have.
+        engine = self._db.get_bind().engine
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        def apply_activity(how_many):
+            patron = self._patron()
+            remote_loans = []
+            remote_holds = []
+            for i in range(how_many):
+                edition, pool = self._edition(
+                    data_source_name=DataSource.THREEM,
+                    identifier_type=Identifier.THREEM_ID,
+                    with_license_pool=True
+                )
+                pool.loan_to(patron)
+                remote_loans.append(LoanInfo(
+                    pool.identifier.type, pool.identifier.identifier,
+                    None, None
+                ))
+                edition, pool = self._edition(
+                    data_source_name=DataSource.THREEM,
+                    identifier_type=Identifier.THREEM_ID,
+                    with_license_pool=True
+                )
+                pool.on_hold_to(patron, position=1)
+                remote_holds.append(HoldInfo(
+                    pool.identifier.type, pool.identifier.identifier,
+                    None, None, 1
+                ))
+            self._db.flush()
+            del statements[:]
+            event.listen(engine, "before_cursor_execute", count)
+            try:
+                self.circulation.apply_patron_activity(
+                    patron, remote_loans, remote_holds, True
+                )
+                self._db.flush()
+            finally:
+                event.remove(engine, "before_cursor_execute", count)
+            return len(statements)
+
+        eq_(apply_activity(1), apply_activity(5))
+
     def test_patron_activity(self):
         threem = MockThreeMAPI(self._db)
 
@@ -666,3 +786,377 @@ class TestCirculationAPI(DatabaseTest):
         eq_(0, len(loans))
         eq_(0, len(holds))
         eq_(False, complete)
+
+    def test_patron_activity_consumes_generator_in_worker_thread(self):
+        identifier = self.identifier
+        class GeneratorAPI(BaseCirculationAPI):
+            threads = []
+            sessions = []
+            def patron_activity(self, patron, pin):
+                # This generator doesn't do anything until it's iterated
+                # over.
+                self.threads.append(threading.current_thread())
+                self.sessions.append((self._db, patron))
+                yield LoanInfo(
+                    identifier.type, identifier.identifier, None, None
+                )
+        api = GeneratorAPI()
+        circulation = CirculationAPI(self._db)
+        circulation.apis = [api]
+
+        loans, holds, complete = circulation.patron_activity(
+            self.patron, "1234"
+        )
+        eq_(1, len(loans))
+        eq_([], holds)
+        eq_(True, complete)
+
+        # The generator was run in one of the worker threads, not in
+        # this thread.
+        [thread] = api.threads
+        assert thread != threading.current_thread()
+
+        # It was run by a copy of the API which used its own database
+        # session, and the patron came from that session.
+        [(worker_db, patron)] = api.sessions
+        assert worker_db != self._db
+        eq_(self.patron.id, patron.id)
+        assert patron != self.patron
+        assert not hasattr(api, '_db')
+
+    def test_explicit_zero_timeout(self):
+        circulation = CirculationAPI(self._db, patron_activity_timeout=0)
+        eq_(0, circulation.patron_activity_timeout)
+        circulation = CirculationAPI(self._db)
+        eq_(CirculationAPI.PATRON_ACTIVITY_TIMEOUT,
+            circulation.patron_activity_timeout)
+
+    def test_late_results_are_never_applied_in_request_thread(self):
+        threads = []
+        applied = threading.Event()
+        class Mock(CirculationAPI):
+            def _apply_late_patron_activity(self, api, patron_id, job,
+                                            generation=None):
+                threads.append(threading.current_thread())
+                applied.set()
+
+        # The job finished just after we gave up waiting for it, so
+        # the callback is called in this thread.
+        circulation = Mock(self._db)
+        job = Job(lambda: [])
+        job.run()
+        job.add_done_callback(
+            lambda job: circulation._schedule_late_patron_activity(
+                object(), self.patron.id, job
+            )
+        )
+
+        # But the results were applied in a worker thread.
+        eq_(True, applied.wait(5))
+        [thread] = threads
+        assert thread != threading.current_thread()
+
+    def test_patron_activity_gives_up_on_slow_api(self):
+        identifier = self.identifier
+        release = threading.Event()
+        class SlowAPI(BaseCirculationAPI):
+            def patron_activity(self, patron, pin):
+                release.wait(5)
+                return []
+
+        class FastAPI(BaseCirculationAPI):
+            def patron_activity(self, patron, pin):
+                return [
+                    HoldInfo(identifier.type, identifier.identifier,
+                             None, None, 1)
+                ]
+
+        late = []
+        late_results_applied = threading.Event()
+        class Mock(CirculationAPI):
+            def _apply_late_patron_activity(self, api, patron_id, job,
+                                            generation=None):
+                late.append((api, patron_id, job.result))
+                late_results_applied.set()
+
+        slow = SlowAPI()
+        circulation = Mock(self._db, patron_activity_timeout=0.1)
+        circulation.apis = [slow, FastAPI()]
+
+        try:
+            loans, holds, complete = circulation.patron_activity(
+                self.patron, "1234"
+            )
+        finally:
+            release.set()
+
+        # We got the hold from the fast API, but since the slow API
+        # never answered, we don't have a complete picture.
+        eq_([], loans)
+        eq_(1, len(holds))
+        eq_(False, complete)
+
+        # Once the slow API finished, its results were passed on to be
+        # applied to the database.
+        eq_(True, late_results_applied.wait(5))
+        eq_([(slow, self.patron.id, [])], late)
+
+    def test_apply_late_patron_activity(self):
+        loan, ignore = self.pool.loan_to(self.patron)
+        loan.start = self.YESTERDAY
+        identifier = self.identifier
+
+        class Mock(MockCirculationAPI):
+            def _worker_session(self):
+                return self._db
+
+        circulation = Mock(self._db)
+        api = object()
+        circulation.data_source_id_for_api[api] = self.pool.data_source.id
+
+        # The API eventually told us the patron has a hold on the book
+        # they used to have on loan.
+        job = Job(
+            lambda: [HoldInfo(identifier.type, identifier.identifier,
+                              None, None, 3)]
+        )
+        job.run()
+        circulation._apply_late_patron_activity(api, self.patron.id, job)
+
+        # The loan is gone and the hold has been created.
+        eq_([], self._db.query(Loan).all())
+        [hold] = self._db.query(Hold).all()
+        eq_(self.pool, hold.license_pool)
+        eq_(3, hold.position)
+
+        # If the late API call failed, nothing happens.
+        def explode():
+            raise Exception("oops")
+        job = Job(explode)
+        job.run()
+        circulation._apply_late_patron_activity(api, self.patron.id, job)
+        eq_([hold], self._db.query(Hold).all())
+
+    def test_late_patron_activity_keeps_newer_loans_and_holds(self):
+        class Mock(MockCirculationAPI):
+            def _worker_session(self):
+                return self._db
+
+        circulation = Mock(self._db)
+        api = object()
+        circulation.data_source_id_for_api[api] = self.pool.data_source.id
+
+        # The API call started a while ago, and came back empty.
+        job = Job(lambda: [])
+        job.run()
+        job.started_at = time.time() - 600
+
+        # Meanwhile the patron put one book on hold and borrowed
+        # another.
+        hold, ignore = self.pool.on_hold_to(self.patron)
+        edition, other_pool = self._edition(
+            data_source_name=self.pool.data_source.name,
+            identifier_type=self.identifier.type,
+            with_license_pool=True
+        )
+        loan, ignore = other_pool.loan_to(self.patron)
+        loan.start = datetime.utcnow() - timedelta(minutes=5)
+
+        # The API didn't know about either of them, but they're
+        # not deleted.
+        circulation._apply_late_patron_activity(api, self.patron.id, job)
+        eq_([hold], self._db.query(Hold).all())
+        eq_([loan], self._db.query(Loan).all())
+
+        # A hold that was already there when the API call started
+        # is deleted.
+        hold.start = datetime.utcnow() - timedelta(hours=1)
+        circulation._apply_late_patron_activity(api, self.patron.id, job)
+        eq_([], self._db.query(Hold).all())
+        eq_([loan], self._db.query(Loan).all())
+
+    def test_patron_activity_uses_cache(self):
+        identifier = self.identifier
+        class CountingAPI(BaseCirculationAPI):
+            calls = 0
+            def patron_activity(self, patron, pin):
+                self.calls += 1
+                return [
+                    LoanInfo(identifier.type, identifier.identifier,
+                             None, None)
+                ]
+        api = CountingAPI()
+        circulation = CirculationAPI(
+            self._db, patron_activity_cache_ttl=60
+        )
+        circulation.apis = [api]
+        circulation.data_source_id_for_api[api] = self.pool.data_source.id
+
+        loans, holds, complete = circulation.patron_activity(
+            self.patron, "1234"
+        )
+        eq_(1, len(loans))
+        eq_(1, api.calls)
+
+        # The second time, the API isn't asked.
+        loans, holds, complete = circulation.patron_activity(
+            self.patron, "1234"
+        )
+        eq_(1, len(loans))
+        eq_(True, complete)
+        eq_(1, api.calls)
+
+        # Changing the patron's loans through the circulation manager
+        # invalidates the cache.
+        circulation._invalidate_patron_activity(self.patron, self.pool)
+        circulation.patron_activity(self.patron, "1234")
+        eq_(2, api.calls)
+
+    def test_patron_activity_invalidated_during_fetch_is_not_cached(self):
+        identifier = self.identifier
+        pool = self.pool
+        class BorrowingAPI(BaseCirculationAPI):
+            calls = 0
+            def patron_activity(self, patron, pin):
+                self.calls += 1
+                # While we're fetching the patron's activity, they
+                # borrow a book through the circulation manager.
+                circulation._invalidate_patron_activity(patron, pool)
+                return []
+        api = BorrowingAPI()
+        circulation = CirculationAPI(
+            self._db, patron_activity_cache_ttl=60
+        )
+        circulation.apis = [api]
+        data_source_id = self.pool.data_source.id
+        circulation.data_source_id_for_api[api] = data_source_id
+
+        # The result that came back was out of date before it
+        # arrived, so it wasn't cached, and the next sync asks the API
+        # again.
+        circulation.patron_activity(self.patron, "1234")
+        eq_(None, circulation.patron_activity_cache.get(
+            self.patron.id, data_source_id
+        ))
+        circulation.patron_activity(self.patron, "1234")
+        eq_(2, api.calls)
+
+        # The same goes for results that come in after the deadline.
+        class Mock(MockCirculationAPI):
+            def _worker_session(self):
+                return self._db
+        circulation = Mock(self._db)
+        cache = circulation.patron_activity_cache
+        cache.ttl = 60
+        api = object()
+        circulation.data_source_id_for_api[api] = data_source_id
+        generation = cache.generation(self.patron.id)
+        job = Job(lambda: [])
+        job.run()
+        circulation._invalidate_patron_activity(self.patron, self.pool)
+        circulation._apply_late_patron_activity(
+            api, self.patron.id, job, generation
+        )
+        eq_(None, cache.get(self.patron.id, data_source_id))
+
+        # If nothing happened in the meantime, the late results are
+        # cached.
+        circulation._apply_late_patron_activity(
+            api, self.patron.id, job, cache.generation(self.patron.id)
+        )
+        eq_([], cache.get(self.patron.id, data_source_id))
+
+    def test_revoke_loan_invalidates_patron_activity_cache(self):
+        cache = self.circulation.patron_activity_cache
+        cache.ttl = 60
+        data_source_id = self.pool.data_source.id
+        cache.put(self.patron.id, data_source_id, [])
+
+        self.pool.loan_to(self.patron)
+        self.remote.queue_checkin(True)
+        self.circulation.revoke_loan(self.patron, "1234", self.pool)
+        eq_(None, cache.get(self.patron.id, data_source_id))
+
+
+class TestPatronActivityCache(object):
+
+    def test_get_and_put(self):
+        cache = PatronActivityCache(60)
+        eq_(None, cache.get(1, 2))
+        cache.put(1, 2, iter(["a loan"]))
+        eq_(["a loan"], cache.get(1, 2))
+        eq_(None, cache.get(1, 3))
+        eq_(None, cache.get(2, 2))
+
+        # Nothing is cached for an unknown data source.
+        cache.put(1, None, ["a loan"])
+        eq_(None, cache.get(1, None))
+
+    def test_disabled(self):
+        cache = PatronActivityCache(0)
+        cache.put(1, 2, ["a loan"])
+        eq_(None, cache.get(1, 2))
+
+    def test_expiration(self):
+        cache = PatronActivityCache(0.01)
+        cache.put(1, 2, ["a loan"])
+        time.sleep(0.02)
+        eq_(None, cache.get(1, 2))
+
+    def test_least_recently_used_entry_is_discarded(self):
+        cache = PatronActivityCache(60, max_size=2)
+        cache.put(1, 1, ["a"])
+        cache.put(2, 1, ["b"])
+
+        # Using the first entry makes the second one the least
+        # recently used.
+        cache.get(1, 1)
+        cache.put(3, 1, ["c"])
+        eq_(["a"], cache.get(1, 1))
+        eq_(None, cache.get(2, 1))
+        eq_(["c"], cache.get(3, 1))
+
+    def test_invalidate(self):
+        cache = PatronActivityCache(60)
+        cache.put(1, 1, ["a"])
+        cache.put(1, 2, ["b"])
+        cache.put(2, 1, ["c"])
+
+        cache.invalidate(1, 1)
+        eq_(None, cache.get(1, 1))
+        eq_(["b"], cache.get(1, 2))
+
+        cache.invalidate(1)
+        eq_(None, cache.get(1, 2))
+        eq_(["c"], cache.get(2, 1))
+
+    def test_put_after_invalidate_is_ignored(self):
+        cache = PatronActivityCache(60)
+        before = cache.generation(1)
+        other_patron = cache.generation(2)
+
+        # The patron's activity was invalidated while it was being
+        # fetched, so the result isn't cached.
+        cache.invalidate(1, 2)
+        cache.put(1, 2, ["a loan"], before)
+        eq_(None, cache.get(1, 2))
+
+        # A fetch that started after the invalidation is cached.
+        cache.put(1, 2, ["a loan"], cache.generation(1))
+        eq_(["a loan"], cache.get(1, 2))
+
+        # Other patrons aren't affected.
+        cache.put(2, 2, ["b loan"], other_patron)
+        eq_(["b loan"], cache.get(2, 2))
+
+    def test_forgotten_generation_is_never_reused(self):
+        cache = PatronActivityCache(60, max_size=1)
+        before = cache.generation(1)
+        cache.invalidate(1)
+
+        # Invalidating another patron pushes the first patron's
+        # generation out, but it doesn't go back to what it was.
+        cache.invalidate(2)
+        eq_(1, len(cache._generations))
+        cache.put(1, 2, ["a loan"], before)
+        eq_(None, cache.get(1, 2))
@@ -7,6 +7,7 @@ from nose.tools import (
 from contextlib import contextmanager
 import os
 import datetime
+import hashlib
 import re
 from wsgiref.handlers import format_date_time
 from time import mktime
@@ -24,7 +25,10 @@ from collections import Counter
 from api.controller import (
     CirculationManager,
     CirculationManagerController,
+    client_has_current_copy,
+    conditional_feed_response,
 )
+from api.feed_compression import CompressedFeedCache
 from api.mock_authentication import (
     MockAuthenticationProvider
 )
@@ -85,7 +89,11 @@ from core.opds import (
 from core.util.opds_writer import (    
     OPDSFeed,
 )
-from api.opds import CirculationManagerAnnotator
+from api.opds import (
+    CirculationManagerAnnotator,
+    URLTemplates,
+    PreloadFeed,
+)
 from api.annotations import AnnotationWriter
 from api.admin.oauth import DummyGoogleClient
 from api.testing import MockAdobeConfiguration
@@ -534,6 +542,50 @@ class TestLoanController(CirculationControllerTest):
             assert isinstance(response, ProblemDetail)
             eq_(502, response.status_code)
 
+    def test_fulfill_streams_remote_content(self):
+        with self.app.test_request_context(
+                "/", headers=dict(Authorization=self.valid_auth,
+                                  Range="bytes=10-")):
+            self.manager.loans.authenticated_patron_from_request()
+            self.manager.loans.borrow(
+                self.data_source.name, self.identifier.type,
+                self.identifier.identifier
+            )
+            [mech1, mech2] = sorted(
+                self.pool.delivery_mechanisms, 
+                key=lambda x: x.delivery_mechanism.default_client_can_fulfill
+            )
+
+            requests = []
+            def streaming_get(url, headers, **kwargs):
+                requests.append((url, headers))
+                def content():
+                    yield "part of "
+                    yield "an audiobook"
+                headers = {
+                    "Content-Range": "bytes 10-29/30",
+                    "Content-Length": "20",
+                }
+                return 206, headers, content()
+
+            response = self.manager.loans.fulfill(
+                self.data_source.name, self.identifier.type,
+                self.identifier.identifier, mech2.delivery_mechanism.id,
+                do_get=streaming_get
+            )
+
+            # The client's Range header was passed on to the remote
+            # server.
+            eq_([(mech2.resource.url, {"Range": "bytes=10-"})], requests)
+
+            # The partial response was passed on to the client, one
+            # chunk at a time.
+            eq_(206, response.status_code)
+            eq_("bytes 10-29/30", response.headers['Content-Range'])
+            eq_("20", response.headers['Content-Length'])
+            eq_(True, response.is_streamed)
+            eq_("part of an audiobook", response.get_data())
+
     def test_borrow_and_fulfill_with_streaming_delivery_mechanism(self):
         # Create a pool with a streaming delivery mechanism
         work = self._work(with_license_pool=True, with_open_access_download=False)
@@ -989,6 +1041,64 @@ class TestLoanController(CirculationControllerTest):
             eq_(0, len(threem_revoke_links))
 
 
+    def test_active_loans_conditional_get(self):
+        with self.app.test_request_context(
+                "/", headers=dict(Authorization=self.valid_auth)):
+            patron = self.manager.loans.authenticated_patron_from_request()
+            with self.temp_config() as config:
+                response = self.manager.loans.sync()
+            eq_(200, response.status_code)
+            etag = response.headers['ETag']
+            cache_control = response.headers['Cache-Control']
+
+        # The feed is generated on the fly, so its ETag is weak.
+        assert etag.startswith('W/"')
+
+        # If the client's copy of the feed is current, the feed isn't
+        # built again.
+        headers = dict(Authorization=self.valid_auth)
+        headers['If-None-Match'] = etag
+        def sync(policies={}):
+            with self.app.test_request_context("/", headers=headers):
+                self.manager.loans.authenticated_patron_from_request()
+                with self.temp_config() as config:
+                    config[Configuration.POLICIES] = policies
+                    return self.manager.loans.sync()
+        response = sync()
+        eq_(304, response.status_code)
+        eq_(etag, response.headers['ETag'])
+
+        # The 304 response can be cached the same way as the feed.
+        eq_(cache_control, response.headers['Cache-Control'])
+
+        # A change to the hold policy can change the feed, so it
+        # changes the ETag.
+        response = sync({
+            Configuration.HOLD_POLICY : Configuration.HOLD_POLICY_HIDE
+        })
+        eq_(200, response.status_code)
+        assert etag != response.headers['ETag']
+
+        # Once the patron has a new loan, the client's copy is out of
+        # date.
+        work = self._work(with_license_pool=True)
+        [pool] = work.license_pools
+        pool.loan_to(patron)
+        response = sync()
+        eq_(200, response.status_code)
+        assert etag != response.headers['ETag']
+
+        # So it is once a book on loan becomes available in a new
+        # format.
+        headers['If-None-Match'] = response.headers['ETag']
+        eq_(304, sync().status_code)
+        pool.set_delivery_mechanism(
+            Representation.PDF_MEDIA_TYPE, DeliveryMechanism.ADOBE_DRM,
+            RightsStatus.IN_COPYRIGHT, None
+        )
+        eq_(200, sync().status_code)
+
+
 class TestAnnotationController(CirculationControllerTest):
     def setup(self):
         super(TestAnnotationController, self).setup()
@@ -1054,6 +1164,27 @@ class TestAnnotationController(CirculationControllerTest):
             expected_time = format_date_time(mktime(annotation.timestamp.timetuple()))
             eq_(expected_time, response.headers['Last-Modified'])
 
+        # A client that has the current container gets a 304 response.
+        for headers in ({"If-None-Match": expected_etag},
+                        {"If-Modified-Since": expected_time}):
+            headers['Authorization'] = self.valid_auth
+            with self.app.test_request_context("/", headers=headers):
+                self.manager.annotations.authenticated_patron_from_request()
+                response = self.manager.annotations.container()
+                eq_(304, response.status_code)
+                eq_(expected_etag, response.headers['ETag'])
+
+        # Once the annotation is deleted, the client's copy is out of
+        # date.
+        annotation.set_inactive()
+        with self.app.test_request_context(
+                "/", headers={"Authorization": self.valid_auth,
+                              "If-None-Match": expected_etag}):
+            self.manager.annotations.authenticated_patron_from_request()
+            response = self.manager.annotations.container()
+            eq_(200, response.status_code)
+            eq_(0, json.loads(response.data)['total'])
+
     def test_get_container_for_work(self):
         self.pool.loan_to(self.default_patron)
 
@@ -1315,6 +1446,45 @@ class TestWorkController(CirculationControllerTest):
         [entry] = feed['entries']
         eq_(self.english_1.title, entry['title'])
 
+    def test_templated_url_for(self):
+        # Outside of test mode, the URLs that show up in every entry
+        # are built from templates. They're the same URLs url_for()
+        # would have built.
+        annotator = CirculationManagerAnnotator(None, None)
+        annotator.url_templates = URLTemplates(verify=True)
+        identifiers = [
+            ("Overdrive", "Overdrive ID", "abc"),
+            ("Gutenberg", "Gutenberg ID",
+             "http://www.gutenberg.org/ebooks/10441"),
+            ("Axis 360", "ISBN", u"caf\xe9"),
+        ]
+        routes = [
+            ("permalink", {}), ("report", {}), ("related_books", {}),
+            ("revoke_loan_or_hold", {}), ("borrow", dict(mechanism_id=None)),
+            ("borrow", dict(mechanism_id=4)), ("fulfill", dict(mechanism_id=4)),
+        ]
+        with self.app.test_request_context("/"):
+            for data_source, identifier_type, identifier in identifiers:
+                for endpoint, extra in routes:
+                    kwargs = dict(
+                        data_source=data_source,
+                        identifier_type=identifier_type,
+                        identifier=identifier, _external=True, **extra
+                    )
+                    eq_(annotator.url_for(endpoint, **kwargs),
+                        annotator.templated_url_for(endpoint, **kwargs))
+                kwargs = dict(identifier_type=identifier_type,
+                              identifier=identifier, _external=True)
+                eq_(annotator.url_for('annotations_for_work', **kwargs),
+                    annotator.templated_url_for(
+                        'annotations_for_work', **kwargs
+                    ))
+
+        # The templates really were used.
+        templates = annotator.url_templates.templates.values()
+        eq_(len(routes) + 1, len(templates))
+        assert all(templates)
+
     def test_permalink(self):
         with self.app.test_request_context("/"):
             response = self.manager.work_controller.permalink(self.datasource, self.identifier.type, self.identifier.identifier)
@@ -1752,6 +1922,52 @@ class TestFeedController(CirculationControllerTest):
                 eq_("c", by_rel['copyright'])
                 eq_("d", by_rel['about'])
 
+                # The feed has an ETag derived from its content.
+                eq_('"%s"' % hashlib.md5(response.data).hexdigest(),
+                    response.headers['ETag'])
+
+    def test_conditional_feed_response(self):
+        with self.app.test_request_context("/"):
+            response = conditional_feed_response(u"a feed")
+            eq_(200, response.status_code)
+            etag = response.headers['ETag']
+            eq_('"%s"' % hashlib.md5("a feed").hexdigest(), etag)
+
+        # If the client already has this version of the feed, it's not
+        # sent again.
+        with self.app.test_request_context(
+                "/", headers={"If-None-Match": etag}):
+            response = conditional_feed_response(u"a feed")
+            eq_(304, response.status_code)
+            eq_(True, client_has_current_copy(etag=etag))
+
+            response = conditional_feed_response(u"a new feed")
+            eq_(200, response.status_code)
+            eq_(False, client_has_current_copy(etag='"other"'))
+
+        # A client that accepts gzip gets a compressed copy of the feed,
+        # with its own ETag.
+        compressed_feeds = CompressedFeedCache()
+        with self.app.test_request_context(
+                "/", headers={"Accept-Encoding": "gzip"}):
+            response = conditional_feed_response(
+                u"a feed", compressed_feeds=compressed_feeds
+            )
+            eq_(200, response.status_code)
+            eq_("gzip", response.headers['Content-Encoding'])
+            eq_("Accept-Encoding", response.headers['Vary'])
+            eq_(etag[:-1] + '-gzip"', response.headers['ETag'])
+            eq_(compressed_feeds.get("a feed", "gzip"), response.data)
+
+        # A client that doesn't gets the feed uncompressed.
+        with self.app.test_request_context("/"):
+            response = conditional_feed_response(
+                u"a feed", compressed_feeds=compressed_feeds
+            )
+            eq_("a feed", response.data)
+            eq_(etag, response.headers['ETag'])
+            assert 'Content-Encoding' not in response.headers
+
     def test_multipage_feed(self):
         self._work("fiction work", language="eng", fiction=True, with_open_access_download=True)
         SessionManager.refresh_materialized_views(self._db)
@@ -1867,6 +2083,28 @@ class TestFeedController(CirculationControllerTest):
                 assert self.english_1.title not in response.data
                 assert self.english_2.title in response.data
                 assert self.french_1.author not in response.data
+                etag = response.headers['ETag']
+                rendered = PreloadFeed._rendered
+
+            # The feed is only rendered once.
+            with self.app.test_request_context("/"):
+                response = self.manager.opds_feeds.preload()
+                eq_(etag, response.headers['ETag'])
+                assert PreloadFeed._rendered is rendered
+
+            # A client that already has the feed doesn't get it again.
+            with self.app.test_request_context(
+                    "/", headers={"If-None-Match": etag}):
+                response = self.manager.opds_feeds.preload()
+                eq_(304, response.status_code)
+
+            # If the book's availability changes, the feed is rebuilt.
+            [pool] = self.english_2.license_pools
+            pool.licenses_available += 1
+            self._db.flush()
+            with self.app.test_request_context("/"):
+                response = self.manager.opds_feeds.preload()
+                assert PreloadFeed._rendered is not rendered
 
 class TestAnalyticsController(CirculationControllerTest):
     def setup(self):
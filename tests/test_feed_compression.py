@@ -0,0 +1,132 @@
+# encoding=utf8
+import gzip
+import os
+import shutil
+import tempfile
+from cStringIO import StringIO
+from nose.tools import (
+    set_trace,
+    eq_,
+    assert_raises,
+)
+import flask
+
+from api.feed_compression import CompressedFeedCache
+
+
+class TestCompressedFeedCache(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.feed = u"<feed>" + (u"<entry>☃</entry>" * 100) + u"</feed>"
+        self.content = self.feed.encode("utf8")
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def gunzip(self, data):
+        return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+    def test_compress(self):
+        compressed = CompressedFeedCache.compress(
+            self.content, CompressedFeedCache.GZIP
+        )
+        assert len(compressed) < len(self.content)
+        eq_(self.content, self.gunzip(compressed))
+
+        # Compressing the same feed always gives the same result.
+        eq_(compressed, CompressedFeedCache.compress(
+            self.content, CompressedFeedCache.GZIP
+        ))
+
+        assert_raises(
+            ValueError, CompressedFeedCache.compress, self.content,
+            "compress"
+        )
+
+    def test_negotiate(self):
+        cache = CompressedFeedCache()
+        app = flask.Flask(__name__)
+        def negotiate(accept_encoding):
+            headers = {}
+            if accept_encoding is not None:
+                headers['Accept-Encoding'] = accept_encoding
+            with app.test_request_context("/", headers=headers):
+                return cache.negotiate(flask.request)
+
+        eq_(None, negotiate(None))
+        eq_(None, negotiate("identity"))
+        eq_(None, negotiate("gzip;q=0"))
+        eq_("gzip", negotiate("gzip, deflate"))
+
+        cache.ENCODINGS = ["br", "gzip"]
+        eq_("br", negotiate("gzip, br"))
+        eq_("gzip", negotiate("gzip, br;q=0.5"))
+
+    def test_get_compresses_once(self):
+        cache = CompressedFeedCache()
+        compressed = cache.get(self.feed, CompressedFeedCache.GZIP)
+        eq_(self.content, self.gunzip(compressed))
+
+        # The second time, the compressed copy is found in memory.
+        def fail(*args):
+            raise Exception("Compressed twice!")
+        cache.compress = fail
+        eq_(compressed, cache.get(self.content, CompressedFeedCache.GZIP))
+
+    def test_store_shares_compressed_feeds_through_directory(self):
+        # A script stores a newly generated feed.
+        script_cache = CompressedFeedCache(os.path.join(self.directory, "x"))
+        script_cache.store(self.feed)
+        key = CompressedFeedCache.key(self.content)
+        for encoding in CompressedFeedCache.ENCODINGS:
+            assert os.path.exists(
+                os.path.join(self.directory, "x", "%s.%s" % (key, encoding))
+            )
+
+        # A web application process finds it without compressing it
+        # again.
+        web_cache = CompressedFeedCache(os.path.join(self.directory, "x"))
+        def fail(*args):
+            raise Exception("Compressed twice!")
+        web_cache.compress = fail
+        compressed = web_cache.get(self.feed, CompressedFeedCache.GZIP)
+        eq_(self.content, self.gunzip(compressed))
+
+    def test_max_size(self):
+        cache = CompressedFeedCache(max_size=2)
+        for content in ("a", "b", "c"):
+            cache.get(content, CompressedFeedCache.GZIP)
+        eq_(None, cache._get(cache.key("a"), CompressedFeedCache.GZIP))
+        assert cache._get(cache.key("c"), CompressedFeedCache.GZIP)
+
+    def test_get_does_not_write_to_directory(self):
+        # A feed compressed on demand, like a page of search results,
+        # is only kept in memory.
+        cache = CompressedFeedCache(self.directory)
+        cache.get(self.feed, CompressedFeedCache.GZIP)
+        eq_([], os.listdir(self.directory))
+
+    def test_prune(self):
+        cache = CompressedFeedCache(self.directory, max_age=100)
+        cache.store(u"<feed>old</feed>")
+        old_files = os.listdir(self.directory)
+        now = os.path.getmtime(os.path.join(self.directory, old_files[0]))
+        for filename in old_files:
+            path = os.path.join(self.directory, filename)
+            os.utime(path, (now - 101, now - 101))
+
+        # Storing a new feed deletes the files that haven't been
+        # rewritten recently.
+        cache._last_pruned = None
+        cache.store(self.feed)
+        remaining = os.listdir(self.directory)
+        eq_(len(CompressedFeedCache.ENCODINGS), len(remaining))
+        eq_(set(), set(old_files) & set(remaining))
+
+        # Pruning doesn't happen again until PRUNE_INTERVAL has passed.
+        os.utime(os.path.join(self.directory, remaining[0]), (0, 0))
+        cache.prune(now=now + 1)
+        eq_(len(remaining), len(os.listdir(self.directory)))
+        cache.prune(now=now + CompressedFeedCache.PRUNE_INTERVAL + 1)
+        eq_(len(remaining) - 1, len(os.listdir(self.directory)))
@@ -6,7 +6,10 @@ from api.config import (
     temp_config,
 )
 from core.analytics import Analytics
-from api.google_analytics_provider import GoogleAnalyticsProvider
+from api.google_analytics_provider import (
+    GoogleAnalyticsDispatcher,
+    GoogleAnalyticsProvider,
+)
 from . import DatabaseTest
 from core.model import (
     get_one_or_create,
@@ -14,6 +17,12 @@ from core.model import (
     DataSource,
     LicensePool
 )
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 import urlparse
 import datetime
 from psycopg2.extras import NumericRange
@@ -25,6 +34,34 @@ class MockGoogleAnalyticsProvider(GoogleAnalyticsProvider):
         self.url = url
         self.params = params
 
+class MockGoogleAnalyticsDispatcher(GoogleAnalyticsDispatcher):
+    """A dispatcher that never starts a background thread; hits are
+    only sent when send_pending() is called.
+    """
+
+    RETRY_DELAY = 0
+
+    def __init__(self, **kwargs):
+        super(MockGoogleAnalyticsDispatcher, self).__init__(
+            self.mock_post, **kwargs
+        )
+        self.posts = []
+        self.failures = 0
+        self.started = False
+
+    def mock_post(self, url, body):
+        if self.failures:
+            self.failures -= 1
+            raise Exception("Google Analytics is down")
+        self.posts.append((url, body))
+
+    def _ensure_sender(self):
+        # Do what the background thread does when it starts.
+        if not self.started:
+            self.started = True
+            self._recover_spool()
+
+
 class TestGoogleAnalyticsProvider(DatabaseTest):
 
     def test_from_config(self):        
@@ -38,6 +75,42 @@ class TestGoogleAnalyticsProvider(DatabaseTest):
         ga = GoogleAnalyticsProvider.from_config(config)
         eq_("faketrackingid", ga.tracking_id)
 
+        # By default, hits are sent in the background.
+        assert isinstance(ga.dispatcher, GoogleAnalyticsDispatcher)
+        eq_(ga.post, ga.dispatcher.post)
+        eq_(None, ga.dispatcher.spool_directory)
+
+        config[Configuration.INTEGRATIONS][GoogleAnalyticsProvider.INTEGRATION_NAME].update({
+            GoogleAnalyticsProvider.QUEUE_SIZE: 5,
+            GoogleAnalyticsProvider.SPOOL_DIRECTORY: "/tmp/spool",
+        })
+        ga = GoogleAnalyticsProvider.from_config(config)
+        eq_(5, ga.dispatcher.queue.maxsize)
+        eq_("/tmp/spool", ga.dispatcher.spool_directory)
+
+        # Background sending can be turned off.
+        config[Configuration.INTEGRATIONS][GoogleAnalyticsProvider.INTEGRATION_NAME][GoogleAnalyticsProvider.ASYNCHRONOUS] = False
+        ga = GoogleAnalyticsProvider.from_config(config)
+        eq_(None, ga.dispatcher)
+
+    def test_collect_event_with_dispatcher(self):
+        ga = MockGoogleAnalyticsProvider("faketrackingid")
+        dispatcher = MockGoogleAnalyticsDispatcher()
+        ga.dispatcher = dispatcher
+
+        now = datetime.datetime.utcnow()
+        ga.collect_event(self._db, None, CirculationEvent.NEW_PATRON, now)
+
+        # Nothing was sent; the hit was queued instead.
+        eq_(False, hasattr(ga, "count"))
+        eq_(1, dispatcher.queue.qsize())
+
+        eq_(1, dispatcher.send_pending())
+        [(url, body)] = dispatcher.posts
+        eq_(GoogleAnalyticsProvider.COLLECT_URL, url)
+        params = urlparse.parse_qs(body)
+        eq_(CirculationEvent.NEW_PATRON, params['ea'][0])
+
     def test_collect_event_with_work(self):
         ga = MockGoogleAnalyticsProvider("faketrackingid")
         work = self._work(
@@ -128,3 +201,160 @@ class TestGoogleAnalyticsProvider(DatabaseTest):
         eq_(None, params.get('cd10'))
         eq_(None, params.get('cd11'))
         eq_(None, params.get('cd12'))
+
+
+class TestGoogleAnalyticsDispatcher(object):
+
+    def setup(self):
+        self.spool_directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.spool_directory)
+
+    def test_hits_are_sent_in_batches(self):
+        dispatcher = MockGoogleAnalyticsDispatcher()
+        for i in range(25):
+            dispatcher.add("hit=%d" % i)
+
+        eq_(25, dispatcher.send_pending())
+        [(url1, body1), (url2, body2)] = dispatcher.posts
+        eq_(GoogleAnalyticsProvider.BATCH_URL, url1)
+        eq_(["hit=%d" % i for i in range(20)], body1.split("\n"))
+        eq_(GoogleAnalyticsProvider.BATCH_URL, url2)
+        eq_(["hit=%d" % i for i in range(20, 25)], body2.split("\n"))
+
+    def test_batches_respect_size_limit(self):
+        dispatcher = MockGoogleAnalyticsDispatcher()
+        dispatcher.MAX_BATCH_BYTES = 15
+        for i in range(3):
+            dispatcher.add("hit=%d" % i)
+        dispatcher.send_pending()
+        eq_(["hit=0\nhit=1", "hit=2"], [x[1] for x in dispatcher.posts])
+
+    def test_full_queue_drops_hits(self):
+        dispatcher = MockGoogleAnalyticsDispatcher(queue_size=1)
+        eq_(True, dispatcher.add("hit=1"))
+        eq_(False, dispatcher.add("hit=2"))
+        dispatcher.send_pending()
+        eq_([(GoogleAnalyticsProvider.COLLECT_URL, "hit=1")], dispatcher.posts)
+
+    def test_failed_batch_is_retried(self):
+        dispatcher = MockGoogleAnalyticsDispatcher()
+        dispatcher.add("hit=1")
+        dispatcher.failures = 2
+        dispatcher.send_pending()
+        eq_([(GoogleAnalyticsProvider.COLLECT_URL, "hit=1")], dispatcher.posts)
+
+        # But not forever.
+        dispatcher.posts = []
+        dispatcher.add("hit=2")
+        dispatcher.failures = dispatcher.MAX_ATTEMPTS
+        dispatcher.send_pending()
+        eq_([], dispatcher.posts)
+
+    def test_spool(self):
+        dispatcher = MockGoogleAnalyticsDispatcher(
+            spool_directory=self.spool_directory
+        )
+        dispatcher.SEGMENT_SIZE = 2
+        dispatcher.MAX_BATCH_SIZE = 1
+        for i in range(3):
+            dispatcher.add("hit=%d" % i)
+
+        # Adding a hit doesn't touch the disk.
+        eq_([], os.listdir(self.spool_directory))
+
+        # Hits are spooled when the background thread takes them off
+        # the queue, in segments of SEGMENT_SIZE hits.
+        batch = dispatcher._next_batch(block=False)
+        eq_(["hit=0"], [hit for hit, segment in batch])
+        pid = os.getpid()
+        path1 = os.path.join(self.spool_directory, "%d-1.spool" % pid)
+        path2 = os.path.join(self.spool_directory, "%d-2.spool" % pid)
+        eq_("hit=0\nhit=1\n", open(path1).read())
+        eq_("hit=2\n", open(path2).read())
+
+        # Once a hit is sent, that's recorded in its segment.
+        dispatcher._send_and_acknowledge(batch)
+        eq_("hit=0\nhit=1\n#1\n", open(path1).read())
+
+        # Once every hit in a segment has been dealt with, the segment
+        # is deleted -- even if a hit couldn't be sent.
+        dispatcher._send_and_acknowledge(dispatcher._next_batch(block=False))
+        eq_(False, os.path.exists(path1))
+        dispatcher.failures = dispatcher.MAX_ATTEMPTS
+        dispatcher.send_pending()
+        eq_([], os.listdir(self.spool_directory))
+
+        # A new segment is started for the next hit.
+        dispatcher.add("hit=3")
+        dispatcher._next_batch(block=False)
+        eq_(["%d-3.spool" % pid], os.listdir(self.spool_directory))
+
+    def test_spool_from_dead_process_is_recovered(self):
+        path = os.path.join(self.spool_directory, "12345-1.spool")
+        with open(path, "w") as f:
+            # The first hit was sent before the process died.
+            f.write("hit=0\nhit=1\n#1\nhit=2\n")
+
+        class Mock(MockGoogleAnalyticsDispatcher):
+            alive = True
+            def _process_is_alive(self, pid):
+                return self.alive
+
+        # If the process that owns a spool file is still running, its
+        # hits are left alone.
+        dispatcher = Mock(spool_directory=self.spool_directory)
+        dispatcher.add("hit=3")
+        dispatcher.send_pending()
+        eq_([(GoogleAnalyticsProvider.COLLECT_URL, "hit=3")], dispatcher.posts)
+        eq_(True, os.path.exists(path))
+
+        # Once it's gone, another process sends the hits that weren't
+        # already sent -- even if there are more of them than will fit
+        # in its queue.
+        dispatcher = Mock(spool_directory=self.spool_directory, queue_size=1)
+        dispatcher.alive = False
+        dispatcher.add("hit=4")
+        eq_(False, os.path.exists(path))
+        dispatcher.send_pending()
+        eq_([(GoogleAnalyticsProvider.BATCH_URL, "hit=1\nhit=2"),
+             (GoogleAnalyticsProvider.COLLECT_URL, "hit=4")],
+            dispatcher.posts)
+        eq_([], os.listdir(self.spool_directory))
+
+    def test_shutdown_sends_queued_hits(self):
+        posts = []
+        def post(url, body):
+            time.sleep(0.01)
+            posts.extend(body.split("\n"))
+        dispatcher = GoogleAnalyticsDispatcher(post)
+        hits = ["hit=%d" % i for i in range(50)]
+        for hit in hits:
+            dispatcher.add(hit)
+        dispatcher.shutdown()
+        eq_(hits, posts)
+        eq_(False, dispatcher.thread.is_alive())
+
+        # Shutting down when there's no thread does nothing.
+        dispatcher.shutdown()
+
+    def test_queued_hits_are_sent_at_exit(self):
+        # A script queues some hits and exits right away. The hits
+        # are sent before the process goes away.
+        output = os.path.join(self.spool_directory, "posted")
+        script = """
+import time
+from api.google_analytics_provider import GoogleAnalyticsDispatcher
+def post(url, body):
+    time.sleep(0.05)
+    with open(%r, "a") as f:
+        f.write(body + "\\n")
+dispatcher = GoogleAnalyticsDispatcher(post)
+for i in range(50):
+    dispatcher.add("hit=%%d" %% i)
+""" % output
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        subprocess.check_call([sys.executable, "-c", script], cwd=root)
+        posted = open(output).read().split()
+        eq_(["hit=%d" % i for i in range(50)], posted)
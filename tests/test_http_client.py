@@ -0,0 +1,171 @@
+import os
+from nose.tools import (
+    set_trace,
+    eq_,
+    assert_raises,
+)
+import requests
+from requests.adapters import BaseAdapter
+
+from core.util.http import (
+    BadResponseException,
+    RequestNetworkException,
+    RequestTimedOut,
+)
+
+from api.util.http_client import PooledHTTPClient
+
+
+class MockAdapter(BaseAdapter):
+    """Answers every request with a canned response instead of going
+    over the network.
+    """
+
+    def __init__(self, status_code=200, content="ok"):
+        super(MockAdapter, self).__init__()
+        self.status_code = status_code
+        self.content = content
+        self.exception = None
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append((request, kwargs))
+        if self.exception:
+            raise self.exception
+        response = requests.Response()
+        response.status_code = self.status_code
+        response._content = self.content
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+class TestPooledHTTPClient(object):
+
+    def mock_client(self, **kwargs):
+        client = PooledHTTPClient("Test", **kwargs)
+        adapter = MockAdapter()
+        client.session.mount("http://", adapter)
+        return client, adapter
+
+    def test_for_integration(self):
+        client = PooledHTTPClient.for_integration("Test integration")
+        eq_("Test integration", client.name)
+
+        # The same client is shared by everything that talks to the
+        # integration.
+        eq_(client, PooledHTTPClient.for_integration("Test integration"))
+        assert client != PooledHTTPClient.for_integration("Another")
+
+    def test_session_configuration(self):
+        client = PooledHTTPClient(
+            "Test", pool_connections=2, connections_per_host=3
+        )
+        adapter = client.session.get_adapter("https://example.com/")
+        eq_(2, adapter._pool_connections)
+        eq_(3, adapter._pool_maxsize)
+        eq_(True, adapter._pool_block)
+
+        # The session is reused from one request to the next.
+        eq_(client.session, client.session)
+
+    def test_new_session_after_fork(self):
+        client = PooledHTTPClient("Test")
+        session = client.session
+
+        # Simulate a fork by making it look like the session was
+        # created by some other process.
+        client._session_pid = os.getpid() + 1
+        assert client.session != session
+        eq_(os.getpid(), client._session_pid)
+
+    def test_request(self):
+        client, adapter = self.mock_client()
+        response = client.get("http://example.com/", headers={"a": "b"})
+        eq_("ok", response.content)
+        [(request, kwargs)] = adapter.requests
+        eq_("GET", request.method)
+        eq_("b", request.headers["a"])
+
+        # The default timeout was applied.
+        eq_(PooledHTTPClient.DEFAULT_TIMEOUT, kwargs['timeout'])
+
+        client.post("http://example.com/", "some data")
+        request, kwargs = adapter.requests[-1]
+        eq_("POST", request.method)
+        eq_("some data", request.body)
+
+    def test_request_errors(self):
+        client, adapter = self.mock_client()
+
+        adapter.exception = requests.exceptions.Timeout("too slow")
+        assert_raises(
+            RequestTimedOut, client.get, "http://example.com/", timeout=1
+        )
+        eq_(1, adapter.requests[-1][1]['timeout'])
+
+        adapter.exception = requests.exceptions.ConnectionError("no route")
+        assert_raises(
+            RequestNetworkException, client.get, "http://example.com/"
+        )
+
+        # A 5xx response is an error unless it's explicitly allowed.
+        adapter.exception = None
+        adapter.status_code = 502
+        assert_raises(BadResponseException, client.get, "http://example.com/")
+        eq_(502, client.get(
+            "http://example.com/", allowed_response_codes=["5xx"]
+        ).status_code)
+
+        # Other responses are fine unless they're disallowed, or not
+        # on the list of allowed responses.
+        adapter.status_code = 404
+        eq_(404, client.get("http://example.com/").status_code)
+        assert_raises(
+            BadResponseException, client.get, "http://example.com/",
+            disallowed_response_codes=[404]
+        )
+        assert_raises(
+            BadResponseException, client.get, "http://example.com/",
+            allowed_response_codes=["2xx", 401]
+        )
+
+        # The arguments that control error handling aren't passed on
+        # to requests.
+        request, kwargs = adapter.requests[-1]
+        assert 'allowed_response_codes' not in kwargs
+
+    def test_timing_hooks(self):
+        timings = []
+        def hook(client, method, url, response, elapsed):
+            timings.append((client, method, url, response, elapsed))
+
+        def broken_hook(*args):
+            raise Exception("A broken hook doesn't stop the request.")
+
+        client, adapter = self.mock_client(timing_hooks=[broken_hook])
+        client.add_timing_hook(hook)
+        response = client.request("GET", "http://example.com/")
+        [(c, method, url, r, elapsed)] = timings
+        eq_(client, c)
+        eq_("GET", method)
+        eq_("http://example.com/", url)
+        eq_(response, r)
+        assert elapsed >= 0
+
+        # Hooks are called even if the request fails.
+        adapter.status_code = 500
+        assert_raises(
+            BadResponseException, client.request, "GET", "http://example.com/"
+        )
+        c, method, url, r, elapsed = timings[-1]
+        eq_(None, r)
+
+    def test_close(self):
+        client = PooledHTTPClient("Test")
+        session = client.session
+        client.close()
+        assert client.session != session
@@ -0,0 +1,82 @@
+import time
+from nose.tools import (
+    set_trace,
+    eq_,
+)
+
+from api.util.lru import ExpiringLRUCache
+
+
+class TestExpiringLRUCache(object):
+
+    def test_get_and_put(self):
+        cache = ExpiringLRUCache(10)
+        eq_(None, cache.get("a"))
+        eq_("default", cache.get("a", "default"))
+
+        cache.put("a", 1)
+        eq_(1, cache.get("a"))
+
+        # A value of None can be told apart from a missing value.
+        cache.put("b", None)
+        eq_(None, cache.get("b", "default"))
+
+        cache.put("a", 2)
+        eq_(2, cache.get("a"))
+        eq_(2, len(cache))
+
+    def test_least_recently_used_entry_is_discarded(self):
+        discarded = []
+        cache = ExpiringLRUCache(
+            2, on_discard=lambda key, value: discarded.append((key, value))
+        )
+        cache.put("a", 1)
+        cache.put("b", 2)
+
+        # Using the first entry makes the second one the least
+        # recently used.
+        cache.get("a")
+        cache.put("c", 3)
+        eq_(1, cache.get("a"))
+        eq_(None, cache.get("b"))
+        eq_(3, cache.get("c"))
+        eq_([("b", 2)], discarded)
+        eq_(["a", "c"], cache.keys())
+        eq_([1, 3], cache.values())
+
+        # The size limit can be changed after the cache is created.
+        cache.max_size = 1
+        cache.put("d", 4)
+        eq_(["d"], list(cache))
+
+    def test_expiration(self):
+        cache = ExpiringLRUCache(10, ttl=0.01)
+        cache.put("a", 1)
+        cache.put("b", 2, ttl=60)
+        time.sleep(0.02)
+        eq_(None, cache.get("a"))
+        eq_(2, cache.get("b"))
+
+        # An expired entry is removed once it's noticed.
+        eq_(["b"], cache.keys())
+
+        # Without a ttl, entries don't expire.
+        cache = ExpiringLRUCache(10)
+        cache.put("a", 1)
+        eq_(1, cache.get("a"))
+
+    def test_remove(self):
+        cache = ExpiringLRUCache(10)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.put("c", 3)
+
+        cache.remove("a")
+        cache.remove("no such key")
+        eq_(None, cache.get("a"))
+
+        cache.remove_where(lambda key, value: value > 2)
+        eq_(["b"], cache.keys())
+
+        cache.clear()
+        eq_(0, len(cache))
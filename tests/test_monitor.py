@@ -1,3 +1,4 @@
+import datetime
 from nose.tools import (
     set_trace,
     eq_,
@@ -7,7 +8,10 @@ from . import (
     DatabaseTest,
 )
 
-from api.monitor import SearchIndexMonitor
+from api.monitor import (
+    MonitorCheckpoint,
+    SearchIndexMonitor,
+)
 
 from core.external_search import DummyExternalSearchIndex
 
@@ -28,3 +32,25 @@ class TestSearchIndexMonitor(DatabaseTest):
 
         # The work was added to the search index.
         eq_([('works', 'work-type', work.id)], index.docs.keys())
+
+
+class TestMonitorCheckpoint(DatabaseTest):
+
+    def test_position(self):
+        checkpoint = MonitorCheckpoint(self._db, "Some monitor")
+        run_start = datetime.datetime(2016, 1, 1)
+
+        # There's no checkpoint yet.
+        eq_(0, checkpoint.position(run_start))
+
+        checkpoint.save(run_start, 100)
+        eq_(100, checkpoint.position(run_start))
+
+        # The checkpoint only applies to the run it was saved for.
+        eq_(0, checkpoint.position(datetime.datetime(2016, 1, 2)))
+
+        # Another monitor has its own checkpoint.
+        eq_(0, MonitorCheckpoint(self._db, "Another").position(run_start))
+
+        checkpoint.clear()
+        eq_(0, checkpoint.position(run_start))
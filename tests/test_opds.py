@@ -10,6 +10,8 @@ from nose.tools import (
     assert_raises,
 )
 import feedparser
+import flask
+from sqlalchemy import event
 from . import DatabaseTest
 
 from core.lane import (
@@ -17,6 +19,7 @@ from core.lane import (
     Lane,
 )
 from core.model import (
+    Contributor,
     DataSource,
     Library,
     Work,
@@ -52,6 +55,10 @@ from api.config import (
 from api.opds import (
     CirculationManagerAnnotator,
     CirculationManagerLoanAndHoldAnnotator,
+    ContributionCache,
+    EntryFragmentCache,
+    StreamingFeed,
+    URLTemplates,
 )
 from core.opds import (
     AcquisitionFeed,
@@ -67,6 +74,20 @@ import jwt
 _strftime = AtomFeed._strftime
 
 
+@contextlib.contextmanager
+def count_queries(_db):
+    """Record every SQL statement sent to the database."""
+    statements = []
+    connection = _db.get_bind()
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(connection, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(connection, "before_cursor_execute", record)
+
+
 class WithVendorIDTest(DatabaseTest):
 
     @contextlib.contextmanager
@@ -327,6 +348,125 @@ class TestCirculationManagerAnnotator(WithVendorIDTest):
             assert same_tag is not element
             eq_(etree.tostring(element), etree.tostring(same_tag))
 
+
+class TestURLTemplates(object):
+
+    def setup(self):
+        # A tiny app with routes shaped like the ones that show up in
+        # every OPDS entry.
+        self.app = flask.Flask(__name__)
+        def view(**kwargs):
+            return ""
+        self.app.add_url_rule(
+            '/works/<data_source>/<identifier_type>/<path:identifier>',
+            'permalink', view
+        )
+        self.app.add_url_rule(
+            '/works/<data_source>/<identifier_type>/<path:identifier>/borrow',
+            'borrow', view
+        )
+        self.app.add_url_rule(
+            '/works/<data_source>/<identifier_type>/<path:identifier>/borrow/<mechanism_id>',
+            'borrow', view
+        )
+        self.templates = URLTemplates(verify=True)
+
+    def permalink(self, **kwargs):
+        with self.app.test_request_context("/"):
+            return self.templates.url_for(
+                'permalink', _external=True, **kwargs
+            )
+
+    def test_template_reused(self):
+        url = self.permalink(
+            data_source="Axis 360", identifier_type="ISBN",
+            identifier="9781234567890"
+        )
+        eq_("http://localhost/works/Axis%20360/ISBN/9781234567890", url)
+        [template] = self.templates.templates.values()
+        eq_("http://localhost/works/%(data_source)s/%(identifier_type)s/%(identifier)s",
+            template)
+
+        # The second URL is built from the same template, and
+        # verification confirms that it's what url_for would have built.
+        url = self.permalink(
+            data_source="Gutenberg", identifier_type="Gutenberg ID",
+            identifier="http://www.gutenberg.org/ebooks/10441"
+        )
+        eq_("http://localhost/works/Gutenberg/Gutenberg%20ID/http://www.gutenberg.org/ebooks/10441", url)
+        eq_(1, len(self.templates.templates))
+
+    def test_different_arguments_different_template(self):
+        with self.app.test_request_context("/"):
+            args = dict(data_source="Overdrive", identifier_type="Overdrive ID",
+                        identifier="abc", _external=True)
+            without_mechanism = self.templates.url_for(
+                'borrow', mechanism_id=None, **args
+            )
+            with_mechanism = self.templates.url_for(
+                'borrow', mechanism_id=4, **args
+            )
+        eq_("http://localhost/works/Overdrive/Overdrive%20ID/abc/borrow",
+            without_mechanism)
+        eq_("http://localhost/works/Overdrive/Overdrive%20ID/abc/borrow/4",
+            with_mechanism)
+        eq_(2, len(self.templates.templates))
+
+    def test_unusual_values_use_url_for(self):
+        # These values need escaping that a template can't do, so
+        # url_for is used instead.
+        for identifier in [u"caf\xe9", "a?b", "100%", "x&y"]:
+            url = self.permalink(
+                data_source="Overdrive", identifier_type="ISBN",
+                identifier=identifier
+            )
+            with self.app.test_request_context("/"):
+                eq_(flask.url_for(
+                    'permalink', data_source="Overdrive",
+                    identifier_type="ISBN", identifier=identifier,
+                    _external=True
+                ), url)
+
+    def test_query_string_arguments_use_url_for(self):
+        # An argument that isn't part of the route ends up in the
+        # query string, so no template is made.
+        url = self.permalink(
+            data_source="Overdrive", identifier_type="ISBN",
+            identifier="abc", extra="value"
+        )
+        eq_("http://localhost/works/Overdrive/ISBN/abc?extra=value", url)
+        eq_([False], self.templates.templates.values())
+
+    def test_max_size(self):
+        self.templates.templates.max_size = 2
+        kwargs = dict(
+            data_source="Overdrive", identifier_type="ISBN", identifier="abc"
+        )
+        for url_root in ("http://a/", "http://b/", "http://c/"):
+            with self.app.test_request_context("/", base_url=url_root):
+                url = self.templates.url_for(
+                    'permalink', _external=True, **kwargs
+                )
+            eq_(url_root + "works/Overdrive/ISBN/abc", url)
+
+        # Every URL root gets its own template, but only the two most
+        # recently used are kept.
+        eq_(["http://b/works/%(data_source)s/%(identifier_type)s/%(identifier)s",
+             "http://c/works/%(data_source)s/%(identifier_type)s/%(identifier)s"],
+            self.templates.templates.values())
+
+    def test_verify(self):
+        # If the template and url_for disagree, verification catches it.
+        self.permalink(
+            data_source="Overdrive", identifier_type="ISBN", identifier="abc"
+        )
+        for key in self.templates.templates:
+            self.templates.templates.put(key, "http://wrong/%(identifier)s")
+        assert_raises(
+            ValueError, self.permalink, data_source="Overdrive",
+            identifier_type="ISBN", identifier="abc"
+        )
+
             
 class TestOPDS(WithVendorIDTest):
 
@@ -515,6 +655,42 @@ class TestOPDS(WithVendorIDTest):
             work.license_pools[0].presentation_edition.series = "Serious Cereal Series"
             confirm_related_books_link()
 
+    def test_contribution_cache(self):
+        cache = ContributionCache()
+        with_author = self._edition()
+        no_author = self._edition(authors=[])
+        self._db.flush()
+        ids = [with_author.id, no_author.id]
+
+        # prime() finds out about a number of editions with a single
+        # query...
+        with count_queries(self._db) as statements:
+            cache.prime(self._db, ids)
+        eq_(1, len(statements))
+
+        # ... so that deciding whether to add a related books link
+        # doesn't take any queries at all.
+        with count_queries(self._db) as statements:
+            eq_(True, cache.has_contributors(with_author))
+            eq_(False, cache.has_contributors(no_author))
+        eq_([], statements)
+
+        # When an edition gains or loses a contributor, every cache
+        # forgets what it knew about that edition.
+        other_cache = ContributionCache()
+        other_cache.put(no_author.id, False)
+        no_author.add_contributor(u"New Author", Contributor.PRIMARY_AUTHOR_ROLE)
+        self._db.commit()
+        eq_(None, cache.get(no_author.id))
+        eq_(None, other_cache.get(no_author.id))
+        eq_(True, cache.has_contributors(no_author))
+
+        for contribution in with_author.contributions:
+            self._db.delete(contribution)
+        self._db.commit()
+        eq_(None, cache.get(with_author.id))
+        eq_(False, cache.has_contributors(with_author))
+
     def test_acquisition_feed_includes_annotations_link(self):
         w1 = self._work(with_open_access_download=True)
         self._db.commit()
@@ -644,6 +820,84 @@ class TestOPDS(WithVendorIDTest):
         eq_(patron.username, feed_details['simplified_patron']['simplified:username'])
         eq_(u'987654321', feed_details['simplified_patron']['simplified:authorizationidentifier'])
 
+    def test_loans_feed_query_count_does_not_depend_on_loans(self):
+        patron = self._patron()
+        now = datetime.datetime.utcnow()
+
+        def add_loan_and_hold():
+            work = self._work(language="eng", with_open_access_download=True)
+            work.license_pools[0].loan_to(patron, start=now)
+            work = self._work(language="eng", with_license_pool=True)
+            work.license_pools[0].on_hold_to(patron, start=now, position=1)
+
+        def queries_for_loans_feed():
+            # Build the feed once so that any cached entries are
+            # created, then count the queries needed to build it again.
+            self._db.commit()
+            unicode(CirculationManagerLoanAndHoldAnnotator.active_loans_for(
+                None, patron, test_mode=True
+            ))
+            self._db.expire_all()
+            with count_queries(self._db) as statements:
+                feed = unicode(
+                    CirculationManagerLoanAndHoldAnnotator.active_loans_for(
+                        None, patron, test_mode=True
+                    )
+                )
+            return len(statements), feed
+
+        add_loan_and_hold()
+        few, feed = queries_for_loans_feed()
+        eq_(2, len(feedparser.parse(feed)['entries']))
+
+        for i in range(3):
+            add_loan_and_hold()
+        many, feed = queries_for_loans_feed()
+        eq_(8, len(feedparser.parse(feed)['entries']))
+
+        # Four times as many loans and holds take no more queries.
+        eq_(few, many)
+
+    def test_streaming_loans_feed(self):
+        patron = self._patron()
+        patron.username = u'bellhooks'
+        now = datetime.datetime.utcnow()
+        work1 = self._work(language="eng", with_open_access_download=True)
+        work1.license_pools[0].loan_to(patron, start=now)
+        work2 = self._work(language="eng", with_license_pool=True)
+        work2.license_pools[0].on_hold_to(patron, start=now, position=2)
+
+        stream = CirculationManagerLoanAndHoldAnnotator.active_loans_for(
+            None, patron, test_mode=True, stream=True
+        )
+        assert isinstance(stream, StreamingFeed)
+
+        # The feed comes out in pieces: the feed-level tags, then one
+        # piece per entry, then the closing tag.
+        pieces = list(stream)
+        eq_(4, len(pieces))
+        assert pieces[0].startswith("<feed")
+        assert "simplified:username" in pieces[0]
+        for piece in pieces[1:3]:
+            assert piece.startswith("<entry")
+        eq_("</feed>", pieces[-1])
+
+        # Put together, they make the same feed as the non-streaming
+        # version, except that the feed-level tags come first.
+        streamed = feedparser.parse("".join(pieces))
+        feed_obj = CirculationManagerLoanAndHoldAnnotator.active_loans_for(
+            None, patron, test_mode=True
+        )
+        built = feedparser.parse(unicode(feed_obj))
+        eq_(sorted(x['title'] for x in built['entries']),
+            sorted(x['title'] for x in streamed['entries']))
+        eq_(sorted(x['href'] for x in built['feed']['links']),
+            sorted(x['href'] for x in streamed['feed']['links']))
+        for built_entry in built['entries']:
+            [streamed_entry] = [x for x in streamed['entries']
+                                if x['id'] == built_entry['id']]
+            eq_(built_entry['links'], streamed_entry['links'])
+
     def test_loans_feed_includes_preload_link(self):
         patron = self._patron()
         feed_obj = CirculationManagerLoanAndHoldAnnotator.active_loans_for(
@@ -714,6 +968,96 @@ class TestOPDS(WithVendorIDTest):
         copies_re = re.compile('<opds:copies[^>]+total="100"', re.S)
         assert copies_re.search(u) is not None
 
+    def test_entry_fragment_cache(self):
+        work = self._work(with_open_access_download=True)
+        pool = work.license_pools[0]
+        pool.open_access = False
+        pool.licenses_owned = 10
+        pool.licenses_available = 5
+        self._db.commit()
+        cache = EntryFragmentCache()
+
+        def links(**kwargs):
+            annotator = CirculationManagerAnnotator(
+                None, Fantasy, test_mode=True, entry_fragment_cache=cache,
+                **kwargs
+            )
+            feed = AcquisitionFeed(self._db, "test", "url", [work], annotator)
+            [entry] = feedparser.parse(unicode(feed))['entries']
+            return entry['links']
+
+        # The first time the entry is built, its links are cached.
+        first = links()
+        eq_(1, len(cache._entries))
+        [cached] = cache._entries.values()
+        eq_(len(first), len(cached))
+
+        # The second time, the cached links are used, and they're the
+        # same as the ones built the first time.
+        eq_(first, links())
+        eq_(1, len(cache._entries))
+
+        # When the book's availability changes, the links are built
+        # again.
+        pool.licenses_available = 4
+        links()
+        eq_(2, len(cache._entries))
+        copies_re = re.compile('<opds:copies[^>]+available="4"', re.S)
+        feed = AcquisitionFeed(
+            self._db, "test", "url", [work], CirculationManagerAnnotator(
+                None, Fantasy, test_mode=True, entry_fragment_cache=cache
+            )
+        )
+        assert copies_re.search(unicode(feed)) is not None
+
+        # A patron with a loan gets their own links, which aren't
+        # cached.
+        patron = self._patron()
+        loan, ignore = pool.loan_to(patron)
+        with_loan = links(active_loans_by_work={work: loan})
+        eq_(2, len(cache._entries))
+        assert OPDSFeed.REVOKE_LOAN_REL in [x['rel'] for x in with_loan]
+
+    def test_entry_fragment_cache_notices_new_href(self):
+        work = self._work(with_open_access_download=True)
+        pool = work.license_pools[0]
+        [lpdm] = pool.delivery_mechanisms
+        self._db.commit()
+        cache = EntryFragmentCache()
+
+        def hrefs():
+            annotator = CirculationManagerAnnotator(
+                None, Fantasy, test_mode=True, entry_fragment_cache=cache
+            )
+            feed = AcquisitionFeed(self._db, "test", "url", [work], annotator)
+            [entry] = feedparser.parse(unicode(feed))['entries']
+            return [x['href'] for x in entry['links']]
+
+        old_url = lpdm.resource.url
+        assert old_url in hrefs()
+        eq_(1, len(cache._entries))
+
+        # The open-access download moves to a new URL, without the
+        # LicensePool itself changing. The cached links aren't used.
+        lpdm.resource.url = "http://example.com/new-location.epub"
+        new_hrefs = hrefs()
+        assert "http://example.com/new-location.epub" in new_hrefs
+        assert old_url not in new_hrefs
+        eq_(2, len(cache._entries))
+
+        # An annotator that looked up everything about the work ahead
+        # of time finds the same cache entry.
+        annotator = CirculationManagerAnnotator(
+            None, Fantasy, test_mode=True, entry_fragment_cache=cache
+        )
+        key = annotator._entry_fragment_key(
+            pool, pool.data_source.name, pool.identifier
+        )
+        annotator.prepare_works(self._db, [work])
+        eq_(key, annotator._entry_fragment_key(
+            pool, pool.data_source.name, pool.identifier
+        ))
+
     def test_loans_feed_includes_fulfill_links_for_streaming(self):
         patron = self._patron()
 
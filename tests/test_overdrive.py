@@ -5,12 +5,16 @@ from nose.tools import (
 )
 import pkgutil
 import json
+import threading
+import time
 from datetime import (
     datetime,
     timedelta,
 )
 from api.overdrive import (
     MockOverdriveAPI,
+    OverdriveCirculationMonitor,
+    PatronTokenCache,
 )
 
 from api.circulation import (
@@ -500,7 +504,175 @@ class TestOverdriveAPI(OverdriveAPITest):
         eq_("websiteid:d authorizationname:default", payload['scope'])
         eq_("false", payload['password_required'])
         eq_("[ignore]", payload['password'])
-        
+
+    def test_patron_access_token(self):
+        api = MockOverdriveAPI(self._db)
+        patron = self._patron()
+        patron.authorization_identifier = 'barcode'
+        data, raw = self.sample_json("patron_token.json")
+
+        # The patron has no token, so one is requested from Overdrive
+        # and stored in the database.
+        api.queue_response(200, content=raw)
+        token = api.patron_access_token(patron, "a pin")
+        eq_(raw['access_token'], token)
+        credential = api.get_patron_credential(patron, "a pin")
+        eq_(token, credential.credential)
+        requests_made = len(api.access_token_requests)
+
+        # From this point on the token comes from memory, so a change
+        # to the database goes unnoticed.
+        credential.credential = "changed"
+        eq_(token, api.patron_access_token(patron, "a pin"))
+        eq_(requests_made, len(api.access_token_requests))
+
+        # Once Overdrive rejects the token, a new one is requested
+        # and written to the database.
+        api.queue_response(200, content=dict(raw, access_token="new token"))
+        eq_("new token", api.patron_access_token(
+            patron, "a pin", rejected=token
+        ))
+        eq_("new token", credential.credential)
+        eq_(requests_made+1, len(api.access_token_requests))
+
+        # A token that's about to expire is refreshed before Overdrive
+        # has a chance to reject it.
+        credential.expires = datetime.utcnow() + timedelta(minutes=1)
+        api.patron_tokens.put(
+            (api.website_id, patron.id), "new token", credential.expires
+        )
+        api.queue_response(
+            200, content=dict(raw, access_token="newer token")
+        )
+        eq_("newer token", api.patron_access_token(patron, "a pin"))
+        eq_(requests_made+2, len(api.access_token_requests))
+
+
+class TestPatronTokenCache(object):
+
+    def test_get_and_put(self):
+        cache = PatronTokenCache(max_size=2)
+        eq_(None, cache.get("a"))
+
+        the_future = datetime.utcnow() + timedelta(hours=1)
+        cache.put("a", "token a", the_future)
+        eq_("token a", cache.get("a"))
+
+        # Tokens without an expiration date never need refreshing.
+        cache.put("b", "token b", None)
+        eq_("token b", cache.get("b"))
+
+        # The least recently used token is dropped to make room.
+        cache.put("c", "token c", the_future)
+        eq_(None, cache.get("a"))
+        eq_("token b", cache.get("b"))
+
+        # A token that's about to expire is treated as missing.
+        cache.put("c", "token c", datetime.utcnow() + timedelta(minutes=1))
+        eq_(None, cache.get("c"))
+
+        cache.invalidate("b")
+        eq_(None, cache.get("b"))
+
+    def test_token(self):
+        cache = PatronTokenCache()
+        the_future = datetime.utcnow() + timedelta(hours=1)
+        refreshes = []
+        def refresh(force):
+            refreshes.append(force)
+            return "token %d" % len(refreshes), the_future
+
+        eq_("token 1", cache.token("key", refresh))
+        eq_("token 1", cache.token("key", refresh))
+        eq_([False], refreshes)
+
+        # A rejected token is replaced even though it hasn't expired.
+        eq_("token 2", cache.token("key", refresh, rejected="token 1"))
+        eq_([False, True], refreshes)
+
+        # If the rejected token has already been replaced, the
+        # replacement is used.
+        eq_("token 2", cache.token("key", refresh, rejected="token 1"))
+        eq_([False, True], refreshes)
+
+    def test_concurrent_refreshes_are_coalesced(self):
+        cache = PatronTokenCache()
+        the_future = datetime.utcnow() + timedelta(hours=1)
+        refreshes = []
+        def refresh(force):
+            refreshes.append(force)
+            time.sleep(0.1)
+            return "token", the_future
+
+        tokens = []
+        def get_token():
+            tokens.append(cache.token("key", refresh))
+        threads = [threading.Thread(target=get_token) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(["token"] * 5, tokens)
+        eq_(1, len(refreshes))
+
+        # Once no thread is refreshing the token, its lock is gone.
+        eq_({}, cache._refresh_locks)
+
+    def test_refresh_lock_outlives_failed_refresh(self):
+        cache = PatronTokenCache()
+        the_future = datetime.utcnow() + timedelta(hours=1)
+        releases = [threading.Event(), threading.Event()]
+        refreshes = []
+        def refresh(force):
+            refreshes.append(force)
+            releases[len(refreshes)-1].wait(5)
+            if len(refreshes) == 1:
+                raise Exception("Overdrive is down")
+            return "token", the_future
+
+        tokens = []
+        def get_token():
+            try:
+                tokens.append(cache.token("key", refresh))
+            except Exception, e:
+                tokens.append(None)
+
+        def wait_for(condition):
+            for i in range(500):
+                if condition():
+                    return
+                time.sleep(0.01)
+            raise Exception("Timed out.")
+
+        def users():
+            return cache._refresh_locks.get("key", (None, 0))[1]
+
+        # One thread starts refreshing the token, and another waits
+        # for it.
+        threads = [threading.Thread(target=get_token) for i in range(3)]
+        threads[0].start()
+        wait_for(lambda: len(refreshes) == 1)
+        threads[1].start()
+        wait_for(lambda: users() == 2)
+
+        # The first refresh fails, so the second thread tries again.
+        releases[0].set()
+        wait_for(lambda: len(refreshes) == 2)
+
+        # A thread that comes along now waits for the second thread's
+        # refresh instead of starting one of its own.
+        threads[2].start()
+        wait_for(lambda: users() == 2)
+        eq_(2, len(refreshes))
+
+        releases[1].set()
+        for thread in threads:
+            thread.join()
+        eq_([None, "token", "token"], tokens)
+        eq_(2, len(refreshes))
+        eq_({}, cache._refresh_locks)
+
+
 class TestExtractData(OverdriveAPITest):
 
     def test_get_download_link(self):
@@ -697,3 +869,101 @@ class TestSyncBookshelf(OverdriveAPITest):
         loans, holds = circulation.sync_bookshelf(patron, "dummy pin")
         eq_(5, len(patron.holds))
         assert threem_hold in patron.holds
+
+
+class MockAvailabilityAPI(object):
+    """Pretends to look up availability information, and keeps track
+    of which books were updated.
+    """
+
+    def __init__(self, changed, crash_on=None):
+        self.changed = changed
+        self.crash_on = crash_on
+        self.updated = []
+        self.fetched = []
+        self.credential_checks = []
+
+    def check_creds(self):
+        self.credential_checks.append(threading.current_thread())
+
+    def fetch_availability(self, book_id):
+        time.sleep(0.01)
+        self.fetched.append(book_id)
+        if book_id == "error":
+            raise Exception("Overdrive is down.")
+        return dict(id=book_id)
+
+    def apply_availability(self, book):
+        if book is None:
+            return None, None, False
+        if book['id'] == self.crash_on:
+            raise Exception("The monitor crashed.")
+        self.updated.append(book['id'])
+        return None, False, book['id'] in self.changed
+
+
+class TestOverdriveCirculationMonitor(OverdriveAPITest):
+
+    ids = ["a", None, "b", "error", "c", "d", "e", "f", "g"]
+
+    def monitor(self, changed, monitor_class=OverdriveCirculationMonitor,
+                crash_on=None, **kwargs):
+        monitor = monitor_class(
+            self._db, workers=3, batch_size=2, **kwargs
+        )
+        monitor.api = MockAvailabilityAPI(changed, crash_on)
+        monitor.recently_changed_ids = lambda start, cutoff: self.ids
+        return monitor
+
+    def test_run_once(self):
+        monitor = self.monitor(["a", "c"])
+        monitor.run_once(None, None)
+
+        # Books were updated in order, even though their availability
+        # was fetched in parallel. A missing ID was ignored, and so
+        # was a book whose availability couldn't be fetched.
+        eq_(["a", "b", "c", "d", "e", "f", "g"], monitor.api.updated)
+
+        # The collection token was checked in this thread at the start
+        # of the run and after each batch of two books, so the worker
+        # threads never had to refresh it.
+        eq_([threading.current_thread()] * 5, monitor.api.credential_checks)
+
+    def test_maximum_consecutive_unchanged_books(self):
+        monitor = self.monitor(
+            ["a", "b", "e"], maximum_consecutive_unchanged_books=2
+        )
+        monitor.run_once(None, None)
+
+        # A book whose availability couldn't be fetched doesn't count
+        # as unchanged, so the monitor stopped after "d". Books further
+        # down the list may have been fetched, but they weren't
+        # updated.
+        eq_(["a", "b", "c", "d"], monitor.api.updated)
+
+        # Every request that was in flight when the monitor stopped
+        # was allowed to finish before run_once returned.
+        eq_(sorted(x for x in self.ids if x), sorted(monitor.api.fetched))
+
+    def test_resume_interrupted_run(self):
+        class Monitor(OverdriveCirculationMonitor):
+            RESUMABLE = True
+
+        monitor = self.monitor([], Monitor, crash_on="e")
+        assert_raises(Exception, monitor.run_once, None, None)
+        eq_(["a", "b", "c", "d"], monitor.api.updated)
+
+        # Everything up to "c" was committed, but the checkpoint
+        # didn't move past the book whose availability couldn't be
+        # fetched.
+        eq_(3, monitor.checkpoint.position(None))
+
+        # When the run is tried again, it picks up after "b", so the
+        # book that failed is tried again.
+        monitor = self.monitor([], Monitor)
+        monitor.run_once(None, None)
+        eq_(["c", "d", "e", "f", "g"], monitor.api.updated)
+        eq_(0, monitor.checkpoint.position(None))
+
+        # A monitor that isn't resumable doesn't keep a checkpoint.
+        eq_(None, self.monitor([]).checkpoint)
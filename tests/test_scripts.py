@@ -5,6 +5,9 @@ from nose.tools import (
 
 import contextlib
 import datetime
+import os
+import shutil
+import tempfile
 
 from api.adobe_vendor_id import (
     AdobeVendorIDModel,
@@ -15,6 +18,7 @@ from api.config import (
     temp_config,
     Configuration,
 )
+from api.feed_compression import CompressedFeedCache
 
 from core.lane import (
     Lane,
@@ -37,6 +41,7 @@ from scripts import (
     CacheRepresentationPerLane,
     CacheFacetListsPerLane,
     InstanceInitializationScript,
+    LaneSweeperScript,
     LoanReaperScript,
 )
 
@@ -156,6 +161,101 @@ class TestRepresentationPerLane(TestLaneScript):
             eq_(True, script.should_process_lane(child))
 
 
+    def test_workers_and_max_time(self):
+        with self.temp_config() as config:
+            script = CacheRepresentationPerLane(self._db, [], testing=True)
+            eq_(1, script.workers)
+            eq_(None, script.max_time)
+
+            script = CacheRepresentationPerLane(
+                self._db, ["--workers=4", "--max-time=600"], testing=True
+            )
+            eq_(4, script.workers)
+            eq_(600, script.max_time)
+
+
+class TestLaneSweeperScript(TestLaneScript):
+
+    def test_process_lanes(self):
+        processed = []
+        class Mock(LaneSweeperScript):
+            def process_lane(self, lane):
+                processed.append(lane)
+
+        with self.temp_config() as config:
+            script = Mock(self._db, testing=True)
+            child = Lane(self._db, "child")
+            parent = Lane(self._db, "parent", sublanes=[child])
+
+            # Each lane is timed.
+            timings = script.process_lanes([parent, child])
+            eq_([parent, child], processed)
+            eq_(2, len(timings))
+            for (lane_key, elapsed), name in zip(timings, ["parent", "child"]):
+                assert lane_key.endswith("/" + name)
+                assert elapsed >= 0
+
+            # Once the deadline has passed, no more lanes are
+            # processed.
+            eq_([], script.process_lanes([parent, child], deadline=1))
+            eq_(2, len(processed))
+
+    def test_run(self):
+        processed = []
+        class Mock(LaneSweeperScript):
+            def process_lane(self, lane):
+                processed.append(lane)
+
+        with self.temp_config() as config:
+            script = Mock(self._db, testing=True)
+            lanes = script.lanes()
+
+            # The lanes are found breadth-first.
+            eq_(script.app.manager.top_level_lane, lanes[0])
+
+            timings = script.run()
+            eq_(lanes, processed)
+            eq_(len(lanes), len(timings))
+
+    def test_process_lanes_in_parallel(self):
+        class Mock(LaneSweeperScript):
+            released = False
+
+            def release_database_connections(self):
+                self.released = True
+
+            def setup_worker(self):
+                # Don't connect to the production database.
+                pass
+
+            def lanes(self):
+                return ["a", "b", "c", "d", "e"]
+
+            def process_and_time_lane(self, lane):
+                return lane, os.getpid()
+
+        with self.temp_config() as config:
+            script = Mock(self._db, testing=True, workers=2)
+            timings = script.process_lanes_in_parallel(5)
+
+            # Database connections were released before the worker
+            # processes were forked.
+            eq_(True, script.released)
+
+            # Every lane was processed, in some other process.
+            eq_(["a", "b", "c", "d", "e"], sorted(x for x, pid in timings))
+            pids = set(pid for x, pid in timings)
+            assert os.getpid() not in pids
+            assert len(pids) <= 2
+
+            # Once the deadline has passed, the workers don't process
+            # any more lanes.
+            eq_([], script.process_lanes_in_parallel(5, deadline=1))
+
+            # run() hands the lanes to the worker processes.
+            eq_(5, len(script.run()))
+
+
 class TestCacheFacetListsPerLane(TestLaneScript):
 
     def test_default_arguments(self):
@@ -212,9 +312,32 @@ class TestCacheFacetListsPerLane(TestLaneScript):
                 testing=True
             )
             with script.app.test_request_context("/"):
+                # With nowhere to put compressed feeds that the web
+                # application can see, the feeds aren't compressed.
+                script.app.manager.compressed_feeds = CompressedFeedCache()
                 cached_feeds = script.process_lane(lane)
                 # 2 availabilities * 2 collections * 1 order * 1 page = 4 feeds
                 eq_(4, len(cached_feeds))
+                eq_(0, len(script.app.manager.compressed_feeds._entries))
+
+                directory = tempfile.mkdtemp()
+                try:
+                    compressed_feeds = CompressedFeedCache(directory)
+                    script.app.manager.compressed_feeds = compressed_feeds
+                    cached_feeds = script.process_lane(lane)
+
+                    # Each feed has been compressed and written to the
+                    # directory, ready to be served by any process.
+                    web_cache = CompressedFeedCache(directory)
+                    for feed in cached_feeds:
+                        key = compressed_feeds.key(
+                            feed.content.encode("utf8")
+                        )
+                        assert web_cache._read(
+                            key, CompressedFeedCache.GZIP
+                        ) is not None
+                finally:
+                    shutil.rmtree(directory)
 
 
 class TestInstanceInitializationScript(DatabaseTest):
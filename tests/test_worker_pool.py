@@ -0,0 +1,130 @@
+import threading
+from nose.tools import (
+    set_trace,
+    eq_,
+    assert_raises,
+)
+
+from api.util.worker_pool import (
+    Job,
+    WorkerPool,
+)
+
+
+class TestJob(object):
+
+    def test_run_records_result(self):
+        job = Job(lambda x, y: x + y, 1, y=2)
+        eq_(False, job.done)
+        job.run()
+        eq_(True, job.done)
+        eq_(3, job.result)
+        eq_(None, job.exception)
+        assert job.elapsed >= 0
+
+    def test_run_records_exception(self):
+        def explode():
+            raise ValueError("oops")
+        job = Job(explode)
+        job.run()
+        eq_(True, job.done)
+        eq_(None, job.result)
+        assert isinstance(job.exception, ValueError)
+        eq_(ValueError, job.exc_info[0])
+
+    def test_add_done_callback(self):
+        called = []
+        job = Job(lambda: 5)
+
+        # A callback added before the job runs is called when it
+        # finishes.
+        job.add_done_callback(lambda j: called.append(("before", j.result)))
+        eq_([], called)
+        job.run()
+        eq_([("before", 5)], called)
+
+        # A callback added afterwards is called immediately.
+        job.add_done_callback(lambda j: called.append(("after", j.result)))
+        eq_([("before", 5), ("after", 5)], called)
+
+        # An exception in a callback doesn't propagate.
+        def explode(j):
+            raise Exception("oops")
+        job.add_done_callback(explode)
+
+    def test_wait_gives_up_after_timeout(self):
+        job = Job(lambda: None)
+        eq_(False, job.wait(0.01))
+        job.run()
+        eq_(True, job.wait(0.01))
+
+
+class TestWorkerPool(object):
+
+    def test_size_must_be_positive(self):
+        assert_raises(ValueError, WorkerPool, 0)
+
+    def test_submit(self):
+        pool = WorkerPool(2, "Test pool")
+        eq_([], pool.threads)
+
+        job = pool.submit(lambda: threading.current_thread().name)
+        eq_(True, job.wait(5))
+
+        # The job ran in one of the pool's threads, which were started
+        # on demand.
+        eq_(2, len(pool.threads))
+        assert job.result.startswith("Test pool")
+
+        # Submitting another job reuses the same threads.
+        threads = list(pool.threads)
+        job = pool.submit(lambda: 1)
+        eq_(True, job.wait(5))
+        eq_(threads, pool.threads)
+        pool.shutdown()
+
+    def test_jobs_run_concurrently(self):
+        pool = WorkerPool(2)
+        release = threading.Event()
+        started = []
+        def wait_for_release(x):
+            started.append(x)
+            release.wait(5)
+            return x
+
+        jobs = [pool.submit(wait_for_release, x) for x in (1, 2)]
+
+        # Both jobs start without waiting for the other to finish.
+        eq_(False, jobs[0].wait(0.1))
+        eq_(set([1, 2]), set(started))
+
+        release.set()
+        for job in jobs:
+            eq_(True, job.wait(5))
+        eq_([1, 2], [job.result for job in jobs])
+        pool.shutdown()
+
+    def test_shutdown(self):
+        pool = WorkerPool(2)
+        started = threading.Event()
+        release = threading.Event()
+        def wait_for_release():
+            started.set()
+            release.wait(5)
+            return "done"
+        job = pool.submit(wait_for_release)
+        started.wait(5)
+        threads = list(pool.threads)
+
+        # Jobs submitted before shutdown() still run, and then the
+        # threads stop.
+        release.set()
+        pool.shutdown()
+        eq_("done", job.result)
+        eq_([], pool.threads)
+        eq_([False, False], [x.is_alive() for x in threads])
+
+        # The pool can still be used.
+        eq_(True, pool.submit(lambda: 1).wait(5))
+        eq_(2, len(pool.threads))
+        pool.shutdown()